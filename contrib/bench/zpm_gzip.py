@@ -0,0 +1,102 @@
+#!/usr/bin/env python
+#
+#  Copyright 2014 Rackspace, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""
+Compare the zapp compression of tarfile 'w:gz' with zpmlib.pgzip.
+
+A tar of half random, half repetitive data (roughly what a zapp with data
+files and Python sources looks like to the compressor) is written with
+``tarfile.open(path, 'w:gz')`` and with a :class:`zpmlib.pgzip.GzipWriter`
+for each number of threads::
+
+    $ python contrib/bench/zpm_gzip.py --size 256 --jobs 1 2 4 8
+"""
+
+import argparse
+import io
+import os
+import shutil
+import sys
+import tarfile
+import tempfile
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)),
+                                '..', '..'))
+
+from zpmlib import pgzip  # noqa
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def _add_members(tar, size_mb):
+    for i in range(size_mb):
+        if i % 2:
+            data = os.urandom(CHUNK_SIZE)
+        else:
+            data = ('def function_%d(arg):\n    return arg\n' % i).encode() * (
+                CHUNK_SIZE // 40)
+        info = tarfile.TarInfo(name='data/%05d' % i)
+        info.size = len(data)
+        tar.addfile(info, io.BytesIO(data))
+
+
+def run_tarfile(path, size_mb):
+    started = time.time()
+    tar = tarfile.open(path, 'w:gz')
+    _add_members(tar, size_mb)
+    tar.close()
+    return time.time() - started
+
+
+def run_pgzip(path, size_mb, jobs):
+    started = time.time()
+    with open(path, 'wb') as fp:
+        gz = pgzip.GzipWriter(fp, jobs=jobs)
+        tar = tarfile.open(fileobj=gz, mode='w')
+        _add_members(tar, size_mb)
+        tar.close()
+        gz.close()
+    return time.time() - started
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--size', type=int, default=256,
+                        help='uncompressed size, in MB')
+    parser.add_argument('--jobs', type=int, nargs='+', default=[1, 2, 4, 8])
+    args = parser.parse_args()
+
+    work_dir = tempfile.mkdtemp()
+    path = os.path.join(work_dir, 'bench.zapp')
+    try:
+        row = '%-16s %9s %12s'
+        print(row % ('compressor', 'time', 'size'))
+        elapsed = run_tarfile(path, args.size)
+        print(row % ("tarfile 'w:gz'", '%.2fs' % elapsed,
+                     os.path.getsize(path)))
+        sys.stdout.flush()
+        for jobs in args.jobs:
+            elapsed = run_pgzip(path, args.size, jobs)
+            print(row % ('pgzip -j %d' % jobs, '%.2fs' % elapsed,
+                         os.path.getsize(path)))
+            sys.stdout.flush()
+    finally:
+        shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
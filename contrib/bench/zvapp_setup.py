@@ -0,0 +1,118 @@
+#!/usr/bin/env python
+#
+#  Copyright 2014 Rackspace, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""
+Measure how long zvapp takes to set up big cluster maps.
+
+A stand-in ``zerovm`` which just prints a report and exits is put first in
+the ``PATH``, so the numbers are all zvapp overhead. The timings are taken
+from the ``--trace-out`` timeline of each run::
+
+    $ python contrib/bench/zvapp_setup.py --nodes 1000 10000
+"""
+
+import argparse
+import json
+import os
+import shutil
+import stat
+import subprocess
+import sys
+import tempfile
+import time
+
+FAKE_ZEROVM = """\
+#!/bin/sh
+printf '0\\n0\\n0\\n\\n0 0 0 0 0 0 0 0 0 0 0 0\\nok.\\n'
+"""
+
+
+def _write_fixture(work_dir, nodes):
+    bin_dir = os.path.join(work_dir, 'bin')
+    os.makedirs(bin_dir)
+    zerovm = os.path.join(bin_dir, 'zerovm')
+    with open(zerovm, 'w') as fp:
+        fp.write(FAKE_ZEROVM)
+    os.chmod(zerovm, os.stat(zerovm).st_mode | stat.S_IEXEC)
+
+    nexe_dir = os.path.join(work_dir, 'swift', 'bin')
+    os.makedirs(nexe_dir)
+    open(os.path.join(nexe_dir, 'nexe'), 'w').close()
+
+    job = [{'name': 'node',
+            'exec': {'path': 'swift://local/bin/nexe'},
+            'count': nodes,
+            'devices': [{'name': 'stdout'}]}]
+    job_file = os.path.join(work_dir, 'job.json')
+    with open(job_file, 'w') as fp:
+        json.dump(job, fp)
+    return bin_dir, job_file
+
+
+def run(zvapp, python, nodes):
+    work_dir = tempfile.mkdtemp()
+    try:
+        bin_dir, job_file = _write_fixture(work_dir, nodes)
+        trace_file = os.path.join(work_dir, 'trace.json')
+        env = dict(os.environ)
+        env['PATH'] = bin_dir + os.pathsep + env.get('PATH', '')
+        cmd = [python, zvapp,
+               '--swift-account-path', os.path.join(work_dir, 'swift'),
+               '--trace-out', trace_file, job_file]
+        with open(os.devnull, 'w') as devnull:
+            started = time.time()
+            subprocess.check_call(cmd, env=env, stdout=devnull)
+            wall = time.time() - started
+        with open(trace_file) as fp:
+            events = json.load(fp)['traceEvents']
+    finally:
+        shutil.rmtree(work_dir)
+
+    phases = dict((e['name'], e['dur'] / 1e6) for e in events
+                  if e['ph'] == 'X' and e['tid'] == 0)
+    spawns = [e['ts'] / 1e6 for e in events if e['name'] == 'spawn']
+    return dict(nodes=nodes, wall=wall,
+                parse=phases.get('parse', 0),
+                prepare=phases.get('prepare', 0),
+                first_start=min(spawns) if spawns else 0,
+                last_start=max(spawns) if spawns else 0)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[1])
+    parser.add_argument('--nodes', type=int, nargs='+', default=[1000, 10000])
+    parser.add_argument('--zvapp', default=os.path.join(
+        os.path.dirname(os.path.abspath(__file__)), '..', '..', 'zvapp'))
+    parser.add_argument('--python', default='python2',
+                        help='interpreter zvapp is run with')
+    args = parser.parse_args()
+
+    row = '%8s %9s %9s %9s %12s %12s'
+    print(row % ('nodes', 'wall', 'parse', 'prepare', 'first start',
+                 'last start'))
+    for nodes in args.nodes:
+        result = run(args.zvapp, args.python, nodes)
+        print(row % (result['nodes'],
+                     '%.2fs' % result['wall'],
+                     '%.2fs' % result['parse'],
+                     '%.2fs' % result['prepare'],
+                     '%.2fs' % result['first_start'],
+                     '%.2fs' % result['last_start']))
+        sys.stdout.flush()
+
+
+if __name__ == '__main__':
+    main()
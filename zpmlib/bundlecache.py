@@ -0,0 +1,479 @@
+#  Copyright 2014 Rackspace, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""
+Reproducible zapp writing, with reuse of the compressed members of previous
+bundles.
+
+Members are added in a stable order with normalized metadata (owner, mode
+and mtime), so bundling the same project twice gives the same bytes.
+
+The first member of a zapp is an index (see :attr:`INDEX_MEMBER`) listing the
+name, type, offsets in the tar stream, size and SHA-1 of every member, and the
+digest of the whole content, so tools can read it by decompressing the first
+few KB of the zapp only (see :func:`read_index`). Since the index is only
+known once the rest is written, the rest is written to a separate file first
+(see :func:`write_zapp`).
+
+Every big enough file added to a zapp is compressed into gzip members of its
+own (see :meth:`zpmlib.pgzip.GzipWriter.segment`), which are also kept in the
+project's ``.zapp/bundle-cache`` directory, keyed by the hash of the tar
+header and of the file content. When the project is bundled again, the
+members of unchanged files are copied from the cache instead of being
+compressed again.
+
+Files with the same content as one already in the zapp are stored as hard
+links to it.
+
+Thanks to the index, a zapp can also be read in a single pass: see
+:class:`ZappStream`.
+"""
+
+import copy
+import gzip
+import hashlib
+import io
+import json
+import os
+import tarfile
+import time
+
+import zpmlib
+from zpmlib import pgzip
+
+LOG = zpmlib.get_logger(__name__)
+
+#: Files smaller than this are compressed together with their neighbours,
+#: which compresses better than a gzip member per file
+MIN_CACHED_SIZE = 64 * 1024
+
+#: First member of the zapps, the JSON index of the others
+INDEX_MEMBER = 'boot/zapp.index'
+#: mtime of all the members
+MTIME = 0
+
+_INDEX = 'index.json'
+_MEMBER_TYPES = {
+    tarfile.REGTYPE: 'file',
+    tarfile.AREGTYPE: 'file',
+    tarfile.DIRTYPE: 'dir',
+    tarfile.LNKTYPE: 'link',
+    tarfile.SYMTYPE: 'symlink',
+}
+_ENTRY_SUFFIX = '.gz'
+_PARTIAL_SUFFIX = '.tmp'
+_BUFFER_SIZE = 65536
+#: Coarsest mtime resolution of the filesystems (FAT), a file modified less
+#: than this before it was hashed may change again without its mtime moving
+_MTIME_GRANULARITY = 2.0
+
+
+def file_digest(fileobj, size):
+    """Return the hex digest of the next `size` bytes of `fileobj`, leaving
+    its position unchanged.
+    """
+    position = fileobj.tell()
+    digest = hashlib.sha1()
+    remaining = size
+    while remaining > 0:
+        chunk = fileobj.read(min(remaining, _BUFFER_SIZE))
+        if not chunk:
+            break
+        digest.update(chunk)
+        remaining -= len(chunk)
+    fileobj.seek(position)
+    return digest.hexdigest()
+
+
+def read_index(zapp_path):
+    """Return the index of the zapp at `zapp_path`, decompressing only its
+    first member, or `None` if it has no index.
+    """
+    tar = tarfile.open(zapp_path, 'r|gz')
+    try:
+        info = tar.next()
+        if info is None or info.name != INDEX_MEMBER:
+            return None
+        return json.loads(tar.extractfile(info).read().decode('utf-8'))
+    finally:
+        tar.close()
+
+
+class ZappStream(object):
+    """Read-only file object of the decompressed zapp at `zapp_path`, whose
+    index is `index` (see :func:`read_index`), keeping the content of the
+    members given to :meth:`want` as it reads past them.
+
+    It can stand for a :class:`tarfile.TarFile` opened on the zapp to
+    :meth:`getnames` and :meth:`extractfile` the members kept, so the zapp
+    is decompressed once to stream it somewhere and read some members. A
+    member wanted after its content was read is extracted with
+    :mod:`tarfile`, which decompresses the zapp again.
+    """
+
+    def __init__(self, zapp_path, index):
+        self.zapp_path = zapp_path
+        self._file = gzip.open(zapp_path)
+        self._offset = 0
+        # the data being read, from _chunk_start (what is before is gone)
+        self._chunk = b''
+        self._chunk_start = 0
+        self._members = dict((member['name'], member)
+                             for member in index['members'])
+        self._names = [member['name'] for member in index['members']]
+        # [member, chunks, callbacks] of the wanted members, by data name
+        self._wanted = {}
+        # data name -> content
+        self._content = {}
+        # name -> data name, for the hard links
+        self._data_names = {}
+        self._tar = None
+        self.closed = False
+
+    def want(self, name, callback=None):
+        """Keep the content of the member `name` and call `callback`, if
+        given, with it once it is read.
+        """
+        member = self._members[name]
+        while member['type'] == 'link':
+            member = self._members[member['linkname']]
+        data_name = self._data_names[name] = member['name']
+        if data_name in self._content:
+            if callback is not None:
+                callback(self._content[data_name])
+        elif member['offset_data'] < self._chunk_start:
+            # too late, see extractfile
+            if callback is not None:
+                callback(self.extractfile(name).read())
+        else:
+            wanted = self._wanted.setdefault(data_name, [member, [], []])
+            if callback is not None:
+                wanted[2].append(callback)
+            if member['size'] == 0:
+                self._keep(data_name)
+
+    def read(self, size=-1):
+        data = self._file.read(size)
+        self._chunk = data
+        self._chunk_start = self._offset
+        self._offset += len(data)
+        # the callbacks may want members further in the data
+        done = set()
+        while True:
+            pending = [name for name in self._wanted if name not in done]
+            if not pending:
+                break
+            for data_name in pending:
+                done.add(data_name)
+                self._capture(data_name)
+        self._chunk = b''
+        self._chunk_start = self._offset
+        return data
+
+    def _capture(self, data_name):
+        member, chunks, _callbacks = self._wanted[data_name]
+        start = self._chunk_start
+        member_end = member['offset_data'] + member['size']
+        begin = max(start, member['offset_data'])
+        end = min(self._offset, member_end)
+        if begin < end:
+            chunks.append(self._chunk[begin - start:end - start])
+        if self._offset >= member_end:
+            self._keep(data_name)
+
+    def _keep(self, data_name):
+        _member, chunks, callbacks = self._wanted.pop(data_name)
+        content = self._content[data_name] = b''.join(chunks)
+        for callback in callbacks:
+            callback(content)
+
+    def drain(self):
+        """Read the rest of the zapp."""
+        while self.read(_BUFFER_SIZE):
+            pass
+
+    def getnames(self):
+        return list(self._names)
+
+    def extractfile(self, name):
+        """Return a file object of the content of the member `name`, kept
+        if it was wanted and read, or extracted with :mod:`tarfile`. Raises
+        `KeyError` if there is no such member.
+        """
+        if name not in self._members:
+            raise KeyError(name)
+        data_name = self._data_names.get(name)
+        if data_name in self._content:
+            return io.BytesIO(self._content[data_name])
+        if self._tar is None:
+            LOG.debug('reading %s again for %s', self.zapp_path, name)
+            self._tar = tarfile.open(self.zapp_path, 'r:gz')
+        return self._tar.extractfile(name)
+
+    def close(self):
+        self._file.close()
+        if self._tar is not None:
+            self._tar.close()
+        self.closed = True
+
+
+def write_zapp(zapp_path, tar, body_path):
+    """Write the zapp at `zapp_path`: the index of `tar`, closed, followed
+    by the compressed tar stream it wrote to `body_path`.
+
+    The zapp is written next to `zapp_path` and renamed, so a complete zapp
+    is always found at `zapp_path`.
+    """
+    partial = zapp_path + _PARTIAL_SUFFIX
+    with open(partial, 'wb') as zapp_file:
+        zapp_file.write(pgzip.compress_member(tar.index_member()))
+        with open(body_path, 'rb') as body:
+            for chunk in iter(lambda: body.read(_BUFFER_SIZE), b''):
+                zapp_file.write(chunk)
+    os.rename(partial, zapp_path)
+
+
+def normalize_tarinfo(tarinfo):
+    """Drop the metadata of `tarinfo` which depends on the build machine."""
+    tarinfo.uid = tarinfo.gid = 0
+    tarinfo.uname = tarinfo.gname = ''
+    tarinfo.mtime = MTIME
+    if tarinfo.isdir() or tarinfo.mode & 0o111:
+        tarinfo.mode = 0o755
+    else:
+        tarinfo.mode = 0o644
+    return tarinfo
+
+
+class BundleCache(object):
+    """
+    :param cache_dir:
+        Directory holding the cached members, created if needed.
+    """
+
+    def __init__(self, cache_dir):
+        self.cache_dir = cache_dir
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        # path -> [size, mtime, inode, ctime, content digest], to avoid
+        # hashing files which did not change
+        self.files = {}
+        try:
+            with open(os.path.join(cache_dir, _INDEX)) as fp:
+                self.files = json.load(fp)['files']
+        except (IOError, OSError, ValueError, KeyError):
+            pass
+        self.used = set()
+        # entries of this bundle which are not complete yet
+        self.writing = set()
+        self.hits = 0
+        self.misses = 0
+
+    def content_digest(self, fileobj, size):
+        """:func:`file_digest`, memoized by file size, mtime, inode and ctime.
+
+        Like git does for its index, a file modified within
+        :attr:`_MTIME_GRANULARITY` of the hashing is not memoized: it could
+        be modified again without any of them changing.
+        """
+        name = getattr(fileobj, 'name', None)
+        key = None
+        if isinstance(name, str) and os.path.isfile(name):
+            name = os.path.abspath(name)
+            stat = os.fstat(fileobj.fileno())
+            key = [stat.st_size, stat.st_mtime, stat.st_ino, stat.st_ctime]
+            known = self.files.get(name)
+            if known and known[:-1] == key:
+                return known[-1]
+            if stat.st_mtime >= time.time() - _MTIME_GRANULARITY:
+                key = None
+        digest = file_digest(fileobj, size)
+        if key is not None:
+            self.files[name] = key + [digest]
+        return digest
+
+    def entry_path(self, header, digest):
+        key = hashlib.sha1(header + digest.encode('ascii')).hexdigest()
+        self.used.add(key)
+        return os.path.join(self.cache_dir, key + _ENTRY_SUFFIX)
+
+    def save(self):
+        """Write the index and drop the members not used by this bundle."""
+        for name in os.listdir(self.cache_dir):
+            key, ext = os.path.splitext(name)
+            if ext == _PARTIAL_SUFFIX or (ext == _ENTRY_SUFFIX
+                                          and key not in self.used):
+                os.unlink(os.path.join(self.cache_dir, name))
+        files = dict((path, info) for path, info in self.files.items()
+                     if os.path.exists(path))
+        with open(os.path.join(self.cache_dir, _INDEX), 'w') as fp:
+            json.dump({'files': files}, fp)
+        LOG.info('bundle cache: %d members reused, %d compressed',
+                 self.hits, self.misses)
+
+
+class BundleTarFile(tarfile.TarFile):
+    """A :class:`tarfile.TarFile` writing reproducible zapps.
+
+    When writing to a :class:`zpmlib.pgzip.GzipWriter` with a
+    :class:`BundleCache`, the compressed members of unchanged files are taken
+    from the cache. Open it with ``BundleTarFile.open(fileobj=writer,
+    mode='w', cache=cache)``, and put :meth:`index_member` in front of what
+    it wrote once it is closed.
+    """
+
+    def __init__(self, *args, **kwargs):
+        self.cache = kwargs.pop('cache', None)
+        #: optional :class:`zpmlib.bundlestats.BundleStats`
+        self.stats = kwargs.pop('stats', None)
+        self.digest = hashlib.sha1()
+        #: (path, arcname) of the regular files added from the file system
+        self.sources = []
+        # (content digest, mode) -> name of the first member with it
+        self._contents = {}
+        # entries of the index, with the offsets in what this tar writes
+        self._index = []
+        tarfile.TarFile.__init__(self, *args, **kwargs)
+
+    def add(self, name, arcname=None, recursive=True):
+        # the same order everywhere, whatever os.listdir returns
+        if arcname is None:
+            arcname = name
+        tarfile.TarFile.add(self, name, arcname, recursive=False)
+        if os.path.isfile(name) and not os.path.islink(name):
+            self.sources.append((name, arcname.lstrip('/')))
+        if recursive and os.path.isdir(name) and not os.path.islink(name):
+            for entry in sorted(os.listdir(name)):
+                self.add(os.path.join(name, entry),
+                         os.path.join(arcname, entry), recursive)
+
+    def index_member(self):
+        """Return the :attr:`INDEX_MEMBER` of the members added, as the bytes
+        of a tar member to write before them.
+        """
+        digest = self.digest.hexdigest()
+        # the offsets in the zapp depend on the size of the index: grow it
+        # until they fit
+        shift = 0
+        while True:
+            members = []
+            for entry in self._index:
+                entry = dict(entry)
+                entry['offset'] += shift
+                entry['offset_data'] += shift
+                members.append(entry)
+            data = json.dumps({'digest': digest, 'members': members},
+                              sort_keys=True).encode('ascii')
+            info = normalize_tarinfo(tarfile.TarInfo(name=INDEX_MEMBER))
+            info.size = len(data)
+            header = info.tobuf(self.format, self.encoding, self.errors)
+            padding = -len(data) % tarfile.BLOCKSIZE
+            member = header + data + tarfile.NUL * padding
+            if len(member) == shift:
+                return member
+            shift = len(member)
+
+    def addfile(self, tarinfo, fileobj=None):
+        if self.stats is None:
+            return self._addfile(tarinfo, fileobj)
+        start = self.offset
+        with self.stats.timer('add'):
+            self._addfile(tarinfo, fileobj)
+        # as written: a later copy of some content is a link, of size 0
+        entry = self._index[-1]
+        self.stats.add_member(entry['name'], entry['size'], start,
+                              self.offset)
+
+    def _addfile(self, tarinfo, fileobj=None):
+        self._check('aw')
+        tarinfo = normalize_tarinfo(copy.copy(tarinfo))
+        content_digest = ''
+        if fileobj is not None:
+            if self.cache is not None:
+                content_digest = self.cache.content_digest(fileobj,
+                                                           tarinfo.size)
+            else:
+                content_digest = file_digest(fileobj, tarinfo.size)
+
+        if tarinfo.isreg() and tarinfo.size > 0 and fileobj is not None:
+            # later copies of the same content are stored as hard links to
+            # the first one
+            key = (content_digest, tarinfo.mode)
+            first = self._contents.setdefault(key, tarinfo.name)
+            if first != tarinfo.name:
+                tarinfo.type = tarfile.LNKTYPE
+                tarinfo.linkname = first
+                tarinfo.size = 0
+                header = tarinfo.tobuf(self.format, self.encoding,
+                                       self.errors)
+                self._add_to_index(tarinfo, header, content_digest)
+                self.digest.update(header)
+                return tarfile.TarFile.addfile(self, tarinfo)
+
+        header = tarinfo.tobuf(self.format, self.encoding, self.errors)
+        self._add_to_index(tarinfo, header, content_digest)
+        self.digest.update(header + content_digest.encode('ascii'))
+
+        if (self.cache is None or fileobj is None
+                or not isinstance(self.fileobj, pgzip.GzipWriter)
+                or tarinfo.size < MIN_CACHED_SIZE):
+            return tarfile.TarFile.addfile(self, tarinfo, fileobj)
+
+        blocks = -(-tarinfo.size // tarfile.BLOCKSIZE)
+        size = len(header) + blocks * tarfile.BLOCKSIZE
+        entry = self.cache.entry_path(header, content_digest)
+
+        if entry in self.cache.writing:
+            # same content earlier in this bundle, still being compressed
+            return tarfile.TarFile.addfile(self, tarinfo, fileobj)
+        if os.path.isfile(entry):
+            self.cache.hits += 1
+            self.fileobj.write_members(entry, size)
+            self.offset += size
+            self.members.append(tarinfo)
+            return
+
+        self.cache.misses += 1
+        self.cache.writing.add(entry)
+        writer = self.fileobj
+        writer.segment()
+        partial = entry + _PARTIAL_SUFFIX
+        cache_fp = open(partial, 'wb')
+        writer.tee = cache_fp
+        try:
+            tarfile.TarFile.addfile(self, tarinfo, fileobj)
+        finally:
+            writer.segment()
+            writer.tee = None
+
+        def finish():
+            cache_fp.close()
+            os.rename(partial, entry)
+            self.cache.writing.discard(entry)
+        writer.on_output(finish)
+
+    def _add_to_index(self, tarinfo, header, content_digest):
+        entry = {
+            'name': tarinfo.name,
+            'type': _MEMBER_TYPES.get(tarinfo.type,
+                                      tarinfo.type.decode('ascii')),
+            'offset': self.offset,
+            'offset_data': self.offset + len(header),
+            'size': tarinfo.size,
+        }
+        if content_digest:
+            entry['sha1'] = content_digest
+        if tarinfo.islnk() or tarinfo.issym():
+            entry['linkname'] = tarinfo.linkname
+        self._index.append(entry)
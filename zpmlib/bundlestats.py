@@ -0,0 +1,225 @@
+#  Copyright 2014 Rackspace, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""
+Composition and timing of a bundle (``zpm bundle --stats``).
+
+The members are recorded by :class:`zpmlib.bundlecache.BundleTarFile` with
+their offsets in the (uncompressed) tar stream, and the gzip members by
+:class:`zpmlib.pgzip.GzipWriter` with the range of the stream they hold. The
+compressed size of a zapp member is the share of the gzip members it spans
+in proportion to its bytes.
+"""
+
+import collections
+import contextlib
+import time
+
+import prettytable
+
+#: Directory of the bundled Python dependencies
+SITE_PACKAGES = 'lib/python2.7/site-packages/'
+
+#: Phases timed while bundling, in the order they happen. The time of a
+#: phase excludes that of the phases nested in it (the files added while
+#: compiling, the waits for the compression threads while adding), but the
+#: compression runs in threads, alongside the other phases.
+PHASES = [
+    ('glob', 'Expanding the bundling patterns'),
+    ('deps', 'Installing the dependencies with tox'),
+    ('shake', 'Finding the imported modules'),
+    ('add', 'Adding files to the zapp'),
+    ('compile', 'Compiling bytecode'),
+    ('write', 'Waiting for the compression threads'),
+    ('compress', 'Compressing (CPU time, all threads)'),
+]
+
+
+class BundleStats(object):
+
+    def __init__(self):
+        #: phase -> seconds
+        self.timings = collections.defaultdict(float)
+        # seconds spent in the timers nested in each running timer
+        self._nested = []
+        # [name, size, start, end] of the zapp members
+        self._members = []
+        # (start, size, compressed size) of the gzip members
+        self._blocks = []
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+        """Add the time spent in the block to `phase`, less the time spent
+        in the timers nested in it. The time of a `None` phase is only taken
+        off the enclosing timer.
+        """
+        start = time.time()
+        self._nested.append(0.0)
+        try:
+            yield
+        finally:
+            elapsed = time.time() - start
+            nested = self._nested.pop()
+            if phase is not None:
+                self.timings[phase] += elapsed - nested
+            if self._nested:
+                self._nested[-1] += elapsed
+
+    def add_member(self, name, size, start, end):
+        """Record a zapp member of `size` bytes, taking the bytes from
+        `start` to `end` of the tar stream (with its header and padding).
+        """
+        self._members.append([name, size, start, end])
+
+    def add_block(self, start, size, compressed_size, seconds=0.0):
+        """Record a gzip member holding `size` bytes of the tar stream from
+        `start`, compressed in `seconds`.
+        """
+        self._blocks.append((start, size, compressed_size))
+        self.timings['compress'] += seconds
+
+    def members(self):
+        """Return the ``(name, size, compressed size)`` of the members,
+        biggest compressed first.
+
+        >>> stats = BundleStats()
+        >>> stats.add_member('a', 512, 0, 1024)
+        >>> stats.add_member('b', 3000, 1024, 4608)
+        >>> stats.add_block(0, 2048, 100)
+        >>> stats.add_block(2048, 2560, 40)
+        >>> stats.members()
+        [('b', 3000, 90), ('a', 512, 50)]
+        """
+        blocks = sorted(self._blocks)
+        result = []
+        index = 0
+        for name, size, start, end in sorted(self._members,
+                                             key=lambda m: m[2]):
+            compressed = 0.0
+            while (index < len(blocks)
+                   and blocks[index][0] + blocks[index][1] <= start):
+                index += 1
+            i = index
+            while i < len(blocks) and blocks[i][0] < end:
+                block_start, block_size, block_compressed = blocks[i]
+                overlap = (min(end, block_start + block_size)
+                           - max(start, block_start))
+                if overlap > 0:
+                    compressed += (block_compressed * overlap
+                                   / float(block_size))
+                i += 1
+            result.append((name, size, int(round(compressed))))
+        result.sort(key=lambda member: (-member[2], member[0]))
+        return result
+
+    def groups(self, members=None):
+        """Return the sizes of the members grouped by top-level directory
+        and by Python dependency, as two lists of ``(name, count, size,
+        compressed size)``, biggest compressed first.
+        """
+        if members is None:
+            members = self.members()
+        directories = collections.defaultdict(lambda: [0, 0, 0])
+        dependencies = collections.defaultdict(lambda: [0, 0, 0])
+        top_dirs = set(name.split('/')[0] for name, _size, _compressed
+                       in members if '/' in name)
+        for name, size, compressed in members:
+            if name.startswith(SITE_PACKAGES):
+                dep = name[len(SITE_PACKAGES):].split('/')[0]
+                if dep.endswith('.py'):
+                    dep = dep[:-3]
+                _count(dependencies[dep], size, compressed)
+            top = name.split('/')[0]
+            if top in top_dirs:
+                directory = top + '/'
+            else:
+                directory = './'
+            _count(directories[directory], size, compressed)
+        return _sorted_groups(directories), _sorted_groups(dependencies)
+
+    def as_dict(self):
+        """Return the stats as a JSON serializable `dict`."""
+        members = self.members()
+        directories, dependencies = self.groups(members)
+        keys = ('name', 'count', 'size', 'compressed_size')
+        return {
+            'size': sum(member[1] for member in members),
+            'compressed_size': sum(member[2] for member in members),
+            'timings': dict(self.timings),
+            'members': [dict(zip(('name', 'size', 'compressed_size'), member))
+                        for member in members],
+            'directories': [dict(zip(keys, group)) for group in directories],
+            'dependencies': [dict(zip(keys, group))
+                             for group in dependencies],
+        }
+
+    def report(self, top=10):
+        """Return the timings and the `top` members, directories and
+        dependencies as text tables.
+        """
+        members = self.members()
+        directories, dependencies = self.groups(members)
+        lines = []
+
+        table = prettytable.PrettyTable(['Phase', 'Time (s)'])
+        table.align['Phase'] = 'l'
+        timings = [(label, self.timings[phase]) for phase, label in PHASES
+                   if phase in self.timings]
+        for label, seconds in sorted(timings, key=lambda t: -t[1]):
+            table.add_row([label, '%.3f' % seconds])
+        lines.extend(['Timings (the compression overlaps the other phases):',
+                      str(table)])
+
+        for title, column, groups in (
+                ('Directories', 'Directory', directories),
+                ('Dependencies', 'Dependency', dependencies)):
+            if not groups:
+                continue
+            table = prettytable.PrettyTable(
+                [column, 'Files', 'Size', 'Compressed'])
+            table.align[column] = 'l'
+            for group in groups[:top]:
+                table.add_row(list(group))
+            lines.extend(['%s (top %d):' % (title, top), str(table)])
+
+        table = prettytable.PrettyTable(['Member', 'Size', 'Compressed'])
+        table.align['Member'] = 'l'
+        for member in members[:top]:
+            table.add_row(list(member))
+        lines.extend(['Members (top %d):' % top, str(table)])
+        lines.append('Total: %d members, %d bytes, %d compressed' % (
+            len(members), sum(member[1] for member in members),
+            sum(member[2] for member in members)))
+        return '\n'.join(lines)
+
+
+@contextlib.contextmanager
+def timer(stats, phase):
+    """:meth:`BundleStats.timer`, if `stats` is not None."""
+    if stats is None:
+        yield
+    else:
+        with stats.timer(phase):
+            yield
+
+
+def _count(group, size, compressed):
+    group[0] += 1
+    group[1] += size
+    group[2] += compressed
+
+
+def _sorted_groups(groups):
+    return sorted(((name,) + tuple(counts) for name, counts in groups.items()),
+                  key=lambda group: (-group[3], group[0]))
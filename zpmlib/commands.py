@@ -13,12 +13,15 @@
 #  limitations under the License.
 
 import functools
+import json
 import logging
 import os
 import operator
 import argparse
+import sys
 
 import zpmlib
+from zpmlib import bundlestats
 from zpmlib import zpm
 
 # List of function that will be the top-level zpm commands.
@@ -75,8 +78,11 @@ def command(func):
     """Register `func` as a top-level zpm command.
 
     The name of the function will be the name of the command and any
-    cmdline arguments registered with `arg` will be available.
+    cmdline arguments registered with `arg` will be available. Registering
+    a second command under the same name is an error.
     """
+    if any(cmd.__name__ == func.__name__ for cmd in _commands):
+        raise ValueError('command %r is already registered' % func.__name__)
     _commands.append(func)
     return func
 
@@ -230,14 +236,95 @@ def new(args):
 @arg('--refresh-deps', '-r',
      help='Refresh/re-download locally cached dependencies',
      action='store_true')
+@arg('--jobs', '-j', type=int,
+     help='Number of threads compressing the zapp (default: number of CPUs)')
+@arg('--compile', '-c', dest='compile_bytecode', action='store_true',
+     help='Also bundle the bytecode of the Python sources, compiled with'
+          ' python2.7')
+@arg('--shake', action='store_true',
+     help='Only bundle the modules of the dependencies imported by the'
+          ' entry scripts (and the dynamic_imports of zapp.yaml)')
+@arg('--layered', action='store_true',
+     help='Bundle the dependencies into a separate zapp, uploaded by'
+          ' "zpm deploy" only when they change')
+@arg('--stats', action='store_true',
+     help='Print the biggest members, directories and dependencies of the'
+          ' zapp, and the time spent in each bundling phase')
+@arg('--stats-file', metavar='FILE',
+     help='Write the bundle stats (all the members) to FILE as JSON')
+@arg('--all', '-a', nargs='?', const='.', metavar='DIR',
+     help='Bundle every project with a zapp.yaml under DIR (default: .),'
+          ' concurrently, and print a summary')
+@arg('--processes', '-p', type=int,
+     help='Number of projects bundled at once with --all'
+          ' (default: number of CPUs)')
+@arg('--watch', '-w', action='store_true',
+     help='Bundle again whenever zapp.yaml or a bundled file changes,'
+          ' until interrupted')
+@arg('--on-change', metavar='CMD',
+     help='With --watch, run the shell command CMD after each bundle,'
+          ' e.g. "zpm execute myapp.zapp"')
+@arg('--poll', action='store_true',
+     help='With --watch, poll the files instead of using inotify')
 def bundle(args):
     """Bundle a ZeroVM application
 
     This command creates a Zapp using the instructions in zapp.yaml.
     The file is read from the project root.
     """
+    if args.all is not None:
+        _bundle_all(args)
+        return
     root = zpm.find_project_root()
-    zpm.bundle_project(root, refresh_deps=args.refresh_deps)
+    if args.watch:
+        _bundle_watch(root, args)
+        return
+    if args.on_change or args.poll:
+        raise zpmlib.ZPMException('--on-change and --poll require --watch')
+    stats = None
+    if args.stats or args.stats_file:
+        stats = bundlestats.BundleStats()
+    zpm.bundle_project(root, refresh_deps=args.refresh_deps, jobs=args.jobs,
+                       compile_bytecode=args.compile_bytecode,
+                       shake=args.shake, stats=stats,
+                       layered=args.layered)
+    if args.stats:
+        print(stats.report())
+    if args.stats_file:
+        with open(args.stats_file, 'w') as fp:
+            json.dump(stats.as_dict(), fp, indent=2, sort_keys=True)
+
+
+def _bundle_watch(root, args):
+    if args.stats or args.stats_file:
+        raise zpmlib.ZPMException('--stats cannot be used with --watch')
+    try:
+        zpm.watch_project(root, on_change=args.on_change, poll=args.poll,
+                          refresh_deps=args.refresh_deps, jobs=args.jobs,
+                          compile_bytecode=args.compile_bytecode,
+                          shake=args.shake, layered=args.layered)
+    except KeyboardInterrupt:
+        print('stopped watching %s' % root)
+
+
+def _bundle_all(args):
+    if args.stats or args.stats_file:
+        raise zpmlib.ZPMException('--stats cannot be used with --all')
+    if args.watch:
+        raise zpmlib.ZPMException('--watch cannot be used with --all')
+    # the projects are bundled in parallel already, compress each of them
+    # with a single thread unless told otherwise
+    results = zpm.bundle_all(args.all, processes=args.processes,
+                             refresh_deps=args.refresh_deps,
+                             jobs=args.jobs or 1,
+                             compile_bytecode=args.compile_bytecode,
+                             shake=args.shake, layered=args.layered)
+    print(zpm._get_bundle_table(results))
+    failed = [result['project'] for result in results if 'error' in result]
+    if failed:
+        raise zpmlib.ZPMException('failed to bundle %d of %d projects: %s'
+                                  % (len(failed), len(results),
+                                     ', '.join(failed)))
 
 
 @command
@@ -288,6 +375,32 @@ def execute(args):
         print('Total time: %s' % total_time)
 
 
+@command
+@arg('zapp', help='A ZeroVM application')
+@arg('--swift-dir', default='.',
+     help='Local directory to map swift:// paths to')
+@arg('--zvapp', default='zvapp', help='The zvapp script to run the zapp with')
+@arg('--summary', '-s', action='store_true',
+     help='Show execution summary table')
+@with_logging
+def local(args):
+    """Run a ZeroVM application locally
+
+    This runs a zapp produced by "zpm bundle" on the local machine with
+    zvapp, without deploying it. Objects referred to with swift:// paths
+    in the zapp are read from and written to a local directory, one
+    subdirectory per container.
+    """
+    resp, output = zpm.run_local(args)
+    if args.summary:
+        total_time, exec_table = zpm._get_exec_table(resp)
+        print('Execution summary:')
+        print(exec_table)
+        print('Total time: %s' % total_time)
+    sys.stdout.flush()
+    getattr(sys.stdout, 'buffer', sys.stdout).write(output)
+
+
 @command
 @arg('command', nargs='?', help='A zpm command')
 def help(args):
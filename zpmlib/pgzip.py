@@ -0,0 +1,240 @@
+#  Copyright 2014 Rackspace, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""
+Parallel gzip compression.
+
+The data is cut into blocks which are compressed independently in a thread
+pool (``zlib`` releases the GIL while compressing) and written out in order,
+each block as a complete gzip member. A file made of several gzip members is
+still a valid gzip file: :mod:`gzip`, :mod:`tarfile` and ``gunzip`` read it as
+the concatenation of the members.
+"""
+
+import collections
+import multiprocessing
+import os
+import struct
+import time
+import zlib
+from multiprocessing.pool import ThreadPool
+
+from zpmlib import bundlestats
+
+#: Uncompressed size of the blocks compressed independently
+BLOCK_SIZE = 1024 * 1024
+
+_GZIP_HEADER = (
+    b'\x1f\x8b'  # magic
+    b'\x08'  # deflate
+    b'\x00'  # flags
+    b'\x00\x00\x00\x00'  # mtime, left unset
+    b'\x00'  # extra flags
+    b'\xff'  # OS: unknown
+)
+
+
+def compress_member(data, level=9):
+    """Compress `data` into a complete gzip member.
+
+    >>> import gzip, io
+    >>> member = compress_member(b'hello')
+    >>> gzip.GzipFile(fileobj=io.BytesIO(member * 2)).read() == b'hellohello'
+    True
+    """
+    compressor = zlib.compressobj(level, zlib.DEFLATED, -zlib.MAX_WBITS)
+    body = compressor.compress(data) + compressor.flush()
+    trailer = struct.pack('<II', zlib.crc32(data) & 0xffffffff,
+                          len(data) & 0xffffffff)
+    return _GZIP_HEADER + body + trailer
+
+
+def _timed_compress_member(data, level):
+    start = time.time()
+    member = compress_member(data, level)
+    return member, time.time() - start
+
+
+class GzipWriter(object):
+    """Write-only file object compressing what is written to it into
+    `fileobj`, using `jobs` threads.
+
+    It can be used as the ``fileobj`` of a :class:`tarfile.TarFile` opened
+    in ``'w'`` mode.
+
+    :param fileobj:
+        File object the compressed data is written to. It is not closed by
+        :meth:`close`.
+    :param int jobs:
+        Number of compression threads. Defaults to the number of CPUs; with
+        1, the blocks are compressed in the calling thread.
+    :param stats:
+        Optional :class:`zpmlib.bundlestats.BundleStats` recording the
+        gzip members written.
+    """
+
+    def __init__(self, fileobj, jobs=None, level=9, block_size=BLOCK_SIZE,
+                 stats=None):
+        self.fileobj = fileobj
+        self.stats = stats
+        self.level = level
+        self.block_size = block_size
+        if jobs is None:
+            jobs = multiprocessing.cpu_count()
+        self.jobs = max(jobs, 1)
+        self._pool = None
+        if self.jobs > 1:
+            self._pool = ThreadPool(self.jobs)
+        #: if set, the compressed output of what is written is also written
+        #: to this file object (see :meth:`segment`)
+        self.tee = None
+        # actions writing out the compressed blocks, in order
+        self._pending = collections.deque()
+        self._buffer = []
+        self._buffered = 0
+        self._offset = 0
+        # uncompressed bytes handed to compression (or copied) so far
+        self._submitted = 0
+        self.closed = False
+
+    def write(self, data):
+        if self.closed:
+            raise ValueError('write to closed file')
+        self._buffer.append(data)
+        self._buffered += len(data)
+        self._offset += len(data)
+        if self._buffered >= self.block_size:
+            data = b''.join(self._buffer)
+            for start in range(0, len(data) - self.block_size + 1,
+                               self.block_size):
+                self._submit(data[start:start + self.block_size])
+            rest = data[len(data) - len(data) % self.block_size:]
+            self._buffer = [rest] if rest else []
+            self._buffered = len(rest)
+
+    def tell(self):
+        """Return the number of (uncompressed) bytes written so far."""
+        return self._offset
+
+    def segment(self):
+        """End the current gzip member.
+
+        The data written after this call starts a new member, so the
+        compressed output of the data written between two calls (copied to
+        :attr:`tee`, if set) is a standalone gzip file.
+        """
+        if self._buffered:
+            self._submit(b''.join(self._buffer))
+            self._buffer = []
+            self._buffered = 0
+
+    def write_members(self, path, size):
+        """Copy the gzip members in the file at `path` to the output as they
+        are, `size` being their uncompressed size.
+        """
+        if self.closed:
+            raise ValueError('write to closed file')
+        self.segment()
+        self._offset += size
+        start = self._submitted
+        self._submitted += size
+
+        def copy():
+            with open(path, 'rb') as fp:
+                for chunk in iter(lambda: fp.read(self.block_size), b''):
+                    self._output(chunk, None)
+            if self.stats is not None:
+                self.stats.add_block(start, size, os.path.getsize(path))
+        self._enqueue(copy)
+
+    def on_output(self, func):
+        """Call `func` once the data written so far has been output."""
+        self.segment()
+        self._enqueue(func)
+
+    def _submit(self, block):
+        tee = self.tee
+        start = self._submitted
+        size = len(block)
+        self._submitted += size
+
+        def output(result):
+            member, seconds = result
+            if self.stats is not None:
+                self.stats.add_block(start, size, len(member), seconds)
+            self._output(member, tee)
+
+        if self._pool is None:
+            # not part of the phase writing: it is timed as 'compress'
+            with bundlestats.timer(self.stats, None):
+                output(_timed_compress_member(block, self.level))
+            return
+        result = self._pool.apply_async(_timed_compress_member,
+                                        (block, self.level))
+        self._enqueue(lambda: output(result.get()))
+
+    def _enqueue(self, action):
+        if self._pool is None:
+            action()
+            return
+        self._pending.append(action)
+        # keep a couple of blocks per thread in flight, bounding the memory
+        if len(self._pending) > 2 * self.jobs:
+            with bundlestats.timer(self.stats, 'write'):
+                while len(self._pending) > 2 * self.jobs:
+                    self._pending.popleft()()
+
+    def _output(self, data, tee):
+        self.fileobj.write(data)
+        if tee is not None:
+            tee.write(data)
+
+    def flush(self):
+        self.segment()
+        if self._pending:
+            with bundlestats.timer(self.stats, 'write'):
+                while self._pending:
+                    self._pending.popleft()()
+        self.fileobj.flush()
+
+    def close(self):
+        if self.closed:
+            return
+        try:
+            if not self._offset:
+                # an empty gzip file still has one (empty) member
+                self._output(compress_member(b'', self.level), None)
+            self.flush()
+        finally:
+            self.closed = True
+            if self._pool is not None:
+                self._pool.close()
+                self._pool.join()
+
+    def abort(self):
+        """Stop compressing after a failure, without writing out what is
+        pending. `fileobj` is left as is.
+        """
+        self.closed = True
+        if self._pool is not None:
+            self._pool.terminate()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, _traceback):
+        if exc_type is None:
+            self.close()
+        else:
+            self.abort()
@@ -20,6 +20,7 @@ Main help text is shown when no command is given:
       execute   Remotely execute a ZeroVM application.
       help      Show this help
       new       Create template zapp.yaml file
+      run       Run a ZeroVM application locally
       version   Show the version number
   
   See 'zpm <command> --help' for more information on a specific command.
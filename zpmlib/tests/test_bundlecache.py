@@ -0,0 +1,263 @@
+#  Copyright 2014 Rackspace, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import gzip
+import os
+import shutil
+import tarfile
+import tempfile
+import time
+
+import mock
+import pytest
+
+from zpmlib import bundlecache
+from zpmlib import pgzip
+
+
+class TestBundleCache:
+
+    def setup_method(self, _method):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache = bundlecache.BundleCache(
+            os.path.join(self.temp_dir, 'cache'))
+        self.path = os.path.join(self.temp_dir, 'a.dat')
+        self.write(b'one')
+
+    def teardown_method(self, _method):
+        shutil.rmtree(self.temp_dir)
+
+    def write(self, data, mtime=None):
+        with open(self.path, 'wb') as fp:
+            fp.write(data)
+        if mtime is None:
+            # out of the racy window
+            mtime = time.time() - 60
+        os.utime(self.path, (mtime, mtime))
+
+    def digest(self):
+        with open(self.path, 'rb') as fp:
+            with mock.patch('zpmlib.bundlecache.file_digest',
+                            wraps=bundlecache.file_digest) as file_digest:
+                digest = self.cache.content_digest(fp, 3)
+        return digest, file_digest.called
+
+    def test_memoized(self):
+        digest, hashed = self.digest()
+        assert hashed
+        assert self.digest() == (digest, False)
+
+    def test_changed_same_mtime(self):
+        # ctime moves, even when the mtime is set back
+        stat = os.stat(self.path)
+        self.digest()
+        time.sleep(0.01)
+        self.write(b'two', stat.st_mtime)
+        if os.stat(self.path).st_ctime == stat.st_ctime:
+            pytest.skip('ctime resolution too coarse')
+        digest, hashed = self.digest()
+        assert hashed
+        with open(self.path, 'rb') as fp:
+            assert digest == bundlecache.file_digest(fp, 3)
+
+    def test_replaced(self):
+        stat = os.stat(self.path)
+        self.digest()
+        os.rename(self.path, self.path + '.old')
+        self.write(b'two', stat.st_mtime)
+        digest, hashed = self.digest()
+        assert hashed
+        with open(self.path, 'rb') as fp:
+            assert digest == bundlecache.file_digest(fp, 3)
+
+    def test_racy(self):
+        self.write(b'one', time.time())
+        assert self.digest()[1]
+        assert self.digest()[1]
+
+
+class TestBundleTarFile:
+
+    def setup_method(self, _method):
+        self.temp_dir = tempfile.mkdtemp()
+        self.cache_dir = os.path.join(self.temp_dir, 'cache')
+        self.big = os.path.join(self.temp_dir, 'big.dat')
+        self.small = os.path.join(self.temp_dir, 'small.py')
+        with open(self.big, 'wb') as fp:
+            fp.write(os.urandom(bundlecache.MIN_CACHED_SIZE * 3))
+        with open(self.small, 'w') as fp:
+            fp.write('print("hello")\n')
+        self.zapp = os.path.join(self.temp_dir, 'test.zapp')
+
+    def teardown_method(self, _method):
+        shutil.rmtree(self.temp_dir)
+
+    def bundle(self, names, jobs=2):
+        cache = bundlecache.BundleCache(self.cache_dir)
+        with open(self.zapp, 'wb') as fp:
+            gz = pgzip.GzipWriter(fp, jobs=jobs, block_size=4096)
+            tar = bundlecache.BundleTarFile.open(fileobj=gz, mode='w',
+                                                 cache=cache)
+            for name in names:
+                tar.add(os.path.join(self.temp_dir, name), arcname=name)
+            tar.close()
+            gz.close()
+        cache.save()
+        return cache
+
+    def check_zapp(self, names):
+        tar = tarfile.open(self.zapp)
+        assert tar.getnames() == names
+        for name in names:
+            if name == bundlecache.INDEX_MEMBER:
+                continue
+            with open(os.path.join(self.temp_dir, name), 'rb') as fp:
+                assert tar.extractfile(name).read() == fp.read()
+
+    def test_reuse(self):
+        cache = self.bundle(['small.py', 'big.dat'])
+        assert (cache.hits, cache.misses) == (0, 1)
+        self.check_zapp(['small.py', 'big.dat'])
+
+        with open(self.small, 'a') as fp:
+            fp.write('print("again")\n')
+        cache = self.bundle(['small.py', 'big.dat'])
+        assert (cache.hits, cache.misses) == (1, 0)
+        self.check_zapp(['small.py', 'big.dat'])
+
+    def test_changed_file(self):
+        self.bundle(['big.dat'])
+        with open(self.big, 'r+b') as fp:
+            fp.write(b'changed')
+        os.utime(self.big, (1, 1))
+        cache = self.bundle(['big.dat'], jobs=1)
+        assert (cache.hits, cache.misses) == (0, 1)
+        self.check_zapp(['big.dat'])
+        # only the member of the current content is kept
+        entries = [name for name in os.listdir(self.cache_dir)
+                   if name.endswith('.gz')]
+        assert len(entries) == 1
+
+    def test_same_content_twice(self):
+        cache = self.bundle(['big.dat', 'big.dat'])
+        assert (cache.hits, cache.misses) == (0, 1)
+        self.check_zapp(['big.dat', 'big.dat'])
+
+    def test_duplicate_content(self):
+        copy = os.path.join(self.temp_dir, 'copy.dat')
+        script = os.path.join(self.temp_dir, 'script.py')
+        shutil.copy(self.big, copy)
+        shutil.copy(self.small, script)
+        os.chmod(script, 0o755)
+        self.bundle(['big.dat', 'small.py', 'copy.dat', 'script.py'])
+        self.check_zapp(['big.dat', 'small.py', 'copy.dat', 'script.py'])
+
+        tar = tarfile.open(self.zapp)
+        members = tar.getmembers()
+        # the copy is a hard link, the script differs by its mode
+        assert [m.islnk() for m in members] == [False, False, True, False]
+        assert members[2].linkname == 'big.dat'
+        assert os.path.getsize(self.zapp) < os.path.getsize(self.big) * 1.1
+
+    def test_index(self):
+        body = os.path.join(self.temp_dir, 'test.body')
+        copy = os.path.join(self.temp_dir, 'copy.dat')
+        shutil.copy(self.big, copy)
+        with open(body, 'wb') as fp:
+            gz = pgzip.GzipWriter(fp, jobs=1)
+            tar = bundlecache.BundleTarFile.open(fileobj=gz, mode='w')
+            tar.add(self.small, arcname='small.py')
+            tar.add(self.big, arcname='big.dat')
+            tar.add(copy, arcname='copy.dat')
+            tar.close()
+            gz.close()
+        bundlecache.write_zapp(self.zapp, tar, body)
+        self.check_zapp(['boot/zapp.index', 'small.py', 'big.dat',
+                         'copy.dat'])
+
+        index = bundlecache.read_index(self.zapp)
+        assert index['digest'] == tar.digest.hexdigest()
+        members = tarfile.open(self.zapp).getmembers()[1:]
+        assert [(m.name, m.offset, m.offset_data, m.size) for m in members] \
+            == [(e['name'], e['offset'], e['offset_data'], e['size'])
+                for e in index['members']]
+        assert [e['type'] for e in index['members']] == ['file', 'file',
+                                                         'link']
+        with open(self.big, 'rb') as fp:
+            assert index['members'][1]['sha1'] == \
+                bundlecache.file_digest(fp, bundlecache.MIN_CACHED_SIZE * 3)
+        assert index['members'][2]['linkname'] == 'big.dat'
+
+    def test_read_index_missing(self):
+        self.bundle(['small.py'])
+        assert bundlecache.read_index(self.zapp) is None
+
+
+class TestZappStream:
+
+    def setup_method(self, _method):
+        self.temp_dir = tempfile.mkdtemp()
+        self.zapp = os.path.join(self.temp_dir, 'test.zapp')
+        self.files = {
+            'a.txt': b'a' * 1000,
+            'b.dat': os.urandom(20000),
+            'c.txt': b'c',
+            'copy.dat': None,
+        }
+        self.files['copy.dat'] = self.files['b.dat']
+        body = os.path.join(self.temp_dir, 'test.body')
+        with open(body, 'wb') as fp:
+            gz = pgzip.GzipWriter(fp, jobs=1)
+            tar = bundlecache.BundleTarFile.open(fileobj=gz, mode='w')
+            for name in sorted(self.files):
+                path = os.path.join(self.temp_dir, name)
+                with open(path, 'wb') as data:
+                    data.write(self.files[name])
+                tar.add(path, arcname=name)
+            tar.close()
+            gz.close()
+        bundlecache.write_zapp(self.zapp, tar, body)
+        self.stream = bundlecache.ZappStream(
+            self.zapp, bundlecache.read_index(self.zapp))
+
+    def teardown_method(self, _method):
+        self.stream.close()
+        shutil.rmtree(self.temp_dir)
+
+    def test_read(self):
+        read = []
+        self.stream.want('c.txt', read.append)
+        self.stream.want('copy.dat')
+        chunks = []
+        for chunk in iter(lambda: self.stream.read(100), b''):
+            chunks.append(chunk)
+        assert read == [b'c']
+        with open(self.zapp, 'rb') as fp:
+            assert b''.join(chunks) == gzip.GzipFile(fileobj=fp).read()
+        assert self.stream.getnames() == ['a.txt', 'b.dat', 'c.txt',
+                                          'copy.dat']
+        with mock.patch('tarfile.open') as tar_open:
+            assert self.stream.extractfile('c.txt').read() == b'c'
+            assert self.stream.extractfile('copy.dat').read() == \
+                self.files['b.dat']
+        # not read again
+        assert tar_open.call_count == 0
+
+    def test_want_too_late(self):
+        self.stream.drain()
+        read = []
+        self.stream.want('a.txt', read.append)
+        assert read == [self.files['a.txt']]
+        with pytest.raises(KeyError):
+            self.stream.extractfile('missing')
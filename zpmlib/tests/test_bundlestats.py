@@ -0,0 +1,140 @@
+#  Copyright 2014 Rackspace, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import io
+import json
+import mock
+import os
+import shutil
+import tempfile
+import time
+
+import yaml
+
+from zpmlib import bundlestats
+from zpmlib import pgzip
+from zpmlib import zpm
+
+
+class TestBundleStats:
+
+    def test_groups(self):
+        stats = bundlestats.BundleStats()
+        names = ['zapp.yaml', 'src', 'src/a.py',
+                 'lib/python2.7/site-packages/dep1',
+                 'lib/python2.7/site-packages/dep1/__init__.py',
+                 'lib/python2.7/site-packages/dep2.py']
+        for i, name in enumerate(names):
+            stats.add_member(name, 100 * i, 1024 * i, 1024 * (i + 1))
+        stats.add_block(0, 1024 * len(names), 60 * len(names))
+
+        directories, dependencies = stats.groups()
+        assert directories == [
+            ('lib/', 3, 1200, 180),
+            ('src/', 2, 300, 120),
+            ('./', 1, 0, 60),
+        ]
+        assert dependencies == [
+            ('dep1', 2, 700, 120),
+            ('dep2', 1, 500, 60),
+        ]
+
+    def test_timer(self):
+        stats = bundlestats.BundleStats()
+        times = [0.0, 1.0, 2.0, 5.0, 6.0, 7.0, 10.0, 12.0]
+        with mock.patch('time.time', side_effect=times):
+            with stats.timer('compile'):
+                with stats.timer('add'):
+                    with stats.timer('write'):
+                        pass
+                    with stats.timer(None):
+                        pass
+        # the nested phases are not counted twice
+        assert stats.timings == {'compile': 3.0, 'add': 5.0, 'write': 3.0}
+
+    def test_timer_compressing_inline(self):
+        stats = bundlestats.BundleStats()
+        gz = pgzip.GzipWriter(io.BytesIO(), jobs=1, block_size=1024,
+                              stats=stats)
+        with mock.patch('zpmlib.pgzip._timed_compress_member') as compress:
+            compress.side_effect = lambda data, level: (time.sleep(0.1)
+                                                        or (b'', 0.1))
+            with stats.timer('add'):
+                gz.write(b'x' * 4096)
+        assert compress.call_count == 4
+        assert abs(stats.timings['compress'] - 0.4) < 1e-9
+        # counted as 'compress' only
+        assert stats.timings['add'] < 0.1
+
+    def test_bundle_project(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            zpm.create_project(tempdir, template='python')
+            with open(os.path.join(tempdir, 'zapp.yaml')) as zapp_yaml:
+                zapp = yaml.safe_load(zapp_yaml)
+            os.mkdir(os.path.join(tempdir, 'data'))
+            with open(os.path.join(tempdir, 'data', 'big.bin'), 'wb') as fp:
+                fp.write(os.urandom(256 * 1024))
+            with open(os.path.join(tempdir, 'main.py'), 'w') as fp:
+                fp.write('print "hello"\n' * 1000)
+            zapp['bundling'].extend(['main.py', 'data'])
+            with open(os.path.join(tempdir, 'zapp.yaml'), 'w') as zapp_yaml:
+                zapp_yaml.write(yaml.dump(zapp))
+
+            stats = bundlestats.BundleStats()
+            zpm.bundle_project(tempdir, stats=stats)
+            result = json.loads(json.dumps(stats.as_dict()))
+
+            # biggest first
+            assert result['members'][0]['name'] == 'data/big.bin'
+            assert sorted(m['name'] for m in result['members']) == [
+                'boot/system.map', 'data', 'data/big.bin', 'main.py',
+                'zapp.yaml',
+            ]
+            assert result['members'][0]['size'] == 256 * 1024
+            assert result['directories'][0]['name'] == 'data/'
+            assert result['dependencies'] == []
+            # all of the zapp but the gzip and tar trailers
+            zapp_size = os.path.getsize(
+                os.path.join(tempdir, os.path.basename(tempdir) + '.zapp'))
+            assert 0 < zapp_size - result['compressed_size'] < 1024
+            # the waits for the compression threads, if any, are apart
+            assert set(result['timings']) - set(['write']) == \
+                set(['glob', 'add', 'compress'])
+            assert 'data/big.bin' in stats.report()
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_bundle_project_links(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            zpm.create_project(tempdir, template='python')
+            with open(os.path.join(tempdir, 'zapp.yaml')) as zapp_yaml:
+                zapp = yaml.safe_load(zapp_yaml)
+            data = os.urandom(1024)
+            for name in ('a.bin', 'b.bin'):
+                with open(os.path.join(tempdir, name), 'wb') as fp:
+                    fp.write(data)
+            zapp['bundling'].extend(['a.bin', 'b.bin'])
+            with open(os.path.join(tempdir, 'zapp.yaml'), 'w') as zapp_yaml:
+                zapp_yaml.write(yaml.dump(zapp))
+
+            stats = bundlestats.BundleStats()
+            zpm.bundle_project(tempdir, stats=stats)
+            sizes = dict((m['name'], m['size'])
+                         for m in stats.as_dict()['members'])
+            # the copy is a hard link to the first one, it adds no data
+            assert (sizes['a.bin'], sizes['b.bin']) == (1024, 0)
+        finally:
+            shutil.rmtree(tempdir)
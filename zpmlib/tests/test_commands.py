@@ -13,6 +13,7 @@
 #  limitations under the License.
 
 import mock
+import pytest
 
 from zpmlib import commands
 from swiftclient.exceptions import ClientException
@@ -23,6 +24,15 @@ def test_all_commands_sorted():
     assert cmd_names == sorted(cmd_names)
 
 
+def test_command_registered_once():
+    def bundle(args):
+        pass
+
+    with pytest.raises(ValueError):
+        commands.command(bundle)
+    assert commands.bundle in commands.all_commands()
+
+
 def test_swift_log_filter():
     log_filter = commands.SwiftLogFilter()
 
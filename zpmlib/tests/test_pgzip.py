@@ -0,0 +1,68 @@
+#  Copyright 2014 Rackspace, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import gzip
+import io
+import os
+import tarfile
+
+import pytest
+
+from zpmlib import pgzip
+
+
+def _decompress(data):
+    return gzip.GzipFile(fileobj=io.BytesIO(data)).read()
+
+
+class TestGzipWriter:
+
+    @pytest.mark.parametrize('jobs', [1, 4])
+    def test_round_trip(self, jobs):
+        data = os.urandom(5000) + b'x' * 10000
+        out = io.BytesIO()
+        gz = pgzip.GzipWriter(out, jobs=jobs, block_size=1024)
+        for start in range(0, len(data), 700):
+            gz.write(data[start:start + 700])
+        assert gz.tell() == len(data)
+        gz.close()
+        assert _decompress(out.getvalue()) == data
+
+    def test_empty(self):
+        out = io.BytesIO()
+        pgzip.GzipWriter(out, jobs=2).close()
+        assert _decompress(out.getvalue()) == b''
+
+    def test_tarfile(self):
+        out = io.BytesIO()
+        gz = pgzip.GzipWriter(out, jobs=2, block_size=512)
+        tar = tarfile.open(fileobj=gz, mode='w')
+        for name in ('a', 'b'):
+            info = tarfile.TarInfo(name=name)
+            content = name.encode('ascii') * 3000
+            info.size = len(content)
+            tar.addfile(info, io.BytesIO(content))
+        tar.close()
+        gz.close()
+
+        out.seek(0)
+        tar = tarfile.open(fileobj=out, mode='r:gz')
+        assert tar.getnames() == ['a', 'b']
+        assert tar.extractfile('b').read() == b'b' * 3000
+
+    def test_write_after_close(self):
+        gz = pgzip.GzipWriter(io.BytesIO(), jobs=1)
+        gz.close()
+        with pytest.raises(ValueError):
+            gz.write(b'data')
@@ -12,6 +12,7 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+import glob
 import os
 import shutil
 import tempfile
@@ -161,3 +162,42 @@ class TestAtomicFileCreator:
         afc = util.AtomicFileCreator()
         with pytest.raises(ValueError):
             afc.create_file('not_a_file', 'fake/path', 'abc')
+
+
+class TestTreeGlob:
+    """Tests for :class:`zpmlib.util.TreeGlob`.
+    """
+
+    def setup_method(self, _method):
+        self.root = tempfile.mkdtemp()
+        for path in ('a.py', 'b.txt', '.hidden.py', 'src/c.py', 'src/d.txt',
+                     'src/sub/e.py', 'src/.git/f.py', 'lib/g.py'):
+            path = os.path.join(self.root, path)
+            if not os.path.isdir(os.path.dirname(path)):
+                os.makedirs(os.path.dirname(path))
+            open(path, 'w').close()
+        os.symlink('src', os.path.join(self.root, 'link'))
+
+    def teardown_method(self, _method):
+        shutil.rmtree(self.root)
+
+    def test_expand_like_glob(self):
+        patterns = ['*.py', '.*', 'src/*', '*/*.py', 'src/*/*.py', 'src',
+                    'src/sub/e.py', 'l[a-i]*', 'link/*.py', 'missing/*',
+                    './a.py', 'src/']
+        tree = util.TreeGlob(self.root)
+        expected = [
+            sorted(os.path.relpath(path, self.root) for path in
+                   glob.glob(os.path.join(self.root, pattern)))
+            for pattern in patterns
+        ]
+        assert tree.expand(patterns) == expected
+
+    def test_members(self):
+        tree = util.TreeGlob(self.root)
+        matches = tree.expand(['src/*.py', 'src', 'link', 'a.py', 'a.py'])
+        members = list(tree.members(sum(matches, []), exclude=['a.py']))
+        assert members == [
+            'src/c.py', 'src', 'src/.git', 'src/.git/f.py', 'src/d.txt',
+            'src/sub', 'src/sub/e.py', 'link',
+        ]
@@ -0,0 +1,105 @@
+#  Copyright 2014 Rackspace, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+import os
+import shutil
+import sys
+import tempfile
+
+import pytest
+
+from zpmlib import watch
+
+
+def _write(path, data):
+    with open(path, 'w') as fp:
+        fp.write(data)
+
+
+class TestPollingWatcher:
+    """
+    Tests for :class:`zpmlib.watch.PollingWatcher`.
+    """
+
+    def setup_method(self, _method):
+        self.tempdir = tempfile.mkdtemp()
+        _write(os.path.join(self.tempdir, 'a.py'), 'a')
+        _write(os.path.join(self.tempdir, 'b.py'), 'b')
+        self.watcher = watch.PollingWatcher(
+            self.tempdir, lambda: ['a.py', 'b.py', 'c.py'], interval=0.01)
+
+    def teardown_method(self, _method):
+        shutil.rmtree(self.tempdir)
+
+    def test_no_change(self):
+        assert self.watcher.wait(0.05) == set()
+
+    def test_changes(self):
+        _write(os.path.join(self.tempdir, 'a.py'), 'changed')
+        os.unlink(os.path.join(self.tempdir, 'b.py'))
+        _write(os.path.join(self.tempdir, 'c.py'), 'c')
+        assert self.watcher.wait(1) == set(['a.py', 'b.py', 'c.py'])
+        # reported once
+        assert self.watcher.wait(0.05) == set()
+
+
+@pytest.mark.skipif(not sys.platform.startswith('linux'),
+                    reason='inotify is only available on Linux')
+class TestInotifyWatcher:
+    """
+    Tests for :class:`zpmlib.watch.InotifyWatcher`.
+    """
+
+    def setup_method(self, _method):
+        self.tempdir = tempfile.mkdtemp()
+        os.mkdir(os.path.join(self.tempdir, 'src'))
+        os.mkdir(os.path.join(self.tempdir, '.zapp'))
+        self.watcher = watch.InotifyWatcher(self.tempdir)
+
+    def teardown_method(self, _method):
+        self.watcher.close()
+        shutil.rmtree(self.tempdir)
+
+    def test_changes(self):
+        assert self.watcher.wait(0) == set()
+        _write(os.path.join(self.tempdir, 'src', 'a.py'), 'a')
+        # hidden directories are not watched
+        _write(os.path.join(self.tempdir, '.zapp', 'cache'), 'x')
+        assert watch.wait_changes(self.watcher, 0.05) == \
+            set([os.path.join('src', 'a.py')])
+
+    def test_new_directory(self):
+        os.mkdir(os.path.join(self.tempdir, 'new'))
+        assert watch.wait_changes(self.watcher, 0.05) == set(['new'])
+        _write(os.path.join(self.tempdir, 'new', 'b.py'), 'b')
+        assert watch.wait_changes(self.watcher, 0.05) == \
+            set([os.path.join('new', 'b.py')])
+
+
+class FakeWatcher(object):
+
+    def __init__(self, changes):
+        self.changes = changes
+
+    def wait(self, timeout=None):
+        if self.changes:
+            return self.changes.pop(0)
+        return set()
+
+
+def test_wait_changes():
+    fake = FakeWatcher([set(['a']), set(['b']), set(), set(['c'])])
+    # a and b come in the same burst, c in the next one
+    assert watch.wait_changes(fake) == set(['a', 'b'])
+    assert watch.wait_changes(fake) == set(['c'])
@@ -12,14 +12,23 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+import errno
+import gzip
+import hashlib
+import json
 import os
 import shutil
 import tarfile
 import tempfile
 
 import mock
+import pytest
+import swiftclient
 import yaml
 
+import zpmlib
+from zpmlib import bundlecache
+from zpmlib import zappbundler
 from zpmlib import zpm
 
 
@@ -29,6 +38,17 @@ def touch_file(dir_name, file_name):
 
 class TestPythonBundler:
 
+    def setup_method(self, _method):
+        # keep the shared dependency store out of the home directory
+        self.deps_store = tempfile.mkdtemp()
+        self.store_patch = mock.patch.object(zappbundler, 'DEPS_STORE_DIR',
+                                             self.deps_store)
+        self.store_patch.start()
+
+    def teardown_method(self, _method):
+        self.store_patch.stop()
+        shutil.rmtree(self.deps_store)
+
     def test_bundle_no_deps(self):
         tempdir = tempfile.mkdtemp()
 
@@ -50,6 +70,7 @@ class TestPythonBundler:
                                      os.path.basename(tempdir) + '.zapp')
             tar = tarfile.open(zapp_file)
             expected_file_names = [
+                'boot/zapp.index',
                 'boot/system.map',
                 'zapp.yaml',
                 'main.py',
@@ -58,6 +79,117 @@ class TestPythonBundler:
         finally:
             shutil.rmtree(tempdir)
 
+    def test_bundle_reproducible(self):
+        tempdir = tempfile.mkdtemp()
+
+        try:
+            zpm.create_project(tempdir, template='python')
+            with open(os.path.join(tempdir, 'zapp.yaml')) as zapp_yaml:
+                zapp = yaml.safe_load(zapp_yaml)
+            touch_file(tempdir, 'main.py')
+            touch_file(tempdir, 'b.py')
+            touch_file(tempdir, 'a.py')
+            zapp['bundling'].extend(['main.py', '*.py'])
+            with open(os.path.join(tempdir, 'zapp.yaml'), 'w') as zapp_yaml:
+                zapp_yaml.write(yaml.dump(zapp))
+            zapp_file = os.path.join(tempdir,
+                                     os.path.basename(tempdir) + '.zapp')
+
+            zpm.bundle_project(tempdir)
+            with open(zapp_file, 'rb') as fp:
+                first = fp.read()
+            os.utime(os.path.join(tempdir, 'main.py'), (1, 1))
+            zpm.bundle_project(tempdir, jobs=1)
+            with open(zapp_file, 'rb') as fp:
+                assert fp.read() == first
+
+            tar = tarfile.open(zapp_file)
+            assert [x.name for x in tar.getmembers()] == [
+                'boot/zapp.index', 'boot/system.map', 'zapp.yaml',
+                'main.py', 'a.py', 'b.py',
+            ]
+            assert set(x.mtime for x in tar.getmembers()) == set([0])
+            index = json.loads(
+                tar.extractfile('boot/zapp.index').read().decode('utf-8'))
+            assert zpm._get_zapp_digest(
+                bundlecache.read_index(zapp_file)) == index['digest']
+            # the offsets in the index are those of the members
+            for info, entry in zip(tar.getmembers()[1:], index['members']):
+                assert (info.name, info.offset, info.offset_data) == \
+                    (entry['name'], entry['offset'], entry['offset_data'])
+            main = [entry for entry in index['members']
+                    if entry['name'] == 'main.py'][0]
+            assert main['sha1'] == hashlib.sha1(b'').hexdigest()
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_bundle_compile(self):
+        tempdir = tempfile.mkdtemp()
+
+        try:
+            zpm.create_project(tempdir, template='python')
+            with open(os.path.join(tempdir, 'zapp.yaml')) as zapp_yaml:
+                zapp = yaml.safe_load(zapp_yaml)
+            os.mkdir(os.path.join(tempdir, 'pkg'))
+            touch_file(tempdir, 'main.py')
+            touch_file(tempdir, 'pkg/__init__.py')
+            touch_file(tempdir, 'pkg/broken.py')
+            touch_file(tempdir, 'pkg/data.txt')
+            zapp['bundling'].extend(['main.py', 'pkg'])
+            with open(os.path.join(tempdir, 'zapp.yaml'), 'w') as zapp_yaml:
+                zapp_yaml.write(yaml.dump(zapp))
+
+            def compile_sources(data):
+                failed = []
+                for source, dfile, cfile in json.loads(data.decode('utf-8')):
+                    if source.endswith('broken.py'):
+                        failed.append([source, 'invalid syntax'])
+                    else:
+                        with open(cfile, 'w') as fp:
+                            fp.write(dfile)
+                return json.dumps(failed).encode('utf-8'), None
+
+            with mock.patch('subprocess.Popen') as sppo:
+                sppo.return_value.communicate.side_effect = compile_sources
+                sppo.return_value.returncode = 0
+                zpm.bundle_project(tempdir, compile_bytecode=True)
+                args = sppo.call_args[0][0]
+                assert args[:2] == ['python2.7', '-c']
+                assert args[3] == '0'
+
+            zapp_file = os.path.join(tempdir,
+                                     os.path.basename(tempdir) + '.zapp')
+            tar = tarfile.open(zapp_file)
+            assert [x.name for x in tar.getmembers()] == [
+                'boot/zapp.index', 'boot/system.map', 'zapp.yaml',
+                'main.py', 'pkg', 'pkg/__init__.py', 'pkg/broken.py',
+                'pkg/data.txt', 'main.pyc', 'pkg/__init__.pyc',
+            ]
+            # compiled with the path in the zapp as file name
+            assert tar.extractfile('pkg/__init__.pyc').read() == \
+                b'/pkg/__init__.py'
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_bundle_compile_no_interpreter(self):
+        tempdir = tempfile.mkdtemp()
+
+        try:
+            zpm.create_project(tempdir, template='python')
+            with open(os.path.join(tempdir, 'zapp.yaml')) as zapp_yaml:
+                zapp = yaml.safe_load(zapp_yaml)
+            touch_file(tempdir, 'main.py')
+            zapp['bundling'].append('main.py')
+            with open(os.path.join(tempdir, 'zapp.yaml'), 'w') as zapp_yaml:
+                zapp_yaml.write(yaml.dump(zapp))
+
+            with mock.patch('subprocess.Popen') as sppo:
+                sppo.side_effect = OSError(errno.ENOENT, 'not found')
+                with pytest.raises(zpmlib.ZPMException):
+                    zpm.bundle_project(tempdir, compile_bytecode=True)
+        finally:
+            shutil.rmtree(tempdir)
+
     def test_bundle(self):
         tempdir = tempfile.mkdtemp()
         zapp_file = os.path.join(tempdir, os.path.basename(tempdir) + '.zapp')
@@ -111,6 +243,7 @@ class TestPythonBundler:
             ]
             tar = tarfile.open(zapp_file)
             expected_file_names = [
+                'boot/zapp.index',
                 'boot/system.map',
                 'zapp.yaml',
                 'main.py',
@@ -153,6 +286,7 @@ class TestPythonBundler:
 
             tar = tarfile.open(zapp_file)
             expected_file_names = [
+                'boot/zapp.index',
                 'boot/system.map',
                 'zapp.yaml',
                 'main.py',
@@ -164,3 +298,280 @@ class TestPythonBundler:
             tar.close()
         finally:
             shutil.rmtree(tempdir)
+
+    def test_bundle_prune(self):
+        tempdir = tempfile.mkdtemp()
+        site_pkgs = os.path.join(tempdir, '.zapp/.zapp/venv/lib/python2.7/'
+                                          'site-packages')
+        zapp_file = os.path.join(tempdir, os.path.basename(tempdir) + '.zapp')
+        try:
+            zpm.create_project(tempdir, template='python')
+            with open(os.path.join(tempdir, 'zapp.yaml')) as zapp_yaml:
+                zapp = yaml.safe_load(zapp_yaml)
+            touch_file(tempdir, 'main.py')
+            zapp['bundling'].append('main.py')
+            zapp['dependencies'] = ['dep1']
+            with open(os.path.join(tempdir, 'zapp.yaml'), 'w') as zapp_yaml:
+                zapp_yaml.write(yaml.dump(zapp))
+
+            def tox_fetch_deps(*args, **kwargs):
+                dep1 = os.path.join(site_pkgs, 'dep1')
+                for subdir in ('tests', 'docs', 'sub/tests'):
+                    os.makedirs(os.path.join(dep1, subdir))
+                for name in ('__init__.py', '__init__.pyc', '_speedups.c',
+                             'tests/test_dep1.py', 'docs/index.rst',
+                             'sub/__init__.py', 'sub/tests/test_sub.py'):
+                    with open(os.path.join(dep1, name), 'w') as fp:
+                        fp.write('data')
+                return 0
+
+            with mock.patch('subprocess.Popen') as sppo:
+                sppo.return_value.wait.side_effect = tox_fetch_deps
+                with mock.patch.object(zappbundler, 'LOG') as log:
+                    zpm.bundle_project(tempdir)
+            log.info.assert_any_call(
+                "%s: %d bytes bundled, %d bytes pruned (%d%%)",
+                'dep1', 8, 20, 71)
+
+            tar = tarfile.open(zapp_file)
+            prefix = 'lib/python2.7/site-packages/'
+            assert [x.name[len(prefix):] for x in tar.getmembers()
+                    if x.name.startswith(prefix)] == [
+                'dep1', 'dep1/__init__.py', 'dep1/sub', 'dep1/sub/__init__.py',
+            ]
+            tar.close()
+
+            # the rules of the zapp.yaml replace the default ones
+            zapp['prune'] = ['/sub', '*.rst']
+            with open(os.path.join(tempdir, 'zapp.yaml'), 'w') as zapp_yaml:
+                zapp_yaml.write(yaml.dump(zapp))
+            zpm.bundle_project(tempdir)
+            tar = tarfile.open(zapp_file)
+            assert [x.name[len(prefix):] for x in tar.getmembers()
+                    if x.name.startswith(prefix)] == [
+                'dep1', 'dep1/__init__.py', 'dep1/__init__.pyc',
+                'dep1/_speedups.c', 'dep1/docs', 'dep1/tests',
+                'dep1/tests/test_dep1.py',
+            ]
+            tar.close()
+
+            # an empty prune key (null) keeps the default rules
+            zapp['prune'] = None
+            with open(os.path.join(tempdir, 'zapp.yaml'), 'w') as zapp_yaml:
+                zapp_yaml.write(yaml.dump(zapp))
+            zpm.bundle_project(tempdir)
+            tar = tarfile.open(zapp_file)
+            assert [x.name[len(prefix):] for x in tar.getmembers()
+                    if x.name.startswith(prefix)] == [
+                'dep1', 'dep1/__init__.py', 'dep1/sub', 'dep1/sub/__init__.py',
+            ]
+            tar.close()
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_bundle_shake(self):
+        tempdir = tempfile.mkdtemp()
+        site_pkgs = os.path.join(tempdir, '.zapp/.zapp/venv/lib/python2.7/'
+                                          'site-packages')
+        try:
+            zpm.create_project(tempdir, template='python')
+            with open(os.path.join(tempdir, 'zapp.yaml')) as zapp_yaml:
+                zapp = yaml.safe_load(zapp_yaml)
+            touch_file(tempdir, 'main.py')
+            zapp['bundling'].append('main.py')
+            zapp['execution']['groups'][0]['args'] = '/main.py --verbose'
+            zapp['dependencies'] = ['dep1', 'dep2']
+            zapp['dynamic_imports'] = ['dep1.plugins.*']
+            with open(os.path.join(tempdir, 'zapp.yaml'), 'w') as zapp_yaml:
+                zapp_yaml.write(yaml.dump(zapp))
+
+            def tox_fetch_deps(*args, **kwargs):
+                dep1 = os.path.join(site_pkgs, 'dep1')
+                for subdir in ('plugins', 'unused'):
+                    os.makedirs(os.path.join(dep1, subdir))
+                for name in ('__init__.py', 'used.py', 'unused.py',
+                             'data.json', 'plugins/__init__.py',
+                             'plugins/a.py', 'unused/__init__.py'):
+                    touch_file(dep1, name)
+                touch_file(site_pkgs, 'dep2.py')
+                return 0
+
+            def find_modules(data):
+                job = json.loads(data.decode('utf-8'))
+                # the modules are looked up in the dependency store
+                project_dir, store_site_pkgs = job['path']
+                assert project_dir == tempdir
+                assert store_site_pkgs.startswith(self.deps_store)
+                assert job['scripts'] == [os.path.join(tempdir, 'main.py')]
+                assert job['modules'] == ['dep1.plugins.a']
+                dep1 = os.path.join(store_site_pkgs, 'dep1')
+                files = [os.path.join(tempdir, 'main.py')] + [
+                    os.path.join(dep1, name)
+                    for name in ('__init__.py', 'used.py',
+                                 'plugins/__init__.py', 'plugins/a.py')]
+                return json.dumps(files).encode('utf-8'), None
+
+            with mock.patch('subprocess.Popen') as sppo:
+                sppo.return_value.wait.side_effect = tox_fetch_deps
+                sppo.return_value.communicate.side_effect = find_modules
+                sppo.return_value.returncode = 0
+                zpm.bundle_project(tempdir, shake=True)
+
+            zapp_file = os.path.join(tempdir,
+                                     os.path.basename(tempdir) + '.zapp')
+            tar = tarfile.open(zapp_file)
+            prefix = 'lib/python2.7/site-packages/'
+            assert [x.name[len(prefix):] for x in tar.getmembers()
+                    if x.name.startswith(prefix)] == [
+                'dep1', 'dep1/__init__.py', 'dep1/data.json', 'dep1/plugins',
+                'dep1/plugins/__init__.py', 'dep1/plugins/a.py',
+                'dep1/used.py',
+            ]
+            tar.close()
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_bundle_shake_no_entry_script(self):
+        tempdir = tempfile.mkdtemp()
+        try:
+            zpm.create_project(tempdir, template='python')
+            with open(os.path.join(tempdir, 'zapp.yaml')) as zapp_yaml:
+                zapp = yaml.safe_load(zapp_yaml)
+            zapp['dependencies'] = ['dep1']
+            with pytest.raises(zpmlib.ZPMException):
+                zappbundler._python_shake(tempdir, zapp, tempdir)
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_bundle_cached_deps(self):
+        tempdir = tempfile.mkdtemp()
+        site_pkgs = os.path.join(tempdir, '.zapp/.zapp/venv/lib/python2.7/'
+                                          'site-packages')
+        try:
+            zpm.create_project(tempdir, template='python')
+            with open(os.path.join(tempdir, 'zapp.yaml')) as zapp_yaml:
+                zapp = yaml.safe_load(zapp_yaml)
+            touch_file(tempdir, 'main.py')
+            zapp['bundling'].append('main.py')
+            zapp['dependencies'] = ['dep1']
+            with open(os.path.join(tempdir, 'zapp.yaml'), 'w') as zapp_yaml:
+                zapp_yaml.write(yaml.dump(zapp))
+
+            def tox_fetch_deps(*args, **kwargs):
+                os.makedirs(site_pkgs)
+                touch_file(site_pkgs, 'dep1.py')
+                return 0
+
+            with mock.patch('subprocess.Popen') as sppo:
+                instance = sppo.return_value
+                instance.wait.side_effect = tox_fetch_deps
+                zpm.bundle_project(tempdir)
+                assert sppo.call_count == 1
+
+                # the venv is gone, the store still has the dependencies
+                shutil.rmtree(os.path.join(tempdir, '.zapp', '.zapp'))
+                zpm.bundle_project(tempdir)
+                assert sppo.call_count == 1
+
+                zpm.bundle_project(tempdir, refresh_deps=True)
+                assert sppo.call_count == 2
+
+            zapp_file = os.path.join(tempdir,
+                                     os.path.basename(tempdir) + '.zapp')
+            tar = tarfile.open(zapp_file)
+            assert 'lib/python2.7/site-packages/dep1.py' in tar.getnames()
+            tar.close()
+            entries = [name for name in os.listdir(self.deps_store)
+                       if not name.endswith('.lock')]
+            assert len(entries) == 1
+        finally:
+            shutil.rmtree(tempdir)
+
+    def test_bundle_layered(self):
+        tempdir = tempfile.mkdtemp()
+        site_pkgs = os.path.join(tempdir, '.zapp/.zapp/venv/lib/python2.7/'
+                                          'site-packages')
+        try:
+            zpm.create_project(tempdir, template='python')
+            with open(os.path.join(tempdir, 'zapp.yaml')) as zapp_yaml:
+                zapp = yaml.safe_load(zapp_yaml)
+            touch_file(tempdir, 'main.py')
+            zapp['bundling'].append('main.py')
+            zapp['dependencies'] = ['dep1']
+            with open(os.path.join(tempdir, 'zapp.yaml'), 'w') as zapp_yaml:
+                zapp_yaml.write(yaml.dump(zapp))
+
+            def tox_fetch_deps(*args, **kwargs):
+                os.makedirs(site_pkgs)
+                touch_file(site_pkgs, 'dep1.py')
+                return 0
+
+            name = os.path.basename(tempdir)
+            deps_file = os.path.join(tempdir, name + '.deps.zapp')
+            with mock.patch('subprocess.Popen') as sppo:
+                sppo.return_value.wait.side_effect = tox_fetch_deps
+                zapp_file = zpm.bundle_project(tempdir, layered=True)
+
+            tar = tarfile.open(zapp_file)
+            assert 'lib/python2.7/site-packages/dep1.py' not in \
+                tar.getnames()
+            with open(deps_file, 'rb') as fp:
+                sha1 = hashlib.sha1(fp.read()).hexdigest()
+            assert zpm._get_external(tar) == [{
+                'name': 'deps', 'path': name + '.deps.zapp',
+                'size': os.path.getsize(deps_file), 'sha1': sha1,
+                'mountpoint': '/'}]
+            # mounted like the zapp image
+            job = zpm._prepare_job(tar, None, 'swift://AUTH_abc/cont/app.zapp')
+            assert job[0]['devices'][-1] == {
+                'name': 'deps', 'path': 'swift://AUTH_abc/cont/.external/' +
+                sha1, 'mountpoint': '/'}
+            tar.close()
+            tar = tarfile.open(deps_file)
+            assert tar.getnames() == ['boot/zapp.index',
+                                      'lib/python2.7/site-packages/dep1.py']
+            tar.close()
+
+            # uploaded decompressed, as a tar image, next to the zapp
+            conn = mock.Mock()
+            conn.url = 'http://example.com/v1/AUTH_abc'
+            conn.get_container.return_value = ({}, [])
+            conn.head_object.side_effect = \
+                swiftclient.exceptions.ClientException('not found')
+            uploads = {}
+
+            def put_object(container, obj, data, **kwargs):
+                if hasattr(data, 'read'):
+                    data = data.read()
+                uploads[obj] = (data, kwargs)
+
+            conn.put_object.side_effect = put_object
+            zpm._deploy_zapp(conn, 'cont', zapp_file, None)
+            data, kwargs = uploads['.external/%s' % sha1]
+            assert data == gzip.open(deps_file).read()
+            assert kwargs == {'content_length': len(data),
+                              'content_type': 'application/x-tar'}
+
+            # and once only
+            conn.head_object.side_effect = None
+            conn.head_object.return_value = {}
+            uploads.clear()
+            zpm._deploy_zapp(conn, 'cont', zapp_file, None)
+            assert conn.head_object.call_args_list[-1] == \
+                mock.call('cont', '.external/%s' % sha1)
+            assert '.external/%s' % sha1 not in uploads
+
+            # the dependency layer is reproducible
+            zpm.bundle_project(tempdir, layered=True)
+            with open(deps_file, 'rb') as fp:
+                assert hashlib.sha1(fp.read()).hexdigest() == sha1
+
+            # and gone once the dependencies are bundled in the zapp
+            zpm.bundle_project(tempdir)
+            assert not os.path.exists(deps_file)
+            tar = tarfile.open(zapp_file)
+            assert 'lib/python2.7/site-packages/dep1.py' in tar.getnames()
+            assert zpm._get_external(tar) == []
+            tar.close()
+        finally:
+            shutil.rmtree(tempdir)
@@ -23,12 +23,15 @@ import shutil
 import swiftclient.exceptions
 import tarfile
 import tempfile
+import yaml
 import zpmlib
 try:
     from cStringIO import StringIO as BytesIO
 except ImportError:
     from io import BytesIO
 
+from zpmlib import bundlecache
+from zpmlib import pgzip
 from zpmlib import zpm, commands
 
 
@@ -91,6 +94,115 @@ def test__prepare_job():
         shutil.rmtree(tempdir)
 
 
+def test__get_zapp_tar_size():
+    tempdir = tempfile.mkdtemp()
+    try:
+        zpm.create_project(tempdir, template='python')
+        with open(os.path.join(tempdir, 'zapp.yaml')) as fp:
+            zapp = yaml.safe_load(fp)
+        zapp['bundling'] = ['*.py']
+        with open(os.path.join(tempdir, 'zapp.yaml'), 'w') as fp:
+            fp.write(yaml.dump(zapp))
+        for i, size in enumerate([0, 1, 511, 512, 10000]):
+            with open(os.path.join(tempdir, '%d.py' % i), 'w') as fp:
+                fp.write('#' * size)
+        zapp_path = zpm.bundle_project(tempdir, jobs=1)
+        index = bundlecache.read_index(zapp_path)
+        assert zpm._get_zapp_tar_size(index) == \
+            len(gzip.open(zapp_path).read())
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test__generate_uploads_single_pass():
+    tempdir = tempfile.mkdtemp()
+    try:
+        zpm.create_project(tempdir, with_ui=True, template='python')
+        open(os.path.join(tempdir, 'main.py'), 'w').close()
+        with open(os.path.join(tempdir, 'zapp.yaml')) as fp:
+            zapp = yaml.safe_load(fp)
+        zapp['meta']['name'] = 'app'
+        zapp['bundling'] = ['main.py']
+        with open(os.path.join(tempdir, 'zapp.yaml'), 'w') as fp:
+            fp.write(yaml.dump(zapp))
+        zapp_path = zpm.bundle_project(tempdir, jobs=1)
+        conn = mock.Mock(url='http://example.com/v1/AUTH_abc')
+
+        with mock.patch('tarfile.open', wraps=tarfile.open) as tar_open:
+            uploads = zpm._generate_uploads(conn, 'cont', zapp_path, '{}',
+                                            bundlecache.read_index(zapp_path))
+            path, data, _content_type = next(uploads)
+            assert path == 'cont/app.zapp'
+            assert data.read() == gzip.open(zapp_path).read()
+            uploads = list(uploads)
+        # the zapp was only decompressed by the upload (and for its index)
+        assert [call[0][1:] for call in tar_open.call_args_list] == \
+            [('r|gz',)]
+
+        assert [upload[0] for upload in uploads] == [
+            'cont/boot/system.map', 'cont/index.html', 'cont/style.css',
+            'cont/zerocloud.js']
+        job = json.loads(uploads[0][1])
+        assert job[0]['devices'][-1] == {
+            'name': 'image', 'path': 'swift://AUTH_abc/cont/app.zapp'}
+        with open(os.path.join(tempdir, 'style.css'), 'rb') as fp:
+            assert uploads[2][1] == fp.read()
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_bundle_project_twice():
+    tempdir = tempfile.mkdtemp()
+    try:
+        zpm.create_project(tempdir, template='python')
+        open(os.path.join(tempdir, 'main.py'), 'w').close()
+        with open(os.path.join(tempdir, 'zapp.yaml')) as fp:
+            zapp = yaml.safe_load(fp)
+        zapp['meta']['name'] = 'app'
+        zapp['bundling'] = ['*']
+        with open(os.path.join(tempdir, 'zapp.yaml'), 'w') as fp:
+            fp.write(yaml.dump(zapp))
+        zapp_path = zpm.bundle_project(tempdir, jobs=1)
+        with open(zapp_path, 'rb') as fp:
+            first = fp.read()
+        # a leftover partial zapp is not bundled either
+        open(zapp_path + '.tmp', 'w').close()
+
+        # the first zapp, and the .zapp directory, are not in the second one
+        zapp_path = zpm.bundle_project(tempdir, jobs=1)
+        names = tarfile.open(zapp_path).getnames()
+        assert 'main.py' in names
+        assert [name for name in names
+                if name.startswith(('app.zapp', '.zapp'))] == []
+        with open(zapp_path, 'rb') as fp:
+            assert fp.read() == first
+    finally:
+        shutil.rmtree(tempdir)
+
+
+def test_bundle_project_failure():
+    tempdir = tempfile.mkdtemp()
+    try:
+        zpm.create_project(tempdir, template='python')
+        with open(os.path.join(tempdir, 'zapp.yaml')) as fp:
+            zapp = yaml.safe_load(fp)
+        zapp['bundling'] = ['missing.py']
+        with open(os.path.join(tempdir, 'zapp.yaml'), 'w') as fp:
+            fp.write(yaml.dump(zapp))
+        abort = pgzip.GzipWriter.abort
+        with mock.patch.object(pgzip.GzipWriter, 'abort',
+                               autospec=True) as gz_abort:
+            gz_abort.side_effect = abort
+            with pytest.raises(zpmlib.ZPMException):
+                zpm.bundle_project(tempdir, jobs=2)
+        # the compression threads are stopped, the partial body is removed
+        assert gz_abort.call_count == 1
+        assert not os.path.exists(os.path.join(tempdir, '.zapp',
+                                               'zapp.body'))
+    finally:
+        shutil.rmtree(tempdir)
+
+
 class TestFindProjectRoot:
     """
     Tests for :func:`zpmlib.zpm.find_project_root`.
@@ -126,6 +238,66 @@ class TestFindProjectRoot:
             shutil.rmtree(self.tempdir)
 
 
+class TestBundleAll:
+    """
+    Tests for :func:`zpmlib.zpm.bundle_all`.
+    """
+
+    def setup_method(self, _method):
+        self.tempdir = tempfile.mkdtemp()
+        for name in ('app1', 'apps/app2', 'broken', '.zapp/hidden'):
+            project = os.path.join(self.tempdir, name)
+            zpm.create_project(project, template='python')
+            with open(os.path.join(project, 'zapp.yaml')) as fp:
+                zapp = yaml.safe_load(fp)
+            zapp['meta']['name'] = os.path.basename(name)
+            if name != 'broken':
+                open(os.path.join(project, 'main.py'), 'w').close()
+                zapp['bundling'] = ['main.py']
+            with open(os.path.join(project, 'zapp.yaml'), 'w') as fp:
+                fp.write(yaml.dump(zapp))
+
+    def teardown_method(self, _method):
+        shutil.rmtree(self.tempdir)
+
+    def test_find_projects(self):
+        assert zpm.find_projects(self.tempdir) == [
+            os.path.join(self.tempdir, name)
+            for name in ('app1', 'apps/app2', 'broken')
+        ]
+
+    def test_bundle_all(self):
+        results = zpm.bundle_all(self.tempdir, processes=2, jobs=1)
+        assert [result['project'] for result in results] == \
+            zpm.find_projects(self.tempdir)
+        app1, app2, broken = results
+        assert app1['zapp'] == os.path.join(self.tempdir, 'app1', 'app1.zapp')
+        assert app1['size'] == os.path.getsize(app1['zapp'])
+        assert os.path.isfile(app2['zapp'])
+        # the broken project did not stop the others
+        assert 'zapp' not in broken
+        assert 'matched anything' in broken['error']
+
+        table = str(zpm._get_bundle_table(results))
+        assert 'app1.zapp' in table
+        assert 'error: None of the files' in table
+
+    def test_bundle_all_command(self):
+        args = commands.set_up_arg_parser().parse_args(
+            ['bundle', '--all', self.tempdir, '-p', '1'])
+        with mock.patch('zpmlib.zpm.bundle_all') as bundle_all:
+            bundle_all.return_value = [
+                {'project': 'a', 'zapp': 'a/a.zapp', 'size': 1, 'time': 0.1},
+                {'project': 'b', 'error': 'boom', 'time': 0.1},
+            ]
+            with pytest.raises(zpmlib.ZPMException) as exc:
+                args.func(args)
+        assert bundle_all.call_args[0] == (self.tempdir,)
+        assert bundle_all.call_args[1]['processes'] == 1
+        assert bundle_all.call_args[1]['jobs'] == 1
+        assert 'failed to bundle 1 of 2 projects: b' in str(exc.value)
+
+
 def test__generate_job_desc():
     # Test :func:`zpmlib.zpm._generate_job_desc`.
     zapp_yaml_contents = {
@@ -376,9 +548,14 @@ print("Hello from ZeroVM!")
         )
 
     def test__generate_uploads(self):
-        uploads = zpm._generate_uploads(self.conn, self.target,
-                                        self.zapp_path, self.auth_opts)
-        uploads = list(uploads)
+        uploads = zpm._generate_uploads(
+            self.conn, self.target, self.zapp_path, self.auth_opts,
+            bundlecache.read_index(self.zapp_path))
+        # the zapp is streamed, read it before the next upload closes it
+        zapp_upload = next(uploads)
+        zapp_upload = zapp_upload[:1] + (zapp_upload[1].read(),) \
+            + zapp_upload[2:]
+        uploads = [zapp_upload] + list(uploads)
 
         foojs_tmpl = jinja2.Template(self.foojstmpl_contents.decode())
         foojs = foojs_tmpl.render(auth_opts=self.auth_opts)
@@ -410,6 +587,43 @@ print("Hello from ZeroVM!")
                 mock.call('x', 'a', 'b', content_type=None),
                 mock.call('x', 'c', 'd', content_type=None)]
 
+    def test__deploy_zapp_unchanged(self):
+        remote_zapp = '%s/zapp.yaml' % self.target
+        self.conn.head_object.return_value = {
+            'x-object-meta-zapp-digest': 'abc123'}
+        with mock.patch('zpmlib.zpm._generate_uploads') as gu:
+            with mock.patch('zpmlib.zpm._get_zapp_digest') as gzd:
+                gzd.return_value = 'abc123'
+                gu.return_value = iter([(remote_zapp, 'zapp', None),
+                                        ('x/c', 'd', None)])
+                zpm._deploy_zapp(self.conn, self.target, self.zapp_path,
+                                 self.auth_opts)
+
+        assert self.conn.head_object.call_args_list == [
+            mock.call('container1', 'foo/bar/zapp.yaml')]
+        assert self.conn.put_object.call_args_list == [
+            mock.call('x', 'c', 'd', content_type=None)]
+
+    def test__deploy_zapp_changed(self):
+        remote_zapp = '%s/zapp.yaml' % self.target
+        self.conn.head_object.return_value = {
+            'x-object-meta-zapp-digest': 'old'}
+        with mock.patch('zpmlib.zpm._generate_uploads') as gu:
+            with mock.patch('zpmlib.zpm._get_zapp_digest') as gzd:
+                gzd.return_value = 'abc123'
+                gu.return_value = iter([(remote_zapp, 'zapp', None)])
+                zpm._deploy_zapp(self.conn, self.target, self.zapp_path,
+                                 self.auth_opts)
+
+        assert self.conn.put_object.call_args_list == [
+            mock.call('container1', 'foo/bar/zapp.yaml', 'zapp',
+                      content_length=None, content_type=None,
+                      headers={'X-Object-Meta-Zapp-Digest': 'abc123'})]
+
+    def test__get_zapp_digest_missing(self):
+        index = bundlecache.read_index(self.zapp_path)
+        assert zpm._get_zapp_digest(index) is None
+
     def test__deploy_zapp_with_index_html(self):
         with mock.patch('zpmlib.zpm._generate_uploads') as gu:
             gu.return_value = iter([('cont/dir/index.html', 'data',
@@ -757,3 +971,239 @@ class TestExecSummaryTable:
         actual_total_t, actual_table = zpm._get_exec_table_data(headers)
         assert actual_total_t == expected_total_t
         assert actual_table == expected_table
+
+
+class TestRunLocal:
+    """
+    Tests for :func:`zpmlib.zpm.run_local`.
+    """
+
+    def setup_method(self, _method):
+        self.temp_dir = tempfile.mkdtemp()
+        self.zapp_path = os.path.join(self.temp_dir, 'hello.zapp')
+        self.job = [{'exec': {'args': 'hello.py',
+                              'path': 'file://python2.7:python'},
+                     'devices': [{'name': 'python2.7'}, {'name': 'stdout'}],
+                     'name': 'hello'}]
+        job_file = os.path.join(self.temp_dir, 'system.map')
+        with open(job_file, 'w') as fp:
+            json.dump(self.job, fp)
+        tar = tarfile.open(self.zapp_path, 'w:gz')
+        tar.add(job_file, arcname='boot/system.map')
+        tar.close()
+
+        self.args = mock.Mock(zapp=self.zapp_path, swift_dir=self.temp_dir,
+                              zvapp='zvapp')
+        self.headers = {'x-nexe-system': 'hello',
+                        'x-nexe-status': 'ok.',
+                        'x-nexe-retcode': '0',
+                        'x-nexe-cdr-line': '0.1, 0.1, 0 0 0 0 0 0 0 0 0 0'}
+
+    def teardown_method(self, _method):
+        shutil.rmtree(self.temp_dir)
+
+    def fake_popen(self, returncode=0):
+        test = self
+
+        class FakePopen(object):
+            def __init__(self, cmd, stdout=None):
+                test.cmd = cmd
+                job_file = cmd[-1]
+                with open(job_file) as fp:
+                    test.run_job = json.load(fp)
+                # ZeroVM mounts plain tar images only, 'r:' is no gzip
+                image = tarfile.open(cmd[cmd.index('--image') + 1], 'r:')
+                test.image_names = image.getnames()
+                image.close()
+                with open(cmd[cmd.index('--summary-out') + 1], 'w') as fp:
+                    json.dump(test.headers, fp)
+                self.returncode = returncode
+
+            def communicate(self):
+                return b'Hello world!\n', None
+
+        return FakePopen
+
+    def test_run_local(self):
+        with mock.patch('subprocess.Popen', new=self.fake_popen()):
+            resp, output = zpm.run_local(self.args)
+
+        assert resp == {'headers': self.headers}
+        assert output == b'Hello world!\n'
+        assert self.cmd[:2] == ['zvapp', '--image']
+        assert self.cmd[3:5] == ['--swift-account-path', self.temp_dir]
+        assert self.image_names == ['boot/system.map']
+        expected_job = copy.deepcopy(self.job)
+        expected_job[0]['devices'].append({'name': 'image'})
+        assert self.run_job == expected_job
+
+    def test_run_local_failed(self):
+        with mock.patch('subprocess.Popen', new=self.fake_popen(1)):
+            with pytest.raises(zpmlib.ZPMException):
+                zpm.run_local(self.args)
+
+    def test_run_local_no_system_map(self):
+        tar = tarfile.open(self.zapp_path, 'w:gz')
+        tar.close()
+        with pytest.raises(zpmlib.ZPMException):
+            zpm.run_local(self.args)
+
+    def _write_external(self, external):
+        tar = tarfile.open(self.zapp_path, 'w:gz')
+        for path, content in [
+                ('boot/zapp.index',
+                 {'members': [{'name': 'boot/external.json'}]}),
+                ('boot/external.json', external)]:
+            data = json.dumps(content).encode('utf-8')
+            info = tarfile.TarInfo(path)
+            info.size = len(data)
+            tar.addfile(info, BytesIO(data))
+        tar.close()
+
+    def test_run_local_external(self):
+        self._write_external([{'name': 'data.bin', 'size': 1, 'sha1': 'x'}])
+        with pytest.raises(zpmlib.ZPMException) as exc:
+            zpm.run_local(self.args)
+        assert 'has external files' in str(exc.value)
+
+    def test_run_local_layered(self):
+        self._write_external([{'name': 'deps', 'path': 'hello.deps.zapp',
+                               'size': 1, 'sha1': 'x', 'mountpoint': '/'}])
+        with pytest.raises(zpmlib.ZPMException) as exc:
+            zpm.run_local(self.args)
+        assert 'layered zapp' in str(exc.value)
+        assert 'hello.deps.zapp' in str(exc.value)
+
+
+class TestWatchProject:
+    """
+    Tests for :func:`zpmlib.zpm.watch_project`.
+    """
+
+    def setup_method(self, _method):
+        self.tempdir = tempfile.mkdtemp()
+        zpm.create_project(self.tempdir, template='python')
+        for name in ('main.py', 'notes.txt'):
+            open(os.path.join(self.tempdir, name), 'w').close()
+        with open(os.path.join(self.tempdir, 'zapp.yaml')) as fp:
+            zapp = yaml.safe_load(fp)
+        zapp['meta']['name'] = 'app'
+        zapp['bundling'] = ['*.py', '*.zapp']
+        with open(os.path.join(self.tempdir, 'zapp.yaml'), 'w') as fp:
+            fp.write(yaml.dump(zapp))
+
+    def teardown_method(self, _method):
+        shutil.rmtree(self.tempdir)
+
+    def test_watched_paths(self):
+        open(os.path.join(self.tempdir, 'app.zapp'), 'w').close()
+        # the zapp itself is not watched
+        assert zpm._watched_paths(self.tempdir) == set(['zapp.yaml',
+                                                        'main.py'])
+
+    def test_watch_project(self):
+        changes = [set(['notes.txt']), set(['main.py']), set(['zapp.yaml']),
+                   KeyboardInterrupt()]
+        with mock.patch('zpmlib.watch.wait_changes') as wait_changes:
+            wait_changes.side_effect = changes
+            with mock.patch('zpmlib.zpm.bundle_project') as bundle_project:
+                bundle_project.side_effect = [None, Exception('bad'), None]
+                with mock.patch('subprocess.call') as call:
+                    with pytest.raises(KeyboardInterrupt):
+                        zpm.watch_project(self.tempdir, on_change='true',
+                                          poll=True, refresh_deps=True)
+        # bundled at start, and not for notes.txt, which is not bundled
+        assert bundle_project.call_args_list == [
+            mock.call(self.tempdir, refresh_deps=True),
+            mock.call(self.tempdir, refresh_deps=False),
+            mock.call(self.tempdir, refresh_deps=False),
+        ]
+        # the failed bundle did not stop the watch, nor run the command
+        assert call.call_args_list == [
+            mock.call('true', shell=True, cwd=self.tempdir),
+        ] * 2
+
+
+class TestExternal:
+    """
+    Tests for the ``external`` section of the zapp.yaml.
+    """
+
+    def setup_method(self, _method):
+        self.tempdir = tempfile.mkdtemp()
+        zpm.create_project(self.tempdir, template='python')
+        os.mkdir(os.path.join(self.tempdir, 'data'))
+        for name, data in (('main.py', b'print(1)'),
+                           ('data/model.bin', b'model'),
+                           ('data/table.csv', b'a,b')):
+            with open(os.path.join(self.tempdir, name), 'wb') as fp:
+                fp.write(data)
+        with open(os.path.join(self.tempdir, 'zapp.yaml')) as fp:
+            zapp = yaml.safe_load(fp)
+        zapp['meta']['name'] = 'app'
+        zapp['bundling'] = ['main.py', 'data']
+        zapp['external'] = ['data/*.bin']
+        with open(os.path.join(self.tempdir, 'zapp.yaml'), 'w') as fp:
+            fp.write(yaml.dump(zapp))
+        self.zapp_path = zpm.bundle_project(self.tempdir, jobs=1)
+        self.conn = mock.Mock()
+        self.conn.url = 'http://example.com/v1/AUTH_abc'
+        self.conn.get_container.return_value = ({}, [])
+
+    def teardown_method(self, _method):
+        shutil.rmtree(self.tempdir)
+
+    def test_bundle(self):
+        tar = tarfile.open(self.zapp_path)
+        names = tar.getnames()
+        assert 'data/table.csv' in names
+        assert 'data/model.bin' not in names
+        assert zpm._get_external(tar) == [
+            {'name': 'data/model.bin', 'size': 5,
+             'sha1': '1d06a0d76f000e6edd18de492383983feefced4e'},
+        ]
+
+    def test__prepare_job(self):
+        tar = tarfile.open(self.zapp_path)
+        job = zpm._prepare_job(tar, None, 'swift://AUTH_abc/cont/app.zapp')
+        assert job[0]['devices'][-2:] == [
+            {'name': 'image', 'path': 'swift://AUTH_abc/cont/app.zapp'},
+            {'name': 'data_model.bin',
+             'path': 'swift://AUTH_abc/cont/.external/'
+                     '1d06a0d76f000e6edd18de492383983feefced4e',
+             'mountpoint': '/data/model.bin'},
+        ]
+
+    def test__deploy_zapp(self):
+        self.conn.head_object.side_effect = \
+            swiftclient.exceptions.ClientException('not found')
+        zpm._deploy_zapp(self.conn, 'cont', self.zapp_path, None)
+        container, obj, data = self.conn.put_object.call_args_list[-1][0]
+        assert (container, obj) == (
+            'cont', '.external/1d06a0d76f000e6edd18de492383983feefced4e')
+        assert data.name == os.path.join(self.tempdir, 'data', 'model.bin')
+        assert data.closed
+
+    def test__deploy_zapp_already_uploaded(self):
+        self.conn.head_object.return_value = {}
+        with mock.patch('zpmlib.bundlecache.read_index',
+                        wraps=bundlecache.read_index) as read_index:
+            zpm._deploy_zapp(self.conn, 'cont', self.zapp_path, None)
+        # the index is read once and passed around
+        assert read_index.call_count == 1
+        objects = [call[0][1] for call in self.conn.put_object.call_args_list]
+        assert objects == ['app.zapp', 'boot/system.map']
+
+    def test__deploy_zapp_changed(self):
+        self.conn.head_object.side_effect = \
+            swiftclient.exceptions.ClientException('not found')
+        with open(os.path.join(self.tempdir, 'data', 'model.bin'), 'w') as fp:
+            fp.write('new model')
+        with pytest.raises(zpmlib.ZPMException):
+            zpm._deploy_zapp(self.conn, 'cont', self.zapp_path, None)
+
+    def test_execute(self):
+        args = mock.Mock(container=None, zapp=self.zapp_path)
+        with mock.patch('zpmlib.zpm._get_zerocloud_conn'):
+            with pytest.raises(zpmlib.ZPMException):
+                zpm.execute(args)
@@ -12,9 +12,20 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+import fnmatch
+import glob
 import os
+import re
 import shutil
 
+try:
+    from os import scandir
+except ImportError:
+    # Python < 3.5
+    scandir = None
+
+_MAGIC = re.compile('[*?[]')
+
 
 class AtomicFileCreator(object):
     """Atomically create a group of files/directories, with a rollback function
@@ -64,3 +75,118 @@ class AtomicFileCreator(object):
         if exc_type is not None:
             self._rollback()
             raise exc_value
+
+
+def _compile_glob_part(part):
+    """Return a function telling if a file name matches the glob pattern
+    `part`, with the rules of :mod:`glob` for hidden files.
+
+    >>> match = _compile_glob_part('*.py')
+    >>> match('setup.py'), match('.hidden.py'), match('setup.pyc')
+    (True, False, False)
+    >>> _compile_glob_part('.*')('.hidden.py')
+    True
+    """
+    if not _MAGIC.search(part):
+        return lambda name: name == part
+    regex = re.compile(fnmatch.translate(part))
+    hidden_ok = part.startswith('.')
+    return lambda name: ((hidden_ok or not name.startswith('.'))
+                         and regex.match(name) is not None)
+
+
+class TreeGlob(object):
+    """Expand glob patterns relative to `root` with a single walk of the
+    tree, only descending into the directories some pattern can match in.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        # relpath -> sorted [(name, is_dir, is_link)]
+        self._listings = {}
+        # relpath -> (is_dir, is_link), for the paths seen in the walk
+        self._kinds = {}
+
+    def listdir(self, relpath):
+        """Return the sorted ``(name, is_dir, is_link)`` of the entries of
+        the directory `relpath`.
+        """
+        if relpath not in self._listings:
+            path = os.path.join(self.root, relpath)
+            entries = []
+            try:
+                if scandir is not None:
+                    entries = [(entry.name, entry.is_dir(), entry.is_symlink())
+                               for entry in scandir(path)]
+                else:
+                    for name in os.listdir(path):
+                        entry = os.path.join(path, name)
+                        entries.append((name, os.path.isdir(entry),
+                                        os.path.islink(entry)))
+            except OSError:
+                pass
+            entries.sort()
+            self._listings[relpath] = entries
+            for name, is_dir, is_link in entries:
+                self._kinds[os.path.join(relpath, name)] = (is_dir, is_link)
+        return self._listings[relpath]
+
+    def expand(self, patterns):
+        """Return, for each of the glob `patterns`, the sorted list of the
+        paths matching it, relative to the root.
+        """
+        results = [[] for _pattern in patterns]
+        compiled = []
+        for i, pattern in enumerate(patterns):
+            parts = [part for part in pattern.split('/')
+                     if part not in ('', '.')]
+            if os.path.isabs(pattern) or not parts or '..' in parts:
+                # outside of the tree, leave it to glob
+                paths = glob.glob(os.path.join(self.root, pattern))
+                results[i] = [os.path.relpath(path, self.root)
+                              for path in paths]
+                compiled.append(None)
+            else:
+                compiled.append([_compile_glob_part(part) for part in parts])
+
+        def walk(relpath, depth, active):
+            for name, is_dir, _is_link in self.listdir(relpath):
+                path = os.path.join(relpath, name)
+                deeper = []
+                for i in active:
+                    parts = compiled[i]
+                    if parts[depth](name):
+                        if depth + 1 == len(parts):
+                            results[i].append(path)
+                        elif is_dir:
+                            deeper.append(i)
+                if deeper:
+                    walk(path, depth + 1, deeper)
+
+        walk('', 0, [i for i, parts in enumerate(compiled) if parts])
+        return [sorted(paths) for paths in results]
+
+    def members(self, paths, exclude=()):
+        """Yield the `paths` and, for the directories among them, what they
+        contain (without following links), in the order of
+        :meth:`zpmlib.bundlecache.BundleTarFile.add`. Each path is given
+        once, and the paths in `exclude` are skipped.
+        """
+        seen = set(exclude)
+        for top in paths:
+            stack = [top]
+            while stack:
+                path = stack.pop()
+                if path in seen:
+                    continue
+                seen.add(path)
+                yield path
+                kind = self._kinds.get(path)
+                if kind is None:
+                    full_path = os.path.join(self.root, path)
+                    kind = (os.path.isdir(full_path),
+                            os.path.islink(full_path))
+                is_dir, is_link = kind
+                if is_dir and not is_link:
+                    stack.extend(os.path.join(path, name) for name, _d, _l
+                                 in reversed(self.listdir(path)))
@@ -0,0 +1,212 @@
+#  Copyright 2014 Rackspace, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+"""
+File change notification for ``zpm bundle --watch``.
+
+On Linux, changes are reported by inotify (through :mod:`ctypes`, so no
+extension is needed); elsewhere, or if inotify cannot be used, the files are
+polled.
+"""
+
+import ctypes
+import ctypes.util
+import errno
+import os
+import select
+import struct
+import time
+
+import zpmlib
+
+LOG = zpmlib.get_logger(__name__)
+
+#: Seconds without changes after which a burst of changes is over
+DEBOUNCE_DELAY = 0.2
+#: Seconds between two polls of the files
+POLL_INTERVAL = 0.5
+
+# from <sys/inotify.h>
+_IN_MODIFY = 0x2
+_IN_ATTRIB = 0x4
+_IN_CLOSE_WRITE = 0x8
+_IN_MOVED_FROM = 0x40
+_IN_MOVED_TO = 0x80
+_IN_CREATE = 0x100
+_IN_DELETE = 0x200
+_IN_Q_OVERFLOW = 0x4000
+_IN_IGNORED = 0x8000
+_IN_ISDIR = 0x40000000
+_IN_NONBLOCK = getattr(os, 'O_NONBLOCK', 0)
+_WATCH_MASK = (_IN_MODIFY | _IN_ATTRIB | _IN_CLOSE_WRITE | _IN_MOVED_FROM
+               | _IN_MOVED_TO | _IN_CREATE | _IN_DELETE)
+_EVENT = struct.Struct('iIII')
+
+
+def _hidden(relpath):
+    return any(part.startswith('.') for part in relpath.split(os.sep))
+
+
+class PollingWatcher(object):
+    """Report the changes of the files given by `paths`, a function
+    returning the paths relative to `root` to watch, by polling them.
+    """
+
+    def __init__(self, root, paths, interval=POLL_INTERVAL):
+        self.root = root
+        self.paths = paths
+        self.interval = interval
+        self._state = self._snapshot()
+
+    def _snapshot(self):
+        state = {}
+        for path in self.paths():
+            try:
+                stat = os.stat(os.path.join(self.root, path))
+            except OSError:
+                continue
+            state[path] = (stat.st_mtime, stat.st_size, stat.st_ino)
+        return state
+
+    def wait(self, timeout=None):
+        """Return the set of the paths changed, waiting up to `timeout`
+        seconds (forever if `None`) for one.
+        """
+        deadline = None if timeout is None else time.time() + timeout
+        while True:
+            state = self._snapshot()
+            changed = set(
+                path for path in set(state) | set(self._state)
+                if state.get(path) != self._state.get(path))
+            self._state = state
+            if changed:
+                return changed
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return set()
+                time.sleep(min(self.interval, remaining))
+            else:
+                time.sleep(self.interval)
+
+    def close(self):
+        pass
+
+
+class InotifyWatcher(object):
+    """Report the changes of the files under `root`, except in hidden
+    directories, with inotify. Raises `OSError` if inotify is not available.
+    """
+
+    def __init__(self, root):
+        self.root = root
+        libc_name = ctypes.util.find_library('c')
+        try:
+            libc = ctypes.CDLL(libc_name, use_errno=True)
+            self._add_watch = libc.inotify_add_watch
+            init = libc.inotify_init1
+        except AttributeError:
+            raise OSError(errno.ENOSYS, 'inotify is not available')
+        self._add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p,
+                                    ctypes.c_uint32]
+        self.fd = init(_IN_NONBLOCK)
+        if self.fd < 0:
+            raise OSError(ctypes.get_errno(), 'inotify_init1 failed')
+        # watch descriptor -> directory, relative to the root
+        self._dirs = {}
+        self._watch_tree('')
+
+    def _watch_tree(self, top):
+        for dirpath, dirnames, _filenames in os.walk(
+                os.path.join(self.root, top)):
+            dirnames[:] = [name for name in dirnames
+                           if not name.startswith('.')]
+            relpath = os.path.relpath(dirpath, self.root)
+            if relpath == '.':
+                relpath = ''
+            path = dirpath
+            if not isinstance(path, bytes):
+                path = path.encode('utf-8')
+            wd = self._add_watch(self.fd, path, _WATCH_MASK)
+            if wd < 0:
+                LOG.warning('cannot watch %s: %s', dirpath,
+                            os.strerror(ctypes.get_errno()))
+                continue
+            self._dirs[wd] = relpath
+
+    def wait(self, timeout=None):
+        """Return the set of the paths changed, waiting up to `timeout`
+        seconds (forever if `None`) for one.
+        """
+        readable, _, _ = select.select([self.fd], [], [], timeout)
+        if not readable:
+            return set()
+        try:
+            data = os.read(self.fd, 65536)
+        except OSError as err:
+            if err.errno == errno.EAGAIN:
+                return set()
+            raise
+        changed = set()
+        offset = 0
+        while offset < len(data):
+            wd, mask, _cookie, length = _EVENT.unpack_from(data, offset)
+            offset += _EVENT.size
+            name = data[offset:offset + length].rstrip(b'\0')
+            offset += length
+            if mask & _IN_Q_OVERFLOW:
+                # events were lost, assume everything changed
+                changed.add('')
+                continue
+            if mask & _IN_IGNORED:
+                self._dirs.pop(wd, None)
+                continue
+            if wd not in self._dirs:
+                continue
+            path = os.path.join(self._dirs[wd], name.decode('utf-8'))
+            if _hidden(path):
+                continue
+            if mask & _IN_ISDIR and mask & (_IN_CREATE | _IN_MOVED_TO):
+                self._watch_tree(path)
+            changed.add(path)
+        return changed
+
+    def close(self):
+        os.close(self.fd)
+
+
+def watcher(root, paths, poll=False):
+    """Return an :class:`InotifyWatcher` for `root`, or a
+    :class:`PollingWatcher` of `paths` if `poll` is true or inotify is not
+    available.
+    """
+    if not poll:
+        try:
+            return InotifyWatcher(root)
+        except OSError as err:
+            LOG.info('inotify not available (%s), polling the files', err)
+    return PollingWatcher(root, paths)
+
+
+def wait_changes(watcher, delay=DEBOUNCE_DELAY):
+    """Wait for changes and return them once no more change came for
+    `delay` seconds, so a burst of changes (such as an editor saving a file
+    or a ``git checkout``) is returned at once.
+    """
+    changed = watcher.wait()
+    while True:
+        more = watcher.wait(delay)
+        if not more:
+            return changed
+        changed |= more
@@ -13,13 +13,80 @@
 #  limitations under the License.
 
 
+import contextlib
+import errno
+import fnmatch
+import hashlib
+import json
 import os
+import shlex
+import shutil
 import subprocess
+import tempfile
+try:
+    import fcntl
+except ImportError:
+    # not on Windows
+    fcntl = None
 
 import zpmlib
+from zpmlib import bundlecache
+from zpmlib import bundlestats
 
 LOG = zpmlib.get_logger(__name__)
 _DEFAULT_BUNDLER = 'python'
+#: User-level store of the site-packages built for the Python dependencies
+#: of zapps, shared by all the projects
+DEPS_STORE_DIR = os.path.join('~', '.zpm', 'deps')
+#: Files and directories left out of the bundled dependencies, unless the
+#: zapp.yaml has a ``prune`` list (an empty ``prune`` key keeps them). A
+#: rule is a glob pattern matched against the names inside a dependency or,
+#: if it contains a ``/``, against their path relative to the dependency.
+DEFAULT_PRUNE_RULES = [
+    'test', 'tests', 'doc', 'docs', 'example', 'examples', '__pycache__',
+    '*.dist-info', '*.egg-info', '*.c', '*.h', '*.pyx', '*.pxd',
+    '*.pyc', '*.pyo',
+]
+#: Interpreter compiling the bytecode, it must match the Python run by the
+#: zapps (the bundled dependencies go to lib/python2.7/site-packages)
+PYTHON_INTERPRETER = 'python2.7'
+
+# Run by PYTHON_INTERPRETER: compile the [source, dfile, cfile] read as JSON
+# from stdin, like py_compile but with the given source mtime in the .pyc
+# header, and print the sources which failed to compile as JSON.
+_COMPILE_SCRIPT = """
+import imp, json, marshal, struct, sys
+mtime = struct.pack('<I', int(sys.argv[1]))
+failed = []
+for source, dfile, cfile in json.load(sys.stdin):
+    try:
+        with open(source, 'rU') as fp:
+            code = compile(fp.read() + '\\n', dfile, 'exec')
+    except (SyntaxError, TypeError, ValueError) as err:
+        failed.append([source, str(err)])
+        continue
+    with open(cfile, 'wb') as fp:
+        fp.write(imp.get_magic() + mtime + marshal.dumps(code))
+json.dump(failed, sys.stdout)
+"""
+
+# Run by PYTHON_INTERPRETER: find the modules imported by the scripts and
+# modules read as JSON from stdin, looking for them in the given path, and
+# print their files as JSON.
+_SHAKE_SCRIPT = """
+import json, modulefinder, sys
+job = json.load(sys.stdin)
+finder = modulefinder.ModuleFinder(path=job['path'])
+for script in job['scripts']:
+    finder.run_script(script)
+for name in job['modules']:
+    try:
+        finder.import_hook(name)
+    except ImportError:
+        pass
+json.dump([module.__file__ for module in finder.modules.values()
+           if module.__file__], sys.stdout)
+"""
 
 
 def bundle(working_dir, zapp, tar, **kwargs):
@@ -29,12 +96,34 @@ def bundle(working_dir, zapp, tar, **kwargs):
     )
 
 
-def python_bundler(working_dir, zapp, tar, refresh_deps=False):
-    # First, write the deps for tox to use:
+def python_bundler(working_dir, zapp, tar, refresh_deps=False,
+                   compile_bytecode=False, shake=False, stats=None,
+                   deps_tar=None):
+    """Bundle the Python dependencies of the `zapp` into `deps_tar`, or into
+    `tar` if it is `None`.
+    """
+    if deps_tar is None:
+        deps_tar = tar
     deps = zapp.get('dependencies', [])
-    if len(deps) == 0:
-        # Nothing extra to do
-        return
+    prune_rules = zapp.get('prune')
+    if prune_rules is None:
+        # no rules, or an empty ``prune:`` key
+        prune_rules = DEFAULT_PRUNE_RULES
+    if len(deps) > 0:
+        _python_bundle_deps(working_dir, deps, deps_tar,
+                            refresh_deps=refresh_deps,
+                            prune_rules=prune_rules,
+                            shake_zapp=zapp if shake else None, stats=stats)
+    if compile_bytecode:
+        with bundlestats.timer(stats, 'compile'):
+            _python_compile(tar)
+            if deps_tar is not tar:
+                _python_compile(deps_tar)
+
+
+def _python_bundle_deps(working_dir, deps, tar, refresh_deps=False,
+                        prune_rules=(), shake_zapp=None, stats=None):
+    # First, write the deps for tox to use:
 
     deps_file = os.path.join(working_dir, '.zapp', 'deps.txt')
     with open(deps_file, 'w') as fp:
@@ -50,6 +139,92 @@ def python_bundler(working_dir, zapp, tar, refresh_deps=False):
 
     tox_ini_path = os.path.join(working_dir, '.zapp', 'tox.ini')
 
+    # The site-packages built for a list of dependencies are shared by all
+    # the projects, in a store keyed by the hash of the list (and of the tox
+    # configuration building them).
+    digest = hashlib.sha1()
+    for path in (deps_file, tox_ini_path):
+        with open(path, 'rb') as fp:
+            digest.update(fp.read())
+    site_pkgs = os.path.join(os.path.expanduser(DEPS_STORE_DIR),
+                             digest.hexdigest(), 'site-packages')
+
+    # projects bundled concurrently (zpm bundle --all) wait for the one
+    # fetching the same dependencies, and use them
+    with _store_lock(os.path.dirname(site_pkgs)):
+        if refresh_deps or not os.path.isdir(site_pkgs):
+            with bundlestats.timer(stats, 'deps'):
+                _python_fetch_deps(working_dir, tox_ini_path, site_pkgs,
+                                   refresh_deps=refresh_deps)
+        else:
+            LOG.info("Using cached third party Python dependencies from %s",
+                     site_pkgs)
+
+    reachable = None
+    if shake_zapp is not None:
+        with bundlestats.timer(stats, 'shake'):
+            reachable = _python_shake(working_dir, shake_zapp, site_pkgs)
+
+    modules = os.listdir(site_pkgs)
+    LOG.info("Bundling third party Python dependencies...")
+    total = [0, 0]
+    for dep in deps:
+        # Sometimes a package can install multiple modules, with different
+        # names, or the installed package/module is different from that of the
+        # package name on PyPI.
+        # In this case, we allow the user to specify the module/package names
+        # to grab at bundle time.
+        # For example: ["package_name", "module1", "package1"]
+        # "package_name" is the name of the top-level python package. We would
+        # install this with `pip install package_name`, for example.
+        # If the `setup.py` for this package specifies that "module1" and
+        # "package1" are installed
+        # If the `setup.py` for this package specifies additional `packages` or
+        # `py_modules`, we can specify to zpm to bundle these as well. The
+        # example above will bundle "extramodule1" and "extrapackage1".
+        if isinstance(dep, list):
+            subdeps = dep[1:]
+        else:
+            subdeps = [dep]
+        for subdep in subdeps:
+            bundled, pruned = _python_bundle_dep(working_dir, tar, site_pkgs,
+                                                 modules, subdep,
+                                                 prune_rules=prune_rules,
+                                                 reachable=reachable)
+            total[0] += bundled
+            total[1] += pruned
+    LOG.info("Python dependencies: %d bytes bundled, %d bytes pruned",
+             *total)
+
+
+@contextlib.contextmanager
+def _store_lock(entry_dir):
+    """Hold an exclusive lock on the dependency store entry `entry_dir`
+    (where the platform supports it).
+    """
+    parent = os.path.dirname(entry_dir)
+    if fcntl is None:
+        yield
+        return
+    if not os.path.isdir(parent):
+        try:
+            os.makedirs(parent)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+    with open(entry_dir + '.lock', 'w') as fp:
+        fcntl.flock(fp.fileno(), fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fp.fileno(), fcntl.LOCK_UN)
+
+
+def _python_fetch_deps(working_dir, tox_ini_path, store_dir,
+                       refresh_deps=False):
+    """Install the dependencies with tox and copy the resulting
+    site-packages to `store_dir`.
+    """
     LOG.info("Fetching third party Python dependencies...")
     if refresh_deps:
         tox_cmd = 'tox -r -c %s' % tox_ini_path
@@ -77,37 +252,162 @@ def python_bundler(working_dir, zapp, tar, refresh_deps=False):
         # error with the output:
         raise zpmlib.ZPMException(stdoutdata)
 
-    site_pkgs = os.path.join(
+    venv_site_pkgs = os.path.join(
         working_dir,
         '.zapp/.zapp/venv/lib/python2.7/site-packages'
     )
-    modules = os.listdir(site_pkgs)
-    LOG.info("Bundling third party Python dependencies...")
-    for dep in deps:
-        # Sometimes a package can install multiple modules, with different
-        # names, or the installed package/module is different from that of the
-        # package name on PyPI.
-        # In this case, we allow the user to specify the module/package names
-        # to grab at bundle time.
-        # For example: ["package_name", "module1", "package1"]
-        # "package_name" is the name of the top-level python package. We would
-        # install this with `pip install package_name`, for example.
-        # If the `setup.py` for this package specifies that "module1" and
-        # "package1" are installed
-        # If the `setup.py` for this package specifies additional `packages` or
-        # `py_modules`, we can specify to zpm to bundle these as well. The
-        # example above will bundle "extramodule1" and "extrapackage1".
-        if isinstance(dep, list):
-            for subdep in dep[1:]:
-                _python_bundle_dep(working_dir, tar, site_pkgs, modules,
-                                   subdep)
-        else:
-            _python_bundle_dep(working_dir, tar, site_pkgs, modules, dep)
+    # copy next to the final location and rename, so an interrupted copy is
+    # never taken for a complete one
+    parent = os.path.dirname(store_dir)
+    if not os.path.isdir(parent):
+        try:
+            os.makedirs(parent)
+        except OSError as err:
+            if err.errno != errno.EEXIST:
+                raise
+    partial = tempfile.mkdtemp(dir=parent)
+    try:
+        shutil.copytree(venv_site_pkgs, os.path.join(partial, 'tree'),
+                        symlinks=True)
+        if os.path.isdir(store_dir):
+            shutil.rmtree(store_dir)
+        os.rename(os.path.join(partial, 'tree'), store_dir)
+    finally:
+        shutil.rmtree(partial)
+
+
+def _python_compile(tar):
+    """Add the bytecode of the Python sources added to `tar` so far.
+
+    The sources are compiled by :data:`PYTHON_INTERPRETER`, with their path
+    in the zapp as file name and the mtime of the zapp members in the header,
+    so the interpreter in ZeroVM uses the ``.pyc`` as they are.
+    """
+    names = set(tar.getnames())
+    sources = []
+    for path, arcname in tar.sources:
+        # skip the sources bundled with their bytecode, or twice
+        if arcname.endswith('.py') and arcname + 'c' not in names:
+            sources.append((path, arcname))
+            names.add(arcname + 'c')
+    if not sources:
+        return
+    LOG.info("Compiling %d Python sources...", len(sources))
+    tempdir = tempfile.mkdtemp()
+    try:
+        jobs = [[os.path.abspath(path), '/' + arcname,
+                 os.path.join(tempdir, '%d.pyc' % i)]
+                for i, (path, arcname) in enumerate(sources)]
+        failed = _python_run(_COMPILE_SCRIPT, [str(bundlecache.MTIME)], jobs,
+                             'compile the Python sources')
+        for source, error in failed:
+            # like compileall, ship the source alone
+            LOG.warning("could not compile %s: %s", source, error)
+        for (path, arcname), (_source, _dfile, cfile) in zip(sources, jobs):
+            if os.path.exists(cfile):
+                tar.add(cfile, arcname=arcname + 'c')
+    finally:
+        shutil.rmtree(tempdir)
 
 
-def _python_bundle_dep(working_dir, tar, site_pkgs_dir, modules_list, dep):
-    from zpmlib import zpm
+def _python_run(script, args, data, action):
+    """Run `script` with :data:`PYTHON_INTERPRETER`, giving it `data` as JSON
+    on stdin, and return what it printed as JSON.
+    """
+    try:
+        sp = subprocess.Popen([PYTHON_INTERPRETER, '-c', script] + args,
+                              stdin=subprocess.PIPE, stdout=subprocess.PIPE)
+    except OSError as err:
+        if err.errno != errno.ENOENT:
+            raise
+        raise zpmlib.ZPMException(
+            "%s is needed to %s" % (PYTHON_INTERPRETER, action)
+        )
+    stdoutdata, _stderrdata = sp.communicate(json.dumps(data).encode('utf-8'))
+    if sp.returncode != 0:
+        raise zpmlib.ZPMException(
+            "Failed to %s with %s" % (action, PYTHON_INTERPRETER)
+        )
+    return json.loads(stdoutdata.decode('utf-8'))
 
+
+def _python_entry_scripts(working_dir, zapp):
+    """Return the scripts and modules run by the Python groups of `zapp`."""
+    scripts = []
+    modules = []
+    for group in zapp['execution']['groups']:
+        if not group['path'].split(':')[-1].startswith('python'):
+            continue
+        args = shlex.split(group.get('args') or '')
+        if args[:1] == ['-m'] and len(args) > 1:
+            modules.append(args[1])
+        elif args and args[0].endswith('.py'):
+            script = os.path.join(working_dir, args[0].lstrip('/'))
+            if os.path.isfile(script):
+                scripts.append(script)
+            else:
+                LOG.warning("entry script '%s' of group '%s' not found",
+                            args[0], group.get('name'))
+    return scripts, modules
+
+
+def _python_shake(working_dir, zapp, site_pkgs):
+    """Return the set of files in `site_pkgs` imported, directly or not, by
+    the entry scripts of `zapp` and the modules listed in its
+    ``dynamic_imports``.
+    """
+    scripts, modules = _python_entry_scripts(working_dir, zapp)
+    if not scripts and not modules:
+        raise zpmlib.ZPMException(
+            "No Python entry script found in the 'execution' section of the "
+            "zapp.yaml, cannot find which modules are imported."
+        )
+    # dynamic imports can use glob patterns, expanded over the modules of the
+    # dependencies
+    names = set()
+    for dirpath, dirnames, filenames in os.walk(site_pkgs):
+        dirnames.sort()
+        relpath = os.path.relpath(dirpath, site_pkgs)
+        for filename in sorted(filenames):
+            if filename.endswith('.py'):
+                name = os.path.join(relpath, filename[:-3])
+                if filename == '__init__.py':
+                    name = relpath
+                names.add(os.path.normpath(name).replace(os.sep, '.'))
+    for pattern in zapp.get('dynamic_imports', []):
+        matches = fnmatch.filter(sorted(names), pattern)
+        if not matches and pattern not in names:
+            LOG.warning("dynamic import '%s' matched no module", pattern)
+        modules.extend(matches or [pattern])
+
+    LOG.info("Finding the modules imported by %s...",
+             ', '.join(scripts + modules))
+    files = _python_run(_SHAKE_SCRIPT, [],
+                        dict(path=[working_dir, site_pkgs],
+                             scripts=scripts, modules=modules),
+                        'find the imported modules')
+    return set(os.path.realpath(path) for path in files)
+
+
+def _python_unreachable(path, reachable):
+    """Tell if the Python module or package at `path` is left out by
+    ``--shake``, given the `reachable` files. Other files are kept.
+    """
+    if os.path.isdir(path):
+        init = os.path.join(path, '__init__.py')
+        return os.path.isfile(init) and os.path.realpath(init) not in reachable
+    return path.endswith('.py') and os.path.realpath(path) not in reachable
+
+
+def _python_bundle_dep(working_dir, tar, site_pkgs_dir, modules_list, dep,
+                       prune_rules=(), reachable=None):
+    """Add the module or package `dep` to `tar`, without the files matching
+    `prune_rules` and, if `reachable` is given, without the Python modules
+    and packages not in it.
+
+    :returns:
+        Tuple of the number of bytes bundled and pruned.
+    """
     if dep in modules_list:
         dep_path = os.path.join(site_pkgs_dir, dep)
     elif '%s.py' % dep in modules_list:
@@ -120,7 +420,63 @@ def _python_bundle_dep(working_dir, tar, site_pkgs_dir, modules_list, dep):
         )
     arcname = os.path.join('/lib/python2.7/site-packages',
                            os.path.basename(dep_path))
-    zpm._add_file_to_tar(working_dir, dep_path, tar, arcname=arcname)
+    if reachable is not None and _python_unreachable(dep_path, reachable):
+        LOG.warning("dependency '%s' is not imported, it is left out", dep)
+        return 0, _tree_size(dep_path)
+    LOG.info('adding %s' % dep_path)
+    sizes = [0, 0]
+    _python_add_pruned(tar, dep_path, arcname, '', prune_rules, sizes,
+                       reachable)
+    if sizes[1]:
+        LOG.info("%s: %d bytes bundled, %d bytes pruned (%d%%)", dep,
+                 sizes[0], sizes[1], 100 * sizes[1] // sum(sizes))
+    return tuple(sizes)
+
+
+def _python_add_pruned(tar, path, arcname, relpath, prune_rules, sizes,
+                       reachable=None):
+    if relpath and (_python_prune(relpath, prune_rules)
+                    or (reachable is not None
+                        and _python_unreachable(path, reachable))):
+        sizes[1] += _tree_size(path)
+        return
+    tar.add(path, arcname=arcname, recursive=False)
+    if os.path.isdir(path) and not os.path.islink(path):
+        for entry in sorted(os.listdir(path)):
+            _python_add_pruned(tar, os.path.join(path, entry),
+                               os.path.join(arcname, entry),
+                               os.path.join(relpath, entry),
+                               prune_rules, sizes, reachable)
+    elif not os.path.islink(path):
+        sizes[0] += os.path.getsize(path)
+
+
+def _python_prune(relpath, prune_rules):
+    """
+    >>> _python_prune('tests', ['tests'])
+    True
+    >>> _python_prune('sub/tests', ['tests'])
+    True
+    >>> _python_prune('sub/tests', ['sub/*'])
+    True
+    >>> _python_prune('other/tests', ['sub/*'])
+    False
+    """
+    name = os.path.basename(relpath)
+    for rule in prune_rules:
+        if '/' in rule:
+            if fnmatch.fnmatch(relpath, rule.strip('/')):
+                return True
+        elif fnmatch.fnmatch(name, rule):
+            return True
+    return False
+
+
+def _tree_size(path):
+    if os.path.islink(path) or not os.path.isdir(path):
+        return os.lstat(path).st_size
+    return sum(_tree_size(os.path.join(path, entry))
+               for entry in os.listdir(path))
 
 
 _BUNDLERS = {
@@ -12,14 +12,21 @@
 #  See the License for the specific language governing permissions and
 #  limitations under the License.
 
+import contextlib
 import fnmatch
-import glob
 import gzip
+import itertools
 import json
+import multiprocessing
 import os
+import re
 import shlex
+import shutil
+import subprocess
 import sys
 import tarfile
+import tempfile
+import time
 try:
     import urlparse
 except ImportError:
@@ -36,7 +43,11 @@ import swiftclient
 import yaml
 
 import zpmlib
+from zpmlib import bundlecache
+from zpmlib import bundlestats
+from zpmlib import pgzip
 from zpmlib import util
+from zpmlib import watch
 from zpmlib import zappbundler
 from zpmlib import zapptemplate
 
@@ -48,6 +59,19 @@ LOG = zpmlib.get_logger(__name__)
 BUFFER_SIZE = 65536
 #: path/filename of the system.map (job description) in every zapp
 SYSTEM_MAP_ZAPP_PATH = 'boot/system.map'
+#: Manifest of the files of the ``external`` section, kept out of the zapp
+EXTERNAL_ZAPP_PATH = 'boot/external.json'
+#: Pseudo directory, next to the deployed zapp, of the external files
+EXTERNAL_DIR = '.external'
+#: Characters replaced by ``_`` in the device names of the external files
+EXTERNAL_DEVICE_UNSAFE = re.compile(r'[^A-Za-z0-9_.-]')
+#: Device of the dependency layer of zapps bundled with ``--layered``
+DEPS_DEVICE = 'deps'
+#: Mount point of the dependency layer, whose members are under
+#: ``lib/python2.7/site-packages`` like in the zapp
+DEPS_MOUNT_POINT = '/'
+#: Swift object metadata holding the content digest of a deployed zapp
+ZAPP_DIGEST_HEADER = 'X-Object-Meta-Zapp-Digest'
 
 #: Message displayed if insufficient auth settings are specified, either on the
 #: command line or in environment variables. Shamelessly copied from
@@ -61,6 +85,9 @@ OS_TENANT_NAME OS_TENANT_ID to be set or overridden with --os-auth-url,
 --os-username, --os-password, --os-tenant-name or os-tenant-id. Note:
 adding "-V 2" is necessary for this."""
 
+#: Column labels for the summary table of ``zpm bundle --all``
+BUNDLE_TABLE_HEADER = ['Project', 'Zapp', 'Size', 'Time (s)', 'Status']
+
 #: Column labels for the execution summary table
 EXEC_TABLE_HEADER = [
     'Node',
@@ -258,22 +285,103 @@ def _prepare_job(tar, zapp, zapp_swift_url):
               ],
               'name': 'hello'}]
 
-
+        Each file of the ``external`` section of the `zapp` is added as a
+        read-only device, whose ``path`` is its object in the
+        :attr:`EXTERNAL_DIR` next to the .zapp (see :func:`_deploy_zapp`).
+        Device names cannot hold a ``/``, so the device is named after the
+        path of the file in the project with the characters matching
+        :attr:`EXTERNAL_DEVICE_UNSAFE` replaced by ``_``, and its
+        ``mountpoint`` is that path. So is the dependency layer of a
+        layered zapp, as the :attr:`DEPS_DEVICE` device, which is a tar
+        image mounted at its ``mountpoint``.
     """
     fp = tar.extractfile(SYSTEM_MAP_ZAPP_PATH)
     # NOTE(larsbutler): the `decode` is needed for python3
     # compatibility
     job = json.loads(fp.read().decode('utf-8'))
-    device = {'name': 'image', 'path': zapp_swift_url}
+    devices = [{'name': 'image', 'path': zapp_swift_url}]
+    external_url = '%s/%s' % (zapp_swift_url.rsplit('/', 1)[0], EXTERNAL_DIR)
+    names = set()
+    for entry in _get_external(tar):
+        if 'mountpoint' in entry:
+            name = entry['name']
+            mountpoint = entry['mountpoint']
+        else:
+            name = _external_device_name(entry['name'], names)
+            mountpoint = '/' + entry['name']
+        names.add(name)
+        devices.append({'name': name,
+                        'path': '%s/%s' % (external_url, entry['sha1']),
+                        'mountpoint': mountpoint})
     for group in job:
-        group['devices'].append(device)
+        group['devices'].extend(devices)
 
     return job
 
 
-def bundle_project(root, refresh_deps=False):
+def _external_device_name(path, taken):
+    """Return the device name of the external file at `path`, which is not
+    in the set `taken`.
+
+    >>> _external_device_name('data/model.bin', set())
+    'data_model.bin'
+    >>> _external_device_name('data/model.bin', set(['data_model.bin']))
+    'data_model.bin-1'
+    """
+    base = name = EXTERNAL_DEVICE_UNSAFE.sub('_', path)
+    count = 0
+    while name in taken:
+        count += 1
+        name = '%s-%d' % (base, count)
+    return name
+
+
+def _get_external(tar):
+    """Return the entries of the :attr:`EXTERNAL_ZAPP_PATH` manifest of the
+    zapp `tar`, empty if it has none.
+    """
+    try:
+        fp = tar.extractfile(EXTERNAL_ZAPP_PATH)
+    except KeyError:
+        return []
+    return json.loads(fp.read().decode('utf-8'))
+
+
+def bundle_project(root, refresh_deps=False, jobs=None,
+                   compile_bytecode=False, shake=False, stats=None,
+                   layered=False):
     """
     Bundle the project under root.
+
+    :param int jobs:
+        Number of threads compressing the zapp, defaults to the number of
+        CPUs. See :mod:`zpmlib.pgzip`.
+    :param bool compile_bytecode:
+        Also bundle the bytecode of the Python sources, compiled for the
+        Python in ZeroVM, so it is not compiled again on every run.
+    :param bool shake:
+        Only bundle the modules of the Python dependencies which are
+        imported by the entry scripts of the zapp, or listed in its
+        ``dynamic_imports``.
+    :param stats:
+        Optional :class:`zpmlib.bundlestats.BundleStats` collecting the
+        composition and timings of the bundle.
+    :param bool layered:
+        Bundle the dependencies into a separate zapp, ``<name>.deps.zapp``,
+        which is given to the zapp as the :attr:`DEPS_DEVICE` image, like
+        an external file. Since it only changes with the dependencies, it is
+        not uploaded again when only the code changes.
+
+    Bundling is reproducible: the same project gives the same zapp, whose
+    content digest is stored in it. The compressed members of unchanged files
+    are reused from the previous bundle. The zapp starts with an index of its
+    members, followed by ``boot/system.map`` and ``zapp.yaml``. See
+    :mod:`zpmlib.bundlecache`.
+
+    The files matched by the ``external`` section are not bundled: the
+    zapp only lists their name, size and SHA-1 in
+    :attr:`EXTERNAL_ZAPP_PATH`, and they are uploaded next to it by
+    :func:`_deploy_zapp`.
     """
     zapp_yaml = os.path.join(root, 'zapp.yaml')
     zapp = yaml.safe_load(open(zapp_yaml))
@@ -281,55 +389,326 @@ def bundle_project(root, refresh_deps=False):
     zapp_name = zapp['meta']['name'] + '.zapp'
 
     zapp_tar_path = os.path.join(root, zapp_name)
-    tar = tarfile.open(zapp_tar_path, 'w:gz')
-
-    job = _generate_job_desc(zapp)
-    job_json = json.dumps(job)
-    info = tarfile.TarInfo(name='boot/system.map')
-    # This size is only correct because json.dumps uses
-    # ensure_ascii=True by default and we thus have a 1-1
-    # correspondence between Unicode characters and bytes.
-    info.size = len(job_json)
-
-    LOG.info('adding %s' % info.name)
-    # In Python 3, we cannot use a str or bytes object with addfile,
-    # we need a BytesIO object. In Python 2, BytesIO is just StringIO.
-    # Since json.dumps produces an ASCII-only Unicode string in Python
-    # 3, it is safe to encode it to ASCII.
-    tar.addfile(info, BytesIO(job_json.encode('ascii')))
-    _add_file_to_tar(root, 'zapp.yaml', tar)
-
-    sections = ('bundling', 'ui')
-    # Keep track of the files we add, given the configuration in the zapp.yaml.
-    file_add_count = 0
-    for section in sections:
-        for pattern in zapp.get(section, []):
-            paths = glob.glob(os.path.join(root, pattern))
+    tar = _open_zapp_tar(root, 'zapp.body', 'bundle-cache', jobs=jobs,
+                         stats=stats)
+    deps_tar = None
+    try:
+        job = _generate_job_desc(zapp)
+        job_json = json.dumps(job)
+        info = tarfile.TarInfo(name='boot/system.map')
+        # This size is only correct because json.dumps uses
+        # ensure_ascii=True by default and we thus have a 1-1
+        # correspondence between Unicode characters and bytes.
+        info.size = len(job_json)
+
+        LOG.info('adding %s' % info.name)
+        # In Python 3, we cannot use a str or bytes object with addfile,
+        # we need a BytesIO object. In Python 2, BytesIO is just StringIO.
+        # Since json.dumps produces an ASCII-only Unicode string in Python
+        # 3, it is safe to encode it to ASCII.
+        tar.addfile(info, BytesIO(job_json.encode('ascii')))
+        _add_file_to_tar(root, 'zapp.yaml', tar)
+
+        sections = ('bundling', 'ui', 'external')
+        patterns = [(section, pattern) for section in sections
+                    for pattern in zapp.get(section, [])]
+        # All the patterns are expanded with a single walk of the project.
+        tree = util.TreeGlob(root)
+        with bundlestats.timer(stats, 'glob'):
+            matches = tree.expand([pattern for _section, pattern in patterns])
+        # Keep track of the files we add, given the configuration in the
+        # zapp.yaml.
+        file_add_count = 0
+        bundled = []
+        external = []
+        for (section, pattern), paths in zip(patterns, matches):
             if len(paths) == 0:
                 LOG.warning(
                     "pattern '%(pat)s' in section '%(sec)s' matched no files",
                     dict(pat=pattern, sec=section)
                 )
+            if section == 'external':
+                external.extend(paths)
             else:
-                for path in paths:
-                    _add_file_to_tar(root, path, tar)
                 file_add_count += len(paths)
+                bundled.extend(paths)
+        external = [path for path in tree.members(external)
+                    if os.path.isfile(os.path.join(root, path))]
+        # Overlapping patterns, or a directory and files inside it, match the
+        # same files: add them once.
+        for path in tree.members(bundled,
+                                 exclude=(['zapp.yaml'] + external
+                                          + _bundle_outputs(zapp))):
+            _add_file_to_tar(root, path, tar, recursive=False)
+
+        if file_add_count == 0:
+            # None of the files specified in the "bundling" or "ui" sections
+            # were found. Something is wrong.
+            raise zpmlib.ZPMException(
+                "None of the files specified in the 'bundling' or 'ui' "
+                "sections of the zapp.yaml matched anything."
+            )
 
-    if file_add_count == 0:
-        # None of the files specified in the "bundling" or "ui" sections were
-        # found. Something is wrong.
-        raise zpmlib.ZPMException(
-            "None of the files specified in the 'bundling' or 'ui' sections of"
-            " the zapp.yaml matched anything."
-        )
+        manifest = []
+        for path in external:
+            full_path = os.path.join(root, path)
+            size = os.path.getsize(full_path)
+            with open(full_path, 'rb') as fp:
+                sha1 = tar.cache.content_digest(fp, size)
+            LOG.info('external %s (%d bytes)', path, size)
+            manifest.append({'name': path, 'size': size, 'sha1': sha1})
+
+        # Do template-specific bundling
+        deps_zapp_name = zapp['meta']['name'] + '.deps.zapp'
+        if layered:
+            # not in the stats, whose offsets are those of the zapp
+            deps_tar = _open_zapp_tar(root, 'deps.body', 'deps-cache',
+                                      jobs=jobs)
+        zappbundler.bundle(root, zapp, tar, refresh_deps=refresh_deps,
+                           compile_bytecode=compile_bytecode, shake=shake,
+                           stats=stats, deps_tar=deps_tar)
+        deps_zapp_path = os.path.join(root, deps_zapp_name)
+        if deps_tar is not None and deps_tar.getmembers():
+            _close_zapp_tar(deps_tar, deps_zapp_path)
+            size = os.path.getsize(deps_zapp_path)
+            with open(deps_zapp_path, 'rb') as fp:
+                sha1 = bundlecache.file_digest(fp, size)
+            LOG.info('dependency layer %s (%d bytes)', deps_zapp_name, size)
+            manifest.append({'name': DEPS_DEVICE, 'path': deps_zapp_name,
+                             'size': size, 'sha1': sha1,
+                             'mountpoint': DEPS_MOUNT_POINT})
+            print('created %s' % deps_zapp_name)
+        else:
+            if deps_tar is not None:
+                _close_zapp_tar(deps_tar, None)
+            # a layer of an earlier bundle would be deployed with the zapp
+            if os.path.exists(deps_zapp_path):
+                os.unlink(deps_zapp_path)
+        _add_external_manifest(manifest, tar)
+
+        _close_zapp_tar(tar, zapp_tar_path)
+    finally:
+        # after a failure, stop the compression threads and remove the
+        # partial bodies
+        _abort_zapp_tar(tar)
+        if deps_tar is not None:
+            _abort_zapp_tar(deps_tar)
+    LOG.info('zapp digest: %s', tar.digest.hexdigest())
+    print('created %s' % zapp_name)
+    return zapp_tar_path
+
+
+def _bundle_outputs(zapp):
+    """Return the paths, relative to the project, written by
+    :func:`bundle_project`: the zapps, their partial files and the ``.zapp``
+    directory. They are never bundled, nor watched, themselves.
+    """
+    zapp_name = zapp['meta']['name'] + '.zapp'
+    deps_zapp_name = zapp['meta']['name'] + '.deps.zapp'
+    return [zapp_name, zapp_name + '.tmp', deps_zapp_name,
+            deps_zapp_name + '.tmp', '.zapp']
+
+
+def _open_zapp_tar(root, body_name, cache_name, jobs=None, stats=None):
+    """Return a :class:`zpmlib.bundlecache.BundleTarFile` writing the body
+    of a zapp to `body_name`, with the bundle cache `cache_name`, both in the
+    ``.zapp`` directory of the project.
+    """
+    cache = bundlecache.BundleCache(os.path.join(root, '.zapp', cache_name))
+    # everything but the index, which goes first in the zapp
+    body_file = open(os.path.join(root, '.zapp', body_name), 'wb')
+    gz = pgzip.GzipWriter(body_file, jobs=jobs, stats=stats)
+    return bundlecache.BundleTarFile.open(fileobj=gz, mode='w', cache=cache,
+                                          stats=stats)
 
-    # Do template-specific bundling
-    zappbundler.bundle(root, zapp, tar, refresh_deps=refresh_deps)
+
+def _close_zapp_tar(tar, zapp_path):
+    """Close `tar`, opened by :func:`_open_zapp_tar`, and write its zapp to
+    `zapp_path` (unless it is `None`).
+    """
+    gz = tar.fileobj
+    body_file = gz.fileobj
     tar.close()
-    print('created %s' % zapp_name)
+    gz.close()
+    body_file.close()
+    try:
+        if zapp_path is not None:
+            bundlecache.write_zapp(zapp_path, tar, body_file.name)
+    finally:
+        os.unlink(body_file.name)
+    tar.cache.save()
+
+
+def _abort_zapp_tar(tar):
+    """Discard `tar`, opened by :func:`_open_zapp_tar`, unless
+    :func:`_close_zapp_tar` got to write its zapp: stop the compression
+    threads, and close and remove the partial body.
+    """
+    gz = tar.fileobj
+    body_file = gz.fileobj
+    if body_file.closed:
+        return
+    gz.abort()
+    body_file.close()
+    os.unlink(body_file.name)
+
+
+def _add_external_manifest(manifest, tar):
+    """Add the :attr:`EXTERNAL_ZAPP_PATH` `manifest` to `tar`, unless it is
+    empty.
+    """
+    if not manifest:
+        return
+    data = json.dumps(manifest, sort_keys=True).encode('ascii')
+    info = tarfile.TarInfo(name=EXTERNAL_ZAPP_PATH)
+    info.size = len(data)
+    tar.addfile(info, BytesIO(data))
+
+
+def watch_project(root, on_change=None, poll=False,
+                  delay=watch.DEBOUNCE_DELAY, **kwargs):
+    """Bundle the project under `root`, then again each time the
+    ``zapp.yaml`` or a file matched by its ``bundling`` or ``ui`` patterns
+    changes, until interrupted.
+
+    The other arguments are passed to :func:`bundle_project`, which only
+    compresses the files changed since the previous bundle.
+
+    :param str on_change:
+        Shell command run after each bundle, e.g. to run or deploy the zapp.
+    :param bool poll:
+        Poll the files instead of using inotify.
+    :param float delay:
+        Seconds without changes after which a burst of changes is bundled.
+    """
+    def rebuild():
+        try:
+            bundle_project(root, **kwargs)
+        except Exception as exc:
+            # keep watching, the next change may fix it
+            LOG.error('bundling failed: %s', exc)
+            return
+        finally:
+            # the dependencies are refreshed once at most
+            kwargs['refresh_deps'] = False
+        if on_change:
+            LOG.info('running %s', on_change)
+            subprocess.call(on_change, shell=True, cwd=root)
+
+    watched = _watched_paths(root)
+    watcher = watch.watcher(root, lambda: _watched_paths(root), poll=poll)
+    try:
+        rebuild()
+        while True:
+            changed = watch.wait_changes(watcher, delay)
+            now_watched = _watched_paths(root)
+            # '' means that anything may have changed
+            relevant = '' in changed or changed & (watched | now_watched)
+            watched = now_watched
+            if relevant:
+                LOG.info('changed: %s', ', '.join(sorted(changed)))
+                rebuild()
+    finally:
+        watcher.close()
+
+
+def _watched_paths(root):
+    """Return the set of the paths, relative to `root`, of the ``zapp.yaml``
+    and of the files bundled from the project.
+    """
+    paths = set(['zapp.yaml'])
+    try:
+        with open(os.path.join(root, 'zapp.yaml')) as fp:
+            zapp = yaml.safe_load(fp)
+        patterns = (zapp.get('bundling', []) + zapp.get('ui', [])
+                    + zapp.get('external', []))
+        # the zapp itself changes on every bundle
+        exclude = _bundle_outputs(zapp)
+    except Exception:
+        # wait for a valid zapp.yaml
+        return paths
+    tree = util.TreeGlob(root)
+    paths.update(tree.members(itertools.chain(*tree.expand(patterns)),
+                              exclude=exclude))
+    return paths
+
+
+def find_projects(top):
+    """Return the sorted directories under `top` (included) containing a
+    ``zapp.yaml`` file. Hidden directories, such as ``.zapp`` or ``.git``,
+    are skipped.
+    """
+    projects = []
+    for dirpath, dirnames, filenames in os.walk(top):
+        dirnames[:] = sorted(name for name in dirnames
+                             if not name.startswith('.'))
+        if 'zapp.yaml' in filenames:
+            projects.append(dirpath)
+    return projects
+
+
+def bundle_all(top, processes=None, **kwargs):
+    """Bundle all the projects found under `top` by :func:`find_projects`,
+    in a pool of `processes` processes (defaults to the number of CPUs).
+
+    The other arguments are passed to :func:`bundle_project`. A project
+    failing to bundle does not stop the others.
+
+    :returns:
+        List of `dict` with the ``project`` directory, and either the
+        ``zapp`` path, its ``size`` and the ``time`` it took to bundle, or
+        the ``error`` message, for each project.
+    """
+    projects = find_projects(top)
+    if not projects:
+        raise zpmlib.ZPMException("no zapp.yaml file found under %s" % top)
+    jobs = [(project, kwargs) for project in projects]
+    if processes == 1 or len(projects) == 1:
+        return [_bundle_worker(job) for job in jobs]
+    pool = multiprocessing.Pool(processes)
+    try:
+        return pool.map(_bundle_worker, jobs, chunksize=1)
+    finally:
+        pool.close()
+        pool.join()
+
+
+def _bundle_worker(job):
+    root, kwargs = job
+    result = {'project': root}
+    start = time.time()
+    try:
+        zapp_path = bundle_project(root, **kwargs)
+    except Exception as exc:
+        LOG.error('bundling %s failed: %s', root, exc)
+        result['error'] = str(exc) or exc.__class__.__name__
+    else:
+        result['zapp'] = zapp_path
+        result['size'] = os.path.getsize(zapp_path)
+    result['time'] = time.time() - start
+    return result
 
 
-def _add_file_to_tar(root, path, tar, arcname=None):
+def _get_bundle_table(results):
+    """Return a ``prettytable.PrettyTable`` summing up the results of
+    :func:`bundle_all`.
+    """
+    table = prettytable.PrettyTable(BUNDLE_TABLE_HEADER)
+    table.align['Project'] = 'l'
+    table.align['Zapp'] = 'l'
+    for result in results:
+        if 'error' in result:
+            status = 'error: %s' % result['error']
+            zapp, size = '', ''
+        else:
+            status = 'ok'
+            zapp, size = os.path.basename(result['zapp']), result['size']
+        table.add_row([result['project'], zapp, size,
+                       '%.3f' % result['time'], status])
+    return table
+
+
+def _add_file_to_tar(root, path, tar, arcname=None, recursive=True):
     """
     :param root:
         Root working directory.
@@ -337,6 +716,8 @@ def _add_file_to_tar(root, path, tar, arcname=None):
         File path.
     :param tar:
         Open :class:`tarfile.TarFile` object to add the ``files`` to.
+    :param bool recursive:
+        If `path` is a directory, also add its content.
     """
     # TODO(larsbutler): document ``arcname``
     LOG.info('adding %s' % path)
@@ -345,7 +726,7 @@ def _add_file_to_tar(root, path, tar, arcname=None):
     if arcname is None:
         # In the archive, give the file the same name and path.
         arcname = relpath
-    tar.add(path, arcname=arcname)
+    tar.add(path, arcname=arcname, recursive=recursive)
 
 
 def _find_ui_uploads(zapp, tar):
@@ -480,40 +861,173 @@ def _deploy_zapp(conn, target, zapp_path, auth_opts, force=False):
 
     # If we get here, everything with the container is fine.
     index = target + '/'
-    uploads = _generate_uploads(conn, target, zapp_path, auth_opts)
+    remote_zapp_path = None
+    zapp_index = None
+    if zapp_path is not None:
+        remote_zapp_path = '%s/%s' % (target, os.path.basename(zapp_path))
+        zapp_index = bundlecache.read_index(zapp_path)
+    zapp_digest = _get_zapp_digest(zapp_index)
+    zapp_size = _get_zapp_tar_size(zapp_index)
+    external_prefix = '%s/%s/' % (target, EXTERNAL_DIR)
+    uploads = _generate_uploads(conn, target, zapp_path, auth_opts,
+                                zapp_index)
     for path, data, content_type in uploads:
         if path.endswith('/index.html'):
             index = path
         container, obj = path.split('/', 1)
-        conn.put_object(container, obj, data, content_type=content_type)
+        if path.startswith(external_prefix):
+            # content addressed: an existing object has the same content
+            if _object_exists(conn, container, obj):
+                LOG.info('%s is already uploaded, skipping it', data.name)
+                continue
+            sha1 = path[len(external_prefix):]
+            # the digest is that of the file, even for a decompressed image
+            fp = getattr(data, 'fileobj', data)
+            size = os.fstat(fp.fileno()).st_size
+            if bundlecache.file_digest(fp, size) != sha1:
+                raise zpmlib.ZPMException(
+                    '%s changed since it was bundled, bundle the zapp again'
+                    % data.name)
+            if fp is not data:
+                size = _get_zapp_tar_size(bundlecache.read_index(data.name))
+            conn.put_object(container, obj, data, content_length=size,
+                            content_type=content_type)
+        elif path == remote_zapp_path and zapp_digest is not None:
+            if _get_remote_zapp_digest(conn, container, obj) == zapp_digest:
+                LOG.info('%s is unchanged, skipping its upload', path)
+                continue
+            conn.put_object(container, obj, data, content_length=zapp_size,
+                            content_type=content_type,
+                            headers={ZAPP_DIGEST_HEADER: zapp_digest})
+        else:
+            conn.put_object(container, obj, data, content_type=content_type)
     return index
 
 
-def _generate_uploads(conn, target, zapp_path, auth_opts):
-    """Generate sequence of (container-and-file-path, data, content-type)
-    tuples.
+def _get_zapp_digest(index):
+    """Return the content digest recorded by :func:`bundle_project` in the
+    zapp `index` (see :func:`zpmlib.bundlecache.read_index`), or `None` for
+    zapps without an index.
     """
-    tar = tarfile.open(zapp_path, 'r:gz')
-    zapp_config = yaml.safe_load(tar.extractfile('zapp.yaml'))
+    if index is None:
+        return None
+    return index['digest']
+
 
+def _get_zapp_tar_size(index):
+    """Return the size of the decompressed zapp, computed from its `index`
+    written by :func:`bundle_project`, or `None` for zapps without an index.
+    """
+    if index is None:
+        return None
+    # the index member is put in front of the tar stream of the others,
+    # which ends with the end of archive marker, padded to a whole record
+    start = min(member['offset'] for member in index['members'])
+    end = start
+    for member in index['members']:
+        blocks = -(-member['size'] // tarfile.BLOCKSIZE)
+        end = max(end, member['offset_data'] + blocks * tarfile.BLOCKSIZE)
+    size = end - start + 2 * tarfile.BLOCKSIZE
+    return start + -(-size // tarfile.RECORDSIZE) * tarfile.RECORDSIZE
+
+
+def _get_remote_zapp_digest(conn, container, obj):
+    try:
+        headers = conn.head_object(container, obj)
+    except swiftclient.exceptions.ClientException:
+        return None
+    return headers.get(ZAPP_DIGEST_HEADER.lower())
+
+
+def _object_exists(conn, container, obj):
+    try:
+        conn.head_object(container, obj)
+    except swiftclient.exceptions.ClientException:
+        return False
+    return True
+
+
+def _generate_uploads(conn, target, zapp_path, auth_opts, index):
+    """Generate sequence of (container-and-file-path, data, content-type)
+    tuples. `index` is the index of the zapp, as returned by
+    :func:`zpmlib.bundlecache.read_index`.
+
+    The data of the zapp (decompressed) and of its external files, read from
+    its directory, is a file object to stream to Swift, which must be read
+    before the next tuple is generated. The external files with a
+    ``mountpoint``, such as the dependency layer, are zapps too: they are
+    decompressed, as a :class:`gzip.GzipFile` over the file, so ZeroCloud
+    can mount them.
+
+    The zapp is decompressed once, while it is uploaded: the ``zapp.yaml``,
+    ``boot/system.map`` and UI files are kept as the upload reads past them
+    (see :class:`zpmlib.bundlecache.ZappStream`). Zapps without an index are
+    read again for each of them.
+    """
     remote_zapp_path = '%s/%s' % (target, os.path.basename(zapp_path))
     swift_url = _get_swift_zapp_url(conn.url, remote_zapp_path)
-    job = _prepare_job(tar, zapp_config, swift_url)
 
-    yield (remote_zapp_path, gzip.open(zapp_path).read(), 'application/x-tar')
-    yield ('%s/%s' % (target, SYSTEM_MAP_ZAPP_PATH), json.dumps(job),
-           'application/json')
+    if index is None:
+        tar = tarfile.open(zapp_path, 'r:gz')
+        zapp_file = gzip.open(zapp_path)
+    else:
+        tar = zapp_file = bundlecache.ZappStream(zapp_path, index)
+        tar.want('zapp.yaml', lambda data: _want_ui_uploads(tar, data))
+        tar.want(SYSTEM_MAP_ZAPP_PATH)
+        if EXTERNAL_ZAPP_PATH in tar.getnames():
+            tar.want(EXTERNAL_ZAPP_PATH)
 
-    for path in _find_ui_uploads(zapp_config, tar):
-        output = tar.extractfile(path).read()
-        if path.endswith('.tmpl'):
-            tmpl = jinja2.Template(output.decode('utf-8'))
-            output = tmpl.render(auth_opts=auth_opts, zapp=zapp_config)
-            # drop the .tmpl extension
-            path = os.path.splitext(path)[0]
+    try:
+        yield (remote_zapp_path, zapp_file, 'application/x-tar')
+        if index is not None:
+            # the upload was skipped, or did not read up to the end
+            zapp_file.drain()
+
+        zapp_config = yaml.safe_load(tar.extractfile('zapp.yaml'))
+        job = _prepare_job(tar, zapp_config, swift_url)
+        yield ('%s/%s' % (target, SYSTEM_MAP_ZAPP_PATH), json.dumps(job),
+               'application/json')
+
+        for path in _find_ui_uploads(zapp_config, tar):
+            output = tar.extractfile(path).read()
+            if path.endswith('.tmpl'):
+                tmpl = jinja2.Template(output.decode('utf-8'))
+                output = tmpl.render(auth_opts=auth_opts, zapp=zapp_config)
+                # drop the .tmpl extension
+                path = os.path.splitext(path)[0]
+
+            ui_path = '%s/%s' % (target, path)
+            yield (ui_path, output, None)
+
+        project_dir = os.path.dirname(os.path.abspath(zapp_path))
+        for entry in _get_external(tar):
+            path = os.path.join(project_dir,
+                                entry.get('path', entry['name']))
+            try:
+                fp = open(path, 'rb')
+            except IOError as exc:
+                raise zpmlib.ZPMException(
+                    'Cannot open external file %s: %s' % (path, exc))
+            with fp:
+                external_path = '%s/%s/%s' % (target, EXTERNAL_DIR,
+                                              entry['sha1'])
+                if 'mountpoint' in entry:
+                    with contextlib.closing(gzip.GzipFile(fileobj=fp)) as gz:
+                        yield (external_path, gz, 'application/x-tar')
+                else:
+                    yield (external_path, fp, 'application/octet-stream')
+    finally:
+        zapp_file.close()
+        if tar is not zapp_file:
+            tar.close()
 
-        ui_path = '%s/%s' % (target, path)
-        yield (ui_path, output, None)
+
+def _want_ui_uploads(stream, zapp_yaml):
+    """Keep the UI files of the ``zapp.yaml`` content `zapp_yaml` from the
+    :class:`zpmlib.bundlecache.ZappStream` `stream`.
+    """
+    for path in _find_ui_uploads(yaml.safe_load(zapp_yaml), stream):
+        stream.want(path)
 
 
 def _prepare_auth(version, args, conn):
@@ -765,6 +1279,7 @@ def execute(args, response_body_buffer=None):
         LOG.debug('RESP STATUS: %s %s', resp['status'], resp['reason'])
         LOG.debug('RESP HEADERS: %s', resp['headers'])
     else:
+        _check_no_external(args.zapp)
         size = os.path.getsize(args.zapp)
         zapp_file = open(args.zapp, 'rb')
         data_reader = iter(lambda: zapp_file.read(BUFFER_SIZE), b'')
@@ -774,6 +1289,99 @@ def execute(args, response_body_buffer=None):
     return resp
 
 
+def _check_no_external(zapp_path):
+    """Raise a `ZPMException` if the zapp has external files, or is a
+    layered zapp, whose dependency layer is external too: they are only
+    available to a deployed zapp.
+    """
+    try:
+        index = bundlecache.read_index(zapp_path)
+    except (IOError, tarfile.TarError):
+        # reported when the zapp is used
+        return
+    if index is None:
+        return
+    if not any(member['name'] == EXTERNAL_ZAPP_PATH
+               for member in index['members']):
+        return
+    tar = tarfile.open(zapp_path, 'r:gz')
+    try:
+        layers = [entry['path'] for entry in _get_external(tar)
+                  if 'path' in entry]
+    finally:
+        tar.close()
+    if layers:
+        raise zpmlib.ZPMException(
+            '%s is a layered zapp, its dependency layer %s is only mounted'
+            ' when it is deployed: bundle it without --layered to run it'
+            ' here, or deploy it to run it: zpm deploy --execute'
+            % (zapp_path, ', '.join(layers)))
+    raise zpmlib.ZPMException(
+        '%s has external files, deploy it to run it: zpm deploy'
+        ' --execute' % zapp_path)
+
+
+def run_local(args):
+    """Run a zapp on the local machine with ``zvapp``, without deploying it.
+
+    The ``boot/system.map`` of the zapp is given the zapp itself as its
+    ``image`` device (like :func:`_prepare_job` does with the deployed
+    zapp), decompressed to a temporary tar file as ZeroVM only mounts plain
+    tar images, and ``swift://`` paths are mapped to the ``args.swift_dir``
+    directory.
+
+    :returns:
+        Tuple of a `dict` with the ``headers`` of the run, like the response
+        of :func:`execute`, and the output of the job (`bytes`).
+    """
+    zapp_path = os.path.abspath(args.zapp)
+    _check_no_external(zapp_path)
+    try:
+        tar = tarfile.open(zapp_path, 'r:gz')
+    except (IOError, tarfile.ReadError) as exc:
+        raise zpmlib.ZPMException('Cannot open %s: %s' % (args.zapp, exc))
+    try:
+        fp = tar.extractfile(SYSTEM_MAP_ZAPP_PATH)
+    except KeyError:
+        raise zpmlib.ZPMException('Could not find %s in %s'
+                                  % (SYSTEM_MAP_ZAPP_PATH, args.zapp))
+    job = json.loads(fp.read().decode('utf-8'))
+    tar.close()
+    for group in job:
+        group['devices'].append({'name': 'image'})
+
+    tempdir = tempfile.mkdtemp()
+    try:
+        job_file = os.path.join(tempdir, 'system.map')
+        with open(job_file, 'w') as fp:
+            json.dump(job, fp)
+        image_file = os.path.join(tempdir, 'image.tar')
+        zapp_file = gzip.open(zapp_path)
+        try:
+            with open(image_file, 'wb') as fp:
+                shutil.copyfileobj(zapp_file, fp, BUFFER_SIZE)
+        finally:
+            zapp_file.close()
+        summary_file = os.path.join(tempdir, 'summary.json')
+        cmd = [args.zvapp, '--image', image_file,
+               '--swift-account-path', os.path.abspath(args.swift_dir),
+               '--summary-out', summary_file, job_file]
+        LOG.debug('running %s', ' '.join(cmd))
+        try:
+            proc = subprocess.Popen(cmd, stdout=subprocess.PIPE)
+        except OSError as exc:
+            raise zpmlib.ZPMException('Cannot run %s: %s' % (args.zvapp, exc))
+        output = proc.communicate()[0]
+        if proc.returncode != 0:
+            raise zpmlib.ZPMException('%s exited with status %d'
+                                      % (args.zvapp, proc.returncode))
+        with open(summary_file) as fp:
+            headers = json.load(fp)
+    finally:
+        shutil.rmtree(tempdir)
+    return {'headers': headers}, output
+
+
 def auth(args):
     conn = _get_zerocloud_conn(args)
     conn.authenticate()
@@ -0,0 +1,569 @@
+#  Copyright 2014 Rackspace, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+import json
+import mock
+import os
+import re
+import shutil
+import tempfile
+import time
+
+from zvshlib import zvapp
+
+
+READABLE = 1
+WRITABLE = 2
+CDR = 4
+
+
+def _write(path, data=b''):
+    if not os.path.isdir(os.path.dirname(path)):
+        os.makedirs(os.path.dirname(path))
+    with open(path, 'wb') as fd:
+        fd.write(data)
+
+
+def _touch_dir(path, mtime):
+    # directory mtimes may not change within the timestamp granularity of
+    # the filesystem, set them explicitly
+    os.utime(path, (mtime, mtime))
+
+
+class TestMaskLiteralPrefix:
+    """
+    Tests for :func:`zvshlib.zvapp.mask_literal_prefix`.
+    """
+
+    def test_literal(self):
+        assert zvapp.mask_literal_prefix(re.compile('^data/part-1$')) == \
+            'data/part-1'
+
+    def test_wildcard(self):
+        mask = re.compile('data/part-.*\\.txt')
+        assert zvapp.mask_literal_prefix(mask) == 'data/part-'
+
+    def test_escaped_chars(self):
+        mask = re.compile('data\\.v1\\-.*')
+        assert zvapp.mask_literal_prefix(mask) == 'data.v1-'
+
+    def test_escaped_class(self):
+        # \d is not a literal character
+        mask = re.compile('part\\d+')
+        assert zvapp.mask_literal_prefix(mask) == 'part'
+
+    def test_optional_last_char(self):
+        for pattern in ('parts?', 'parts*', 'parts{0,1}'):
+            assert zvapp.mask_literal_prefix(re.compile(pattern)) == 'part'
+
+    def test_no_prefix(self):
+        assert zvapp.mask_literal_prefix(re.compile('a|b')) == ''
+        assert zvapp.mask_literal_prefix(re.compile('data',
+                                                    re.IGNORECASE)) == ''
+        assert zvapp.mask_literal_prefix(re.compile('.*')) == ''
+        assert zvapp.mask_literal_prefix(None) == ''
+
+
+class TestListingIndex:
+    """
+    Tests for :class:`zvshlib.zvapp.ListingIndex`.
+    """
+
+    def setup_method(self, _method):
+        self.tempdir = tempfile.mkdtemp()
+        self.top = os.path.join(self.tempdir, 'container')
+        self.cache_file = os.path.join(self.tempdir, 'cache', 'index')
+        _write(os.path.join(self.top, 'b'))
+        _write(os.path.join(self.top, 'a', 'y'))
+        _write(os.path.join(self.top, 'a', 'x'))
+        # out of the racy window, so the index trusts the mtimes
+        self.mtime = time.time() - 60
+        _touch_dir(os.path.join(self.top, 'a'), self.mtime)
+        _touch_dir(self.top, self.mtime)
+
+    def teardown_method(self, _method):
+        shutil.rmtree(self.tempdir)
+
+    def test_build(self):
+        index = zvapp.ListingIndex(self.top)
+        index.refresh()
+        assert index.names == ['a/x', 'a/y', 'b']
+        assert sorted(index.dirs) == ['', 'a']
+
+    def test_build_not_recursive(self):
+        index = zvapp.ListingIndex(self.top, recursive=False)
+        index.refresh()
+        assert sorted(index.names) == ['a', 'b']
+        assert list(index.dirs) == ['']
+
+    def test_symlinks(self):
+        os.symlink(os.path.join(self.top, 'a'), os.path.join(self.top, 'l'))
+        # containers may be symlinks in an account
+        index = zvapp.ListingIndex(self.top, recursive=False)
+        index.refresh()
+        assert sorted(index.names) == sorted(os.listdir(self.top))
+        # but they are not followed, like by os.walk()
+        index = zvapp.ListingIndex(self.top)
+        index.refresh()
+        assert index.names == ['a/x', 'a/y', 'b']
+
+    def test_match(self):
+        index = zvapp.ListingIndex(self.top)
+        index.refresh()
+        assert index.match() == ['a/x', 'a/y', 'b']
+        assert index.match(re.compile('a/.*')) == ['a/x', 'a/y']
+        assert index.match(re.compile('.*y')) == ['a/y']
+        assert index.match(re.compile('c.*')) == []
+
+    def test_match_checks_prefix_range_only(self):
+        index = zvapp.ListingIndex(self.top)
+        index.refresh()
+        mask = mock.Mock(pattern='a/.*', flags=0)
+        mask.match.return_value = True
+        assert index.match(mask) == ['a/x', 'a/y']
+        assert mask.match.call_count == 2
+
+    def test_fresh(self):
+        index = zvapp.ListingIndex(self.top)
+        assert not index.is_fresh()
+        index.refresh()
+        assert index.is_fresh()
+        with mock.patch.object(index, 'build') as build:
+            index.refresh()
+        assert not build.called
+
+    def test_refresh_checks_once(self):
+        index = zvapp.ListingIndex(self.top)
+        index.refresh()
+        with mock.patch.object(index, 'is_fresh') as is_fresh:
+            index.refresh()
+            index.refresh()
+        assert not is_fresh.called
+
+    def test_stale_after_change(self):
+        index = zvapp.ListingIndex(self.top, self.cache_file)
+        index.refresh()
+        _write(os.path.join(self.top, 'a', 'z'))
+        _touch_dir(os.path.join(self.top, 'a'), self.mtime + 10)
+        assert not index.is_fresh()
+        # next job
+        index = zvapp.ListingIndex(self.top, self.cache_file)
+        index.refresh()
+        assert index.names == ['a/x', 'a/y', 'a/z', 'b']
+
+    def test_stale_after_removed_dir(self):
+        index = zvapp.ListingIndex(self.top, self.cache_file)
+        index.refresh()
+        shutil.rmtree(os.path.join(self.top, 'a'))
+        assert not index.is_fresh()
+        index = zvapp.ListingIndex(self.top, self.cache_file)
+        index.refresh()
+        assert index.names == ['b']
+
+    def test_racy_mtime(self):
+        # changed in the same tick as the scan, the mtime does not move
+        now = time.time()
+        _touch_dir(os.path.join(self.top, 'a'), now)
+        index = zvapp.ListingIndex(self.top, self.cache_file)
+        index.refresh()
+        assert index.dirs['a'] is None
+        assert index.dirs[''] == self.mtime
+        _write(os.path.join(self.top, 'a', 'z'))
+        _touch_dir(os.path.join(self.top, 'a'), now)
+        assert not index.is_fresh()
+        index = zvapp.ListingIndex(self.top, self.cache_file)
+        index.refresh()
+        assert index.names == ['a/x', 'a/y', 'a/z', 'b']
+
+    def test_cache_file(self):
+        index = zvapp.ListingIndex(self.top, self.cache_file)
+        index.refresh()
+        assert os.path.isfile(self.cache_file)
+        loaded = zvapp.ListingIndex(self.top, self.cache_file)
+        with mock.patch.object(loaded, 'build') as build:
+            loaded.refresh()
+        assert not build.called
+        assert loaded.names == ['a/x', 'a/y', 'b']
+
+    def test_cache_file_other_top(self):
+        index = zvapp.ListingIndex(self.top, self.cache_file)
+        index.refresh()
+        other = zvapp.ListingIndex(os.path.join(self.top, 'a'),
+                                   self.cache_file)
+        other.refresh()
+        assert other.names == ['x', 'y']
+
+    def test_cache_file_corrupt(self):
+        _write(self.cache_file, b'garbage')
+        index = zvapp.ListingIndex(self.top, self.cache_file)
+        index.refresh()
+        assert index.names == ['a/x', 'a/y', 'b']
+
+    def test_invalidate(self):
+        index = zvapp.ListingIndex(self.top, self.cache_file)
+        index.refresh()
+        index.invalidate()
+        assert not index.is_fresh()
+        assert not os.path.exists(self.cache_file)
+        with mock.patch.object(index, 'build') as build:
+            index.refresh()
+        assert build.called
+
+
+class TestTraceRecorder:
+    """
+    Tests for :class:`zvshlib.zvapp.TraceRecorder`.
+    """
+
+    def setup_method(self, _method):
+        self.tempdir = tempfile.mkdtemp()
+
+    def teardown_method(self, _method):
+        shutil.rmtree(self.tempdir)
+
+    def test_tracks(self):
+        trace = zvapp.TraceRecorder()
+        assert trace.track_id('node-1') == 1
+        assert trace.track_id('node-2') == 2
+        assert trace.track_id('node-1') == 1
+        names = [e['args']['name'] for e in trace.events
+                 if e['name'] == 'thread_name']
+        assert names == ['zvapp', 'node-1', 'node-2']
+
+    def test_events(self):
+        trace = zvapp.TraceRecorder()
+        trace.origin = 100.0
+        trace.complete('run', 101.0, 101.5, track='node-1', args={'x': 1})
+        trace.instant('up to date', 102.0)
+        complete, instant = trace.events[-2:]
+        assert complete['ph'] == 'X'
+        assert complete['ts'] == 1000000
+        assert complete['dur'] == 500000
+        assert complete['tid'] == 1
+        assert complete['args'] == {'x': 1}
+        assert instant['ph'] == 'i'
+        assert instant['ts'] == 2000000
+        assert instant['tid'] == 0
+        assert 'args' not in instant
+
+    def test_dump(self):
+        trace = zvapp.TraceRecorder()
+        trace.complete('parse', trace.origin)
+        file_name = os.path.join(self.tempdir, 'trace.json')
+        trace.dump(file_name)
+        with open(file_name) as fd:
+            data = json.load(fd)
+        assert data['displayTimeUnit'] == 'ms'
+        assert data['traceEvents'][-1]['name'] == 'parse'
+
+
+class TestShardBoundaries:
+    """
+    Tests for :func:`zvshlib.zvapp.shard_boundaries`.
+    """
+
+    def _shards(self, data, count, delimiter=b'\n'):
+        return [data[start:end] for start, end in
+                zvapp.shard_boundaries(data, len(data), count, delimiter)]
+
+    def test_whole_records(self):
+        data = b'a\nbb\nccc\nd\n'
+        assert self._shards(data, 3) == [b'a\nbb\n', b'ccc\n', b'd\n']
+
+    def test_covers_data(self):
+        data = b''.join(('%d\n' % i).encode('ascii') for i in range(1000))
+        for count in (1, 2, 7, 64):
+            shards = zvapp.shard_boundaries(data, len(data), count)
+            assert len(shards) <= count
+            assert shards[0][0] == 0
+            assert shards[-1][1] == len(data)
+            for (_, end), (start, _) in zip(shards, shards[1:]):
+                assert end == start
+            for start, end in shards:
+                assert data[end - 1:end] == b'\n'
+
+    def test_boundary_on_delimiter(self):
+        # the nominal boundary falls right after a delimiter
+        assert self._shards(b'ab\ncd\n', 2) == [b'ab\n', b'cd\n']
+
+    def test_more_shards_than_records(self):
+        assert self._shards(b'a\nb\n', 10) == [b'a\n', b'b\n']
+
+    def test_no_trailing_delimiter(self):
+        assert self._shards(b'aaaa\nbb', 2) == [b'aaaa\n', b'bb']
+
+    def test_no_delimiter(self):
+        assert self._shards(b'abcdef', 3) == [b'abcdef']
+
+    def test_multibyte_delimiter(self):
+        data = b'ab\r\ncd\r\nef\r\n'
+        assert self._shards(data, 3, b'\r\n') == [b'ab\r\n', b'cd\r\n',
+                                                  b'ef\r\n']
+
+
+class TestMergeSortedFiles:
+    """
+    Tests for :func:`zvshlib.zvapp.merge_sorted_files`.
+    """
+
+    def setup_method(self, _method):
+        self.tempdir = tempfile.mkdtemp()
+
+    def teardown_method(self, _method):
+        shutil.rmtree(self.tempdir)
+
+    def _merge(self, *contents):
+        sources = []
+        for i, data in enumerate(contents):
+            sources.append(os.path.join(self.tempdir, 'in-%d' % i))
+            _write(sources[-1], data)
+        destination = os.path.join(self.tempdir, 'out')
+        zvapp.merge_sorted_files(sources, destination)
+        with open(destination, 'rb') as fd:
+            return fd.read()
+
+    def test_merge(self):
+        assert self._merge(b'a\nd\ng\n', b'b\ne\n', b'c\nf\nh\n') == \
+            b'a\nb\nc\nd\ne\nf\ng\nh\n'
+
+    def test_byte_order(self):
+        assert self._merge(b'B\nb\n', b'A\na\n') == b'A\nB\na\nb\n'
+
+    def test_duplicates(self):
+        assert self._merge(b'a\nb\n', b'a\nb\n') == b'a\na\nb\nb\n'
+
+    def test_missing_trailing_newline(self):
+        assert self._merge(b'a\nc', b'b\nd') == b'a\nb\nc\nd\n'
+
+    def test_empty(self):
+        assert self._merge(b'', b'a\n') == b'a\n'
+        assert self._merge() == b''
+
+
+class TestEncodeNode:
+    """
+    Tests for :func:`zvshlib.zvapp.encode_node`.
+    """
+
+    def test_encode(self):
+        class Channel(object):
+            def __init__(self, device):
+                self.device = device
+
+        class Encoder(json.JSONEncoder):
+            def default(self, o):
+                if isinstance(o, Channel):
+                    return {'device': o.device}
+                return json.JSONEncoder.default(self, o)
+
+        node = {'name': 'node', 'replicate': 1, 'args': None,
+                'channels': (Channel('stdin'), Channel('stdout')),
+                'env': {'A': 1.5, 'B': True}}
+        encoded = zvapp.encode_node(node, Encoder())
+        assert encoded == json.loads(json.dumps(node, cls=Encoder))
+
+
+class TestBuildState:
+    """
+    Tests for :class:`zvshlib.zvapp.BuildState`.
+    """
+
+    def setup_method(self, _method):
+        self.tempdir = tempfile.mkdtemp()
+        self.state_file = os.path.join(self.tempdir, 'state', 'job')
+        self.input = os.path.join(self.tempdir, 'input')
+        self.output = os.path.join(self.tempdir, 'output')
+        self.exe = os.path.join(self.tempdir, 'exe')
+        self.report = os.path.join(self.tempdir, 'report')
+        self.response = os.path.join(self.tempdir, 'response')
+        _write(self.input, b'input')
+        _write(self.output, b'output')
+        _write(self.exe, b'nexe')
+        _write(self.report, b'0\n0\n0\n\n\n')
+        _write(self.response, b'response')
+
+    def teardown_method(self, _method):
+        shutil.rmtree(self.tempdir)
+
+    def _state(self):
+        return zvapp.BuildState(self.state_file, READABLE | CDR, WRITABLE,
+                                lambda node_config: self.exe)
+
+    def _node(self, name='node', input_path=None, output_path=None,
+              **extra):
+        node = {
+            'name': name,
+            'exe': 'swift://a/c/exe',
+            'args': 'x',
+            'channels': [
+                {'device': 'stdin', 'path': 'swift://a/c/input',
+                 'access': READABLE, 'lpath': input_path or self.input},
+                {'device': 'stdout', 'path': 'swift://a/c/output',
+                 'access': WRITABLE, 'lpath': output_path or self.output},
+            ],
+        }
+        node.update(extra)
+        return node
+
+    def test_fingerprint_stable(self):
+        state = self._state()
+        node = self._node()
+        assert state.fingerprint(node) == state.fingerprint(self._node())
+        assert self._state().fingerprint(node) == state.fingerprint(node)
+
+    def test_fingerprint_ignores_local_paths(self):
+        state = self._state()
+        node = self._node()
+        other = self._node()
+        for ch in other['channels']:
+            ch['lpath'] += '-copy'
+            shutil.copy(ch['lpath'][:-len('-copy')], ch['lpath'])
+        other['name_service'] = 'udp:127.0.0.1:1234'
+        assert state.fingerprint(node) == state.fingerprint(other)
+
+    def test_fingerprint_key_order(self):
+        state = self._state()
+        node = self._node(env={'A': '1', 'B': '2'})
+        reordered = self._node()
+        reordered['env'] = dict(reversed(list(node['env'].items())))
+        assert state.fingerprint(node) == state.fingerprint(reordered)
+
+    def test_fingerprint_changes(self):
+        state = self._state()
+        before = state.fingerprint(self._node())
+        assert state.fingerprint(self._node(args='y')) != before
+        _write(self.input, b'changed input')
+        assert state.fingerprint(self._node()) != before
+
+    def test_fingerprint_exe(self):
+        state = self._state()
+        before = state.fingerprint(self._node())
+        _write(self.exe, b'other nexe')
+        assert state.fingerprint(self._node()) != before
+
+    def test_fingerprint_ignores_outputs(self):
+        state = self._state()
+        before = state.fingerprint(self._node())
+        _write(self.output, b'other output')
+        assert state.fingerprint(self._node()) == before
+
+    def test_file_digest_cached(self):
+        state = self._state()
+        digest = state.file_digest(self.input)
+        with mock.patch('hashlib.sha1') as sha1:
+            assert state.file_digest(self.input) == digest
+        assert not sha1.called
+
+    def test_record_and_restore(self):
+        state = self._state()
+        node = self._node()
+        state.record(node, self.report, self.response)
+        state.save()
+        os.unlink(self.report)
+        os.unlink(self.response)
+
+        state = self._state()
+        state.restore(node, self.report, self.response)
+        with open(self.report, 'rb') as fd:
+            assert fd.read() == b'0\n0\n0\n\n\n'
+        with open(self.response, 'rb') as fd:
+            assert fd.read() == b'response'
+
+    def test_dirty_nodes(self):
+        node = self._node()
+        state = self._state()
+        assert state.dirty_nodes({'node': node}) == set(['node'])
+        state.record(node, self.report)
+        state.save()
+
+        state = self._state()
+        assert state.dirty_nodes({'node': node}) == set()
+        _write(self.input, b'changed input')
+        assert state.dirty_nodes({'node': node}) == set(['node'])
+
+    def test_dirty_nodes_missing_output(self):
+        node = self._node()
+        state = self._state()
+        state.record(node, self.report)
+        os.unlink(self.output)
+        assert state.dirty_nodes({'node': node}) == set(['node'])
+
+    def test_dirty_nodes_propagate(self):
+        intermediate = os.path.join(self.tempdir, 'intermediate')
+        result = os.path.join(self.tempdir, 'result')
+        _write(intermediate, b'intermediate')
+        _write(result, b'result')
+        nodes = {
+            'map': self._node('map', output_path=intermediate),
+            'reduce': self._node('reduce', input_path=intermediate,
+                                 output_path=result),
+            'peer': self._node('peer', output_path=result + '-peer',
+                               connect=['reduce']),
+            'other': self._node('other', output_path=result + '-other'),
+        }
+        _write(result + '-peer')
+        _write(result + '-other')
+        state = self._state()
+        for node in nodes.values():
+            state.record(node, self.report)
+        assert state.dirty_nodes(nodes) == set()
+        _write(self.input, b'changed input')
+        # every node reads the changed input
+        assert state.dirty_nodes(nodes) == set(nodes)
+
+        state = self._state()
+        for node in nodes.values():
+            state.record(node, self.report)
+        nodes['map']['args'] = 'changed'
+        assert state.dirty_nodes(nodes) == set(['map', 'reduce', 'peer'])
+
+    def test_corrupt_state(self):
+        _write(self.state_file, b'garbage')
+        state = self._state()
+        assert state.nodes == {}
+
+
+class TestParseReport:
+    """
+    Tests for :func:`zvshlib.zvapp.parse_report`.
+    """
+
+    def test_parse(self):
+        report = ('0\n0\n0\n5d41402abc4b2a76b9719d911017c592\n'
+                  '1.23 0 0 0 0 0 0 0 0 0 0 0 0\nok.\n')
+        fields = zvapp.parse_report(report)
+        assert len(fields) == zvapp.REPORT_LENGTH
+        assert fields[zvapp.REPORT_VALIDATOR] == '0'
+        assert fields[zvapp.REPORT_RETCODE] == '0'
+        assert fields[zvapp.REPORT_ETAG] == \
+            '5d41402abc4b2a76b9719d911017c592'
+        assert fields[zvapp.REPORT_CDR] == '1.23 0 0 0 0 0 0 0 0 0 0 0 0'
+        assert fields[zvapp.REPORT_STATUS] == 'ok.'
+
+    def test_verbose(self):
+        report = ('validator state = 0\ndaemon = 0\nuser return code = 1\n'
+                  'etag = disabled\naccounting = 0 0\nexit state = '
+                  'Signal 6\n')
+        fields = zvapp.parse_report(report)
+        assert fields == ['0', '0', '1', 'disabled', '0 0', 'Signal 6']
+
+    def test_short(self):
+        assert zvapp.parse_report('') == [''] * zvapp.REPORT_LENGTH
+        assert zvapp.parse_report('0\n1') == ['0', '1', '', '', '', '']
+
+    def test_status_with_newlines(self):
+        # everything after the last separator belongs to the status
+        fields = zvapp.parse_report('0\n0\n0\n\n\nline 1\nline 2\n')
+        assert fields[zvapp.REPORT_STATUS] == 'line 1\nline 2'
@@ -0,0 +1,611 @@
+#  Copyright 2014 Rackspace, Inc.
+#
+#  Licensed under the Apache License, Version 2.0 (the "License");
+#  you may not use this file except in compliance with the License.
+#  You may obtain a copy of the License at
+#
+#      http://www.apache.org/licenses/LICENSE-2.0
+#
+#  Unless required by applicable law or agreed to in writing, software
+#  distributed under the License is distributed on an "AS IS" BASIS,
+#  WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+#  See the License for the specific language governing permissions and
+#  limitations under the License.
+
+
+"""
+Helpers of the ``zvapp`` script which depend neither on eventlet nor on
+python-zerocloud, so they can be imported and tested on their own.
+"""
+
+import bisect
+import hashlib
+import heapq
+import json
+import os
+import re
+import time
+from tempfile import mkstemp
+
+import six
+
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+
+try:
+    from os import scandir
+except ImportError:
+    try:
+        # Python 2 backport
+        from scandir import scandir
+    except ImportError:
+        scandir = None
+
+
+REGEX_SPECIAL_CHARS = '.^$*+?{}[]|()'
+
+JSON_SCALAR_TYPES = six.string_types + six.integer_types + (
+    float, bool, type(None))
+
+REPORT_VALIDATOR = 0
+REPORT_DAEMON = 1
+REPORT_RETCODE = 2
+REPORT_ETAG = 3
+REPORT_CDR = 4
+REPORT_STATUS = 5
+REPORT_LENGTH = 6
+
+
+def mask_literal_prefix(mask):
+    """
+    Return the literal string every name matched by `mask` must start with.
+
+    `mask` is a compiled regex, as generated by ClusterConfigParser for
+    wildcard paths; anything we cannot reason about yields an empty prefix.
+    """
+    pattern = getattr(mask, 'pattern', None)
+    if not pattern or '|' in pattern or mask.flags & re.IGNORECASE:
+        return ''
+    prefix = []
+    i = 0
+    if pattern.startswith('^'):
+        i = 1
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\':
+            if i + 1 < len(pattern) and not pattern[i + 1].isalnum():
+                prefix.append(pattern[i + 1])
+                i += 2
+                continue
+            break
+        if c in REGEX_SPECIAL_CHARS:
+            break
+        prefix.append(c)
+        i += 1
+    # a quantifier may make the preceding literal optional
+    if prefix and i < len(pattern) and pattern[i] in '*?{':
+        prefix.pop()
+    return ''.join(prefix)
+
+
+def scan_dir(dir_path):
+    """
+    List one directory: returns (mtime, file names, sub-directory names,
+    names of the symlinks to directories). The symlinks are kept apart so
+    they are not descended into, the same way os.walk() does.
+    """
+    mtime = os.stat(dir_path).st_mtime
+    files = []
+    dirs = []
+    links = []
+    if scandir:
+        for entry in scandir(dir_path):
+            if entry.is_dir():
+                if entry.is_symlink():
+                    links.append(entry.name)
+                else:
+                    dirs.append(entry.name)
+            else:
+                files.append(entry.name)
+    else:
+        for name in os.listdir(dir_path):
+            path = os.path.join(dir_path, name)
+            if os.path.isdir(path):
+                if os.path.islink(path):
+                    links.append(name)
+                else:
+                    dirs.append(name)
+            else:
+                files.append(name)
+    return mtime, files, dirs, links
+
+
+class ListingIndex(object):
+    """
+    Sorted listing of all the objects stored under a local directory.
+
+    The index remembers the mtime of every directory it has scanned and is
+    reused for as long as none of them changes. Adding, removing or renaming
+    an object updates the mtime of its parent directory, which forces a
+    rescan on the next lookup. Like git does for its index, a directory
+    whose mtime is within `MTIME_GRANULARITY` seconds of the scan is not
+    trusted: it could still change without its mtime moving, so it is
+    rescanned the next time.
+
+    The tree is checked once, on the first lookup; an index is meant to
+    live for one job, :meth:`invalidate` it after changing the tree.
+
+    :param top:
+        Directory to index.
+    :param cache_file:
+        Optional file the index is persisted to between zvapp runs.
+    :param recursive:
+        If `False` all the entries directly in `top` are listed, symlinks
+        included (used for account listings), otherwise all the files below
+        `top`, with paths relative to it. Like os.walk(), the recursive
+        listing does not follow the symlinks to directories.
+    """
+    VERSION = 2
+    # coarsest mtime resolution we may meet (FAT)
+    MTIME_GRANULARITY = 2.0
+
+    def __init__(self, top, cache_file=None, recursive=True):
+        self.top = top
+        self.cache_file = cache_file
+        self.recursive = recursive
+        self.dirs = {}
+        self.names = []
+        self.loaded = False
+        self.verified = False
+
+    def is_fresh(self):
+        if not self.loaded:
+            return False
+        for rel, mtime in self.dirs.items():
+            try:
+                if os.stat(os.path.join(self.top, rel)).st_mtime != mtime:
+                    return False
+            except OSError:
+                return False
+        return True
+
+    def load(self):
+        if not self.cache_file or not os.path.isfile(self.cache_file):
+            return
+        try:
+            with open(self.cache_file, 'rb') as fd:
+                data = pickle.load(fd)
+        except Exception:
+            # unreadable or truncated cache, it will be rebuilt
+            return
+        if data.get('version') != self.VERSION or data.get('top') != self.top:
+            return
+        self.dirs = data['dirs']
+        self.names = data['names']
+        self.loaded = True
+
+    def save(self):
+        if not self.cache_file:
+            return
+        cache_dir = os.path.dirname(self.cache_file)
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+        (fd, tmp_file) = mkstemp(dir=cache_dir)
+        with os.fdopen(fd, 'wb') as fp:
+            pickle.dump(dict(version=self.VERSION, top=self.top,
+                             dirs=self.dirs, names=self.names),
+                        fp, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_file, self.cache_file)
+
+    def invalidate(self):
+        """
+        Forget the index, and its cache file, so the next lookup rescans.
+        """
+        self.dirs = {}
+        self.loaded = False
+        self.verified = False
+        if self.cache_file and os.path.isfile(self.cache_file):
+            os.unlink(self.cache_file)
+
+    def scan_dirs(self, rels):
+        """
+        Return the :func:`scan_dir` results of the directories `rels`,
+        relative to `top`. Subclasses may list them concurrently.
+        """
+        return [scan_dir(os.path.join(self.top, rel)) for rel in rels]
+
+    def build(self):
+        """
+        Scan the tree level by level, the directories of every level are
+        listed with one :meth:`scan_dirs` call.
+        """
+        dirs = {}
+        names = []
+        frontier = ['']
+        racy = time.time() - self.MTIME_GRANULARITY
+        while frontier:
+            next_frontier = []
+            for rel, (mtime, files, subdirs, links) in zip(
+                    frontier, self.scan_dirs(frontier)):
+                # a racily clean directory never matches on the next check
+                dirs[rel] = mtime if mtime < racy else None
+                if not self.recursive:
+                    names.extend(files)
+                    names.extend(subdirs)
+                    names.extend(links)
+                    continue
+                for fname in files:
+                    names.append(os.path.join(rel, fname))
+                for dname in subdirs:
+                    next_frontier.append(os.path.join(rel, dname))
+            frontier = next_frontier
+        names.sort()
+        self.dirs = dirs
+        self.names = names
+        self.loaded = True
+
+    def refresh(self):
+        """
+        Make sure the index reflects the current state of the tree, only
+        the first call after creating or invalidating the index checks it.
+        """
+        if self.verified:
+            return
+        if not self.loaded:
+            self.load()
+        if not self.is_fresh():
+            self.build()
+            self.save()
+        self.verified = True
+
+    def match(self, mask=None):
+        """
+        Return the sorted names matching `mask`. Only the range of names
+        sharing the literal prefix of `mask` is checked against it.
+        """
+        if not mask:
+            return list(self.names)
+        prefix = mask_literal_prefix(mask)
+        ret = []
+        names = self.names
+        for i in range(bisect.bisect_left(names, prefix), len(names)):
+            name = names[i]
+            if not name.startswith(prefix):
+                break
+            if mask.match(name):
+                ret.append(name)
+        return ret
+
+
+class TraceRecorder(object):
+    """
+    Collect the timeline of a zvapp job as Chrome trace events, the output
+    can be loaded in chrome://tracing or any compatible trace viewer.
+
+    Every node gets its own track (a "thread" in trace-event terms), job-wide
+    phases are recorded on the "zvapp" track.
+    """
+    MAIN_TRACK = 'zvapp'
+
+    def __init__(self):
+        self.origin = time.time()
+        self.pid = os.getpid()
+        self.events = []
+        self.tracks = {}
+        self.track_id(self.MAIN_TRACK)
+
+    def track_id(self, track):
+        tid = self.tracks.get(track)
+        if tid is None:
+            tid = len(self.tracks)
+            self.tracks[track] = tid
+            self.events.append({'name': 'thread_name', 'ph': 'M',
+                                'pid': self.pid, 'tid': tid,
+                                'args': {'name': track}})
+            self.events.append({'name': 'thread_sort_index', 'ph': 'M',
+                                'pid': self.pid, 'tid': tid,
+                                'args': {'sort_index': tid}})
+        return tid
+
+    def timestamp(self, when):
+        # trace-event timestamps are in microseconds
+        return int((when - self.origin) * 1000000)
+
+    def complete(self, name, begin, end=None, track=MAIN_TRACK, args=None):
+        if end is None:
+            end = time.time()
+        event = {'name': name, 'cat': 'zvapp', 'ph': 'X',
+                 'ts': self.timestamp(begin),
+                 'dur': max(self.timestamp(end) - self.timestamp(begin), 0),
+                 'pid': self.pid, 'tid': self.track_id(track)}
+        if args:
+            event['args'] = args
+        self.events.append(event)
+
+    def instant(self, name, when=None, track=MAIN_TRACK, args=None):
+        if when is None:
+            when = time.time()
+        event = {'name': name, 'cat': 'zvapp', 'ph': 'i', 's': 't',
+                 'ts': self.timestamp(when),
+                 'pid': self.pid, 'tid': self.track_id(track)}
+        if args:
+            event['args'] = args
+        self.events.append(event)
+
+    def dump(self, file_name):
+        with open(file_name, 'w') as fd:
+            json.dump({'traceEvents': self.events,
+                       'displayTimeUnit': 'ms'}, fd)
+
+
+def shard_boundaries(data, size, count, delimiter=b'\n'):
+    """
+    Return the `(start, end)` ranges of (up to) `count` chunks of `data`,
+    `size` bytes supporting ``find`` (such as an `mmap`), cut right after a
+    `delimiter` so each chunk holds whole records.
+
+    >>> shard_boundaries(b'a\\nbb\\nccc\\nd\\n', 11, 3)
+    [(0, 5), (5, 9), (9, 11)]
+    """
+    shards = []
+    start = 0
+    for i in range(1, count + 1):
+        end = size * i // count
+        if end < size:
+            # cut right after the first delimiter that ends at or past the
+            # nominal boundary
+            pos = data.find(delimiter, max(end - len(delimiter), start))
+            end = size if pos < 0 else pos + len(delimiter)
+        if end > start:
+            shards.append((start, end))
+        start = end
+        if start >= size:
+            break
+    return shards
+
+
+def merge_sorted_files(sources, destination, buffer_size=1024 * 1024):
+    """
+    K-way merge the newline-delimited files `sources`, each sorted in byte
+    order, into `destination` through a heap, so only one record per file
+    is held in memory. Records are terminated by a newline in the result,
+    even the last one of a file without a trailing newline.
+    """
+    def records(fd):
+        for line in fd:
+            if not line.endswith(b'\n'):
+                # last record of a file without trailing newline
+                line += b'\n'
+            yield line
+
+    inputs = [open(src, 'rb', buffer_size) for src in sources]
+    try:
+        with open(destination, 'wb', buffer_size) as out:
+            out.writelines(heapq.merge(*[records(fd) for fd in inputs]))
+    finally:
+        for fd in inputs:
+            fd.close()
+
+
+def encode_node(obj, encoder):
+    """
+    Convert a parsed node into the same plain dict/list structure that a
+    `json.dumps(obj, cls=NodeEncoder)`/`json.loads()` round trip gives,
+    without serializing it to a string.
+    """
+    if isinstance(obj, dict):
+        return dict((k, encode_node(v, encoder)) for k, v in obj.items())
+    if isinstance(obj, (list, tuple)):
+        return [encode_node(v, encoder) for v in obj]
+    if isinstance(obj, JSON_SCALAR_TYPES):
+        return obj
+    return encode_node(encoder.default(obj), encoder)
+
+
+class BuildState(object):
+    """
+    Fingerprints and outputs of the nodes of previous zvapp runs, used by
+    `--incremental` to run only the nodes whose inputs changed.
+
+    ZeroVM execution is deterministic: a node whose nexe, arguments,
+    environment and input objects are the same as in a recorded run, and
+    whose outputs from that run are still in place, would write exactly the
+    same outputs again. Nodes reading the outputs of a node that has to run,
+    or connected to it over the network, have to run as well.
+
+    :param state_file:
+        File the state is persisted to between zvapp runs.
+    :param readable:
+        Channel access flags of the inputs of a node.
+    :param writable:
+        Channel access flags of the outputs of a node.
+    :param exe_path:
+        Optional function returning the local path of the nexe of a node
+        config, or `None`, so changes to the nexe are noticed too.
+    """
+    VERSION = 1
+    BUFFER_SIZE = 1024 * 1024
+
+    def __init__(self, state_file, readable, writable, exe_path=None):
+        self.state_file = state_file
+        self.readable = readable
+        self.writable = writable
+        self.exe_path = exe_path
+        self.nodes = {}
+        self.files = {}
+        self.fingerprints = {}
+        if os.path.isfile(state_file):
+            try:
+                with open(state_file, 'rb') as fd:
+                    data = pickle.load(fd)
+                if data.get('version') == self.VERSION:
+                    self.nodes = data['nodes']
+                    self.files = data['files']
+            except Exception:
+                # unreadable state, everything will run
+                pass
+
+    def save(self):
+        state_dir = os.path.dirname(self.state_file)
+        if not os.path.isdir(state_dir):
+            os.makedirs(state_dir)
+        (fd, tmp_file) = mkstemp(dir=state_dir)
+        with os.fdopen(fd, 'wb') as fp:
+            pickle.dump(dict(version=self.VERSION, nodes=self.nodes,
+                             files=self.files),
+                        fp, pickle.HIGHEST_PROTOCOL)
+        os.rename(tmp_file, self.state_file)
+
+    def inputs(self, node_config):
+        return [ch['lpath'] for ch in node_config['channels']
+                if ch['access'] & self.readable and ch.get('lpath')]
+
+    def outputs(self, node_config):
+        # channels without a path are immediate responses, kept separately
+        return [ch['lpath'] for ch in node_config['channels']
+                if ch['access'] & self.writable
+                and ch['path'] and ch.get('lpath')]
+
+    @staticmethod
+    def peers(node_config):
+        names = []
+        for entry in (node_config.get('connect') or []) + \
+                (node_config.get('bind') or []):
+            if isinstance(entry, (list, tuple)):
+                entry = entry[0]
+            names.append(entry)
+        return names
+
+    def file_digest(self, path):
+        st = os.stat(path)
+        known = self.files.get(path)
+        if known and known[0] == st.st_size and known[1] == st.st_mtime:
+            return known[2]
+        digest = hashlib.sha1()
+        with open(path, 'rb') as fd:
+            for chunk in iter(lambda: fd.read(self.BUFFER_SIZE), b''):
+                digest.update(chunk)
+        digest = digest.hexdigest()
+        self.files[path] = [st.st_size, st.st_mtime, digest]
+        return digest
+
+    def fingerprint(self, node_config):
+        desc = dict((k, v) for k, v in node_config.items()
+                    if k not in ('channels', 'name_service'))
+        desc['channels'] = [(ch['device'], ch['path'], ch['access'])
+                            for ch in node_config['channels']]
+        fingerprint = hashlib.sha1(
+            json.dumps(desc, sort_keys=True).encode('utf-8'))
+        paths = self.inputs(node_config)
+        if self.exe_path is not None:
+            exe_path = self.exe_path(node_config)
+            if exe_path:
+                paths.append(exe_path)
+        for path in paths:
+            if os.path.isfile(path):
+                fingerprint.update(self.file_digest(path).encode('ascii'))
+        return fingerprint.hexdigest()
+
+    def is_up_to_date(self, name):
+        record = self.nodes.get(name)
+        if not record or record['fingerprint'] != self.fingerprints[name]:
+            return False
+        for path, (size, mtime) in record['outputs'].items():
+            try:
+                st = os.stat(path)
+            except OSError:
+                return False
+            if st.st_size != size or st.st_mtime != mtime:
+                return False
+        return True
+
+    def dirty_nodes(self, node_configs):
+        """
+        Return the names of the nodes that have to run.
+
+        :param node_configs:
+            `dict` of node name -> node config, with resolved local paths.
+        """
+        for name, node_config in node_configs.items():
+            self.fingerprints[name] = self.fingerprint(node_config)
+        dirty = set(name for name in node_configs
+                    if not self.is_up_to_date(name))
+        writers = {}
+        for name, node_config in node_configs.items():
+            for path in self.outputs(node_config):
+                writers.setdefault(path, set()).add(name)
+        neighbours = dict((name, set()) for name in node_configs)
+        for name, node_config in node_configs.items():
+            for peer in self.peers(node_config):
+                if peer in neighbours:
+                    neighbours[name].add(peer)
+                    neighbours[peer].add(name)
+        changed = True
+        while changed:
+            changed = False
+            for name, node_config in node_configs.items():
+                if name in dirty:
+                    continue
+                if neighbours[name] & dirty or any(
+                        writers.get(path, set()) & dirty
+                        for path in self.inputs(node_config)):
+                    dirty.add(name)
+                    changed = True
+        return dirty
+
+    def record(self, node_config, report_file, response_file=None):
+        """
+        Record a successful run of the node, whose report and immediate
+        response (if any) are in `report_file` and `response_file`.
+        """
+        name = node_config['name']
+        outputs = {}
+        for path in self.outputs(node_config):
+            if os.path.isfile(path):
+                st = os.stat(path)
+                outputs[path] = (st.st_size, st.st_mtime)
+        response = None
+        if response_file:
+            with open(response_file, 'rb') as fd:
+                response = fd.read()
+        with open(report_file, 'rb') as fd:
+            report = fd.read()
+        self.nodes[name] = {
+            # inputs may have been written by the run itself
+            'fingerprint': self.fingerprint(node_config),
+            'outputs': outputs,
+            'report': report,
+            'response': response,
+        }
+
+    def restore(self, node_config, report_file, response_file=None):
+        """
+        Replay the report and the immediate response of a skipped node.
+        """
+        record = self.nodes[node_config['name']]
+        with open(report_file, 'wb') as fd:
+            fd.write(record['report'])
+        if response_file and record['response'] is not None:
+            with open(response_file, 'wb') as fd:
+                fd.write(record['response'])
+
+
+def parse_report(report):
+    """
+    Split a ZeroVM report into its `REPORT_LENGTH` fields, dropping the
+    `name = ` prefixes of verbose reports.
+
+    >>> parse_report('0\\n1\\n2\\n')
+    ['0', '1', '2', '', '', '']
+    """
+    fields = report.split('\n', REPORT_LENGTH - 1)
+    fields += [''] * (REPORT_LENGTH - len(fields))
+    result = []
+    for field in fields:
+        field = field.strip()
+        if ' = ' in field:
+            field = field.split(' = ', 1)[1]
+        result.append(field)
+    return result